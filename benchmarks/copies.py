@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+Payload bytes the driver copies per megabyte uploaded or downloaded.
+
+Payload enters the driver as strings returned by `fp.read` (uploads)
+or by the bindings (downloads). Every string handed on, to the bindings
+or to the client, which is not one of those objects is a copy made by
+the driver itself.
+
+Runs on top of the in-process fake of the bindings (tests/fake):
+
+    python -m benchmarks.copies [megabytes]
+"""
+
+import json
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(ROOT, 'tests', 'fake'))
+
+from docker_registry.drivers import elliptics as elliptics_driver  # noqa
+from docker_registry import testing  # noqa
+
+elliptics = elliptics_driver.elliptics
+
+MB = 1024 * 1024
+
+
+class Source(object):
+    """File-like upload body keeping the strings it has returned."""
+
+    def __init__(self, data, returned):
+        self.data = data
+        self.offset = 0
+        self.returned = returned
+
+    def read(self, size):
+        buf = self.data[self.offset:self.offset + size]
+        self.offset += len(buf)
+        self.returned[id(buf)] = buf
+        return buf
+
+
+class Tracer(object):
+    """Counts payload handed on which is not one of the `known` strings."""
+
+    def __init__(self):
+        self.known = {}
+        self.copied = 0
+        self.moved = 0
+
+    def account(self, data):
+        self.moved += len(data)
+        if self.known.get(id(data)) is not data:
+            self.copied += len(data)
+
+
+def trace_uploads(tracer):
+    write_data = elliptics.Session.write_data
+
+    def traced(session, key, data, offset=0):
+        if len(data) > elliptics_driver.MANIFEST_SIZE:
+            tracer.account(data)
+        return write_data(session, key, data, offset)
+    elliptics.Session.write_data = traced
+    return lambda: setattr(elliptics.Session, 'write_data', write_data)
+
+
+def trace_downloads(tracer):
+    init = elliptics.Result.__init__
+
+    def traced(result, group_id, **kwargs):
+        data = kwargs.get('data')
+        if data is not None:
+            tracer.known[id(data)] = data
+        init(result, group_id, **kwargs)
+    elliptics.Result.__init__ = traced
+    return lambda: setattr(elliptics.Result, '__init__', init)
+
+
+def run(stripe_size, megabytes):
+    elliptics.reset()
+    storage = elliptics_driver.Storage(config=testing.Config({
+        'elliptics_nodes': 'fakehost:1025:2',
+        'elliptics_groups': [1, 2, 3],
+        'elliptics_stripe_size': stripe_size}))
+    data = os.urandom(megabytes * MB)
+
+    upload = Tracer()
+    restore = trace_uploads(upload)
+    try:
+        storage.stream_write('images/a/layer', Source(data, upload.known))
+    finally:
+        restore()
+
+    download = Tracer()
+    restore = trace_downloads(download)
+    try:
+        for chunk in storage.stream_read('images/a/layer'):
+            download.account(chunk)
+    finally:
+        restore()
+
+    return dict((name, {'copied_bytes_per_mb': tracer.copied * MB /
+                        float(tracer.moved)})
+                for name, tracer in (('upload', upload),
+                                     ('download', download)))
+
+
+def main(megabytes=32):
+    results = {'single_key': run(0, megabytes),
+               'striped': run(4 * MB, megabytes)}
+    print(json.dumps(results, indent=4, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+Index update latency of writes for every `elliptics_global_index` mode.
+
+Concurrent writers store image layers metadata into distinct directories.
+The fake backend serializes updates of an index and charges them per entry
+the index already holds, which is how the single global index turns
+into the point all writes contend on.
+
+Runs on top of the in-process fake of the bindings (tests/fake):
+
+    python -m benchmarks.global_index [writers] [writes_per_writer]
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(ROOT, 'tests', 'fake'))
+
+from docker_registry.drivers import elliptics as elliptics_driver  # noqa
+from docker_registry import testing  # noqa
+
+elliptics = elliptics_driver.elliptics
+
+# seconds per index update and per entry of the updated index
+INDEX_LATENCY = 0.0005
+INDEX_ENTRY_COST = 0.000001
+MODES = (('single', {}),
+         ('sharded', {'elliptics_global_index_shards': 16}),
+         ('none', {}))
+
+
+def run(mode, options, writers, writes):
+    elliptics.reset()
+    elliptics.backend.configure(index_latency=INDEX_LATENCY,
+                                index_entry_cost=INDEX_ENTRY_COST)
+    config = {'elliptics_nodes': 'fakehost:1025:2',
+              'elliptics_groups': [1, 2, 3],
+              'elliptics_global_index': mode}
+    config.update(options)
+    storage = elliptics_driver.Storage(config=testing.Config(config))
+
+    def writer(n):
+        for i in xrange(writes):
+            image = 'images/%d-%d' % (n, i)
+            for name in ('json', 'ancestry', '_checksum'):
+                storage.put_content('%s/%s' % (image, name), 'x')
+
+    threads = [threading.Thread(target=writer, args=(n,))
+               for n in xrange(writers)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+
+    stats = storage.metrics.snapshot()['s_write_indexes']
+    return {'writes_per_sec': stats['count'] / elapsed,
+            'index_usec_per_write':
+                stats['seconds'] / stats['count'] * 10 ** 6}
+
+
+def main(writers=8, writes=50):
+    results = dict((mode, run(mode, options, writers, writes))
+                   for mode, options in MODES)
+    for mode in ('sharded', 'none'):
+        results[mode]['index_latency_drop'] = (
+            results['single']['index_usec_per_write'] /
+            results[mode]['index_usec_per_write'])
+    print(json.dumps(results, indent=4, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
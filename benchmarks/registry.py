@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+"""
+Registry workloads run through Storage against a simulated cluster.
+
+Four workloads are run one after another on the same storage:
+
+* push: N layers of an image are uploaded with their metadata
+  and a tag of the repository is set
+* pull: parallel clients download every layer with its metadata
+* tags: the tags of the repository are listed and read
+* delete: the repository and the images are removed
+
+Every workload reports ops/s, MB/s, p50/p99 latency of an operation,
+errors, the peak RSS of the process while it ran and how much RSS has
+grown over the workload as JSON. Layer contents
+and the failures injected by the simulated cluster are seeded, so runs
+of different commits with the same arguments are comparable. Pass
+a previous output as `--baseline` to have slowdowns beyond `--tolerance`
+reported (and the exit code set).
+
+Runs on top of the in-process fake of the bindings (tests/fake):
+
+    python -m benchmarks.registry [--layers 8] [--layer-mb 4] \\
+        [--latency 0.001] [--bandwidth 200] [--failure-rate 0] \\
+        [--group 2:latency=0.02] [--option elliptics_stripe_size=4194304] \\
+        [--baseline previous.json]
+"""
+
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(ROOT, 'tests', 'fake'))
+
+from docker_registry.drivers import elliptics as elliptics_driver  # noqa
+from docker_registry import testing  # noqa
+
+elliptics = elliptics_driver.elliptics
+
+MB = 1024 * 1024
+REPOSITORY = 'repositories/library/bench'
+# metrics which get worse when they go up
+LOWER_IS_BETTER = ('p50_ms', 'p99_ms', 'peak_rss_kb', 'rss_growth_kb')
+# seconds between samples of RSS
+RSS_INTERVAL = 0.01
+HIGHER_IS_BETTER = ('ops_per_sec', 'mb_per_sec')
+
+
+def percentile(latencies, p):
+    if not latencies:
+        return 0.0
+    latencies = sorted(latencies)
+    return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))]
+
+
+def rss_kb():
+    """Current RSS of the process in kilobytes."""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except (IOError, OSError):
+        # peak RSS of the process so far (kilobytes on Linux)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return pages * resource.getpagesize() // 1024
+
+
+class RssSampler(object):
+    """Peak RSS of the process while it is running, sampled
+    every RSS_INTERVAL seconds from a thread.
+    """
+
+    def __init__(self):
+        self.initial = self.peak = rss_kb()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _sample(self):
+        while not self._stop.wait(RSS_INTERVAL):
+            self.peak = max(self.peak, rss_kb())
+
+    def stop(self):
+        if not self._stop.is_set():
+            self._stop.set()
+            self._thread.join()
+            self.peak = max(self.peak, rss_kb())
+
+
+class Workload(object):
+    """Latencies, bytes and errors of the operations of a workload."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.bytes = 0
+        self.errors = 0
+        self.started = self.finished = None
+        self.rss = RssSampler()
+
+    def op(self, func, *args):
+        """Run and account a single operation,
+        `func` returns the number of bytes moved or None.
+        """
+        started = time.time()
+        try:
+            nbytes = func(*args)
+        except Exception:
+            with self.lock:
+                self.errors += 1
+            return
+        elapsed = time.time() - started
+        with self.lock:
+            self.latencies.append(elapsed)
+            self.bytes += nbytes or 0
+
+    def run(self, func, items, concurrency):
+        """Call `func(item)` as operations, `concurrency` at a time."""
+        items = list(items)
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                with lock:
+                    if not items:
+                        return
+                    item = items.pop(0)
+                self.op(func, item)
+
+        threads = [threading.Thread(target=worker)
+                   for _ in xrange(concurrency)]
+        self.started = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.finished = time.time()
+        return self
+
+    def report(self):
+        self.rss.stop()
+        elapsed = self.finished - self.started
+        return {'ops': len(self.latencies),
+                'errors': self.errors,
+                'seconds': elapsed,
+                'ops_per_sec': len(self.latencies) / elapsed,
+                'mb_per_sec': self.bytes / float(MB) / elapsed,
+                'p50_ms': percentile(self.latencies, 50) * 1000,
+                'p99_ms': percentile(self.latencies, 99) * 1000,
+                'peak_rss_kb': self.rss.peak,
+                'rss_growth_kb': self.rss.peak - self.rss.initial}
+
+
+class Layers(object):
+    """Distinct layers of `size` bytes generated from `seed`."""
+
+    def __init__(self, count, size, seed):
+        rnd = random.Random(seed)
+        block = ''.join(chr(rnd.getrandbits(8)) for _ in xrange(MB))
+        self.body = (block * (size // MB + 1))[:size]
+        self.ids = ['%064x' % rnd.getrandbits(256) for _ in xrange(count)]
+
+    def content(self, n):
+        # a distinct prefix keeps layers distinct for deduplication
+        return self.ids[n] + self.body[len(self.ids[n]):]
+
+
+class Body(object):
+    """Upload body handing out chunks of a layer as a request would."""
+
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def read(self, size):
+        buf = self.data[self.offset:self.offset + size]
+        self.offset += len(buf)
+        return buf
+
+
+def push(storage, layers, concurrency):
+    def push_layer(n):
+        image = 'images/%s' % layers.ids[n]
+        parent = layers.ids[n - 1] if n else None
+        storage.put_content(image + '/json', json.dumps(
+            {'id': layers.ids[n], 'parent': parent}))
+        content = layers.content(n)
+        storage.stream_write(image + '/layer', Body(content))
+        storage.put_content(image + '/ancestry', json.dumps(
+            list(reversed(layers.ids[:n + 1]))))
+        storage.put_content(image + '/_checksum', 'sha256:%s' % n)
+        return len(content)
+
+    def put(path, content):
+        storage.put_content(path, content)
+        return len(content)
+
+    workload = Workload().run(push_layer, xrange(len(layers.ids)),
+                              concurrency)
+    # the image is tagged once all of its layers are pushed
+    workload.op(put, REPOSITORY + '/tag_latest', layers.ids[-1])
+    workload.op(put, REPOSITORY + '/_index_images',
+                json.dumps([{'id': i} for i in layers.ids]))
+    workload.finished = time.time()
+    return workload
+
+
+def pull(storage, layers, clients):
+    def pull_layer(n):
+        image = 'images/%s' % layers.ids[n]
+        storage.get_content(image + '/json')
+        nbytes = 0
+        for chunk in storage.stream_read(image + '/layer'):
+            nbytes += len(chunk)
+        return nbytes
+
+    # every client pulls the whole image
+    return Workload().run(pull_layer, range(len(layers.ids)) * clients,
+                          clients)
+
+
+def tags(storage, layers, listings, concurrency):
+    # tags written in advance are not timed, their failures are counted
+    failed = 0
+    for n in xrange(1, len(layers.ids)):
+        try:
+            storage.put_content('%s/tag_v%d' % (REPOSITORY, n),
+                                layers.ids[n])
+        except Exception:
+            failed += 1
+
+    def list_tags(_):
+        nbytes = 0
+        for path in storage.list_directory(REPOSITORY):
+            if path.rpartition('/')[2].startswith('tag_'):
+                nbytes += len(storage.get_content(path))
+        return nbytes
+
+    workload = Workload().run(list_tags, xrange(listings), concurrency)
+    workload.errors += failed
+    return workload
+
+
+def delete(storage, layers):
+    workload = Workload()
+    workload.started = time.time()
+    workload.op(storage.remove, REPOSITORY)
+    for image in layers.ids:
+        workload.op(storage.remove, 'images/%s' % image)
+    workload.finished = time.time()
+    return workload
+
+
+def parse_value(value):
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def parse_group(spec):
+    """`GROUP:NAME=VALUE[,NAME=VALUE...]` to (group, {name: value})."""
+    group, _, settings = spec.partition(':')
+    return int(group), dict((name, parse_value(value)) for name, value in
+                            (s.split('=', 1) for s in settings.split(',')))
+
+
+def commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+            stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def regressions(results, baseline, tolerance):
+    """Names of metrics of `results` worse than `baseline` by more than
+    `tolerance` (a share of the baseline value).
+    """
+    found = []
+    for name, workload in sorted(results['workloads'].items()):
+        before = baseline['workloads'].get(name, {})
+        for metric in LOWER_IS_BETTER + HIGHER_IS_BETTER:
+            if not before.get(metric):
+                continue
+            change = workload[metric] / float(before[metric]) - 1
+            worse = change if metric in LOWER_IS_BETTER else -change
+            if worse > tolerance:
+                found.append('%s.%s %+.1f%%' % (name, metric, change * 100))
+    return found
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--layers', type=int, default=8)
+    parser.add_argument('--layer-mb', type=float, default=4)
+    parser.add_argument('--push-concurrency', type=int, default=4)
+    parser.add_argument('--pullers', type=int, default=8)
+    parser.add_argument('--listings', type=int, default=200)
+    parser.add_argument('--groups', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=0.001,
+                        help='seconds per operation of every group')
+    parser.add_argument('--jitter', type=float, default=0.0005)
+    parser.add_argument('--bandwidth', type=float, default=200,
+                        help='MB/s of every group, 0 is unlimited')
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    parser.add_argument('--group', action='append', default=[],
+                        metavar='GROUP:NAME=VALUE[,NAME=VALUE]',
+                        help='override settings of a single group')
+    parser.add_argument('--option', action='append', default=[],
+                        metavar='NAME=VALUE', help='driver option')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--baseline', help='output of a previous run')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    random.seed(args.seed)
+    groups = range(1, args.groups + 1)
+    elliptics.reset(groups)
+    elliptics.backend.configure(latency=args.latency, jitter=args.jitter,
+                                bandwidth=args.bandwidth * MB or None,
+                                failure_rate=args.failure_rate)
+    for spec in args.group:
+        group, settings = parse_group(spec)
+        elliptics.backend.configure(groups=[group], **settings)
+
+    config = {'elliptics_nodes': 'fakehost:1025:2',
+              'elliptics_groups': groups}
+    config.update((name, parse_value(value)) for name, value in
+                  (option.split('=', 1) for option in args.option))
+    storage = elliptics_driver.Storage(config=testing.Config(config))
+    layers = Layers(args.layers, int(args.layer_mb * MB), args.seed)
+
+    results = {'commit': commit(),
+               'arguments': dict((name, value) for name, value
+                                 in vars(args).items()
+                                 if name not in ('baseline', 'tolerance')),
+               'workloads': {}}
+    workloads = results['workloads']
+    workloads['push'] = push(storage, layers, args.push_concurrency).report()
+    workloads['pull'] = pull(storage, layers, args.pullers).report()
+    workloads['tags'] = tags(storage, layers, args.listings,
+                             args.pullers).report()
+    workloads['delete'] = delete(storage, layers).report()
+
+    # let operations the driver has not waited for (lookups of the slower
+    # groups) complete before the interpreter shuts down
+    while elliptics.backend.inflight:
+        time.sleep(0.01)
+
+    failed = False
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['arguments'] != results['arguments']:
+            sys.stderr.write("warning: the baseline has been run with "
+                             "other arguments\n")
+        results['baseline_commit'] = baseline['commit']
+        results['regressions'] = regressions(results, baseline,
+                                             args.tolerance)
+        failed = bool(results['regressions'])
+    print(json.dumps(results, indent=4, sort_keys=True))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+Per-operation cost of getting a ready to use Elliptics session:
+building and configuring a new one (as the driver used to do on every
+access of `Storage._session`) against cloning a preconfigured template.
+
+Runs on top of the in-process fake of the bindings (tests/fake):
+
+    python -m benchmarks.session_overhead [iterations]
+"""
+
+import json
+import os
+import sys
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(ROOT, 'tests', 'fake'))
+
+from docker_registry.drivers import elliptics as elliptics_driver  # noqa
+from docker_registry import testing  # noqa
+
+elliptics = elliptics_driver.elliptics
+
+
+def configured_session(storage):
+    # Storage._session before session templates
+    session = elliptics.Session(storage._elliptics_node)
+    session.groups = storage.groups
+    session.set_namespace(storage.namespace)
+    session.exceptions_policy = elliptics.exceptions_policy.no_exceptions
+    session.set_checker(elliptics.checkers.quorum)
+    return session
+
+
+def main(iterations=100000):
+    storage = elliptics_driver.Storage(config=testing.Config({
+        'elliptics_nodes': 'fakehost:1025:2',
+        'elliptics_groups': [1, 2, 3]}))
+
+    results = {}
+    for name, func in (('configure', lambda: configured_session(storage)),
+                       ('clone', lambda: storage._session)):
+        seconds = min(timeit.repeat(func, number=iterations, repeat=3))
+        results[name] = {'usec_per_op': seconds / iterations * 10 ** 6}
+    results['speedup'] = (results['configure']['usec_per_op'] /
+                          results['clone']['usec_per_op'])
+    print(json.dumps(results, indent=4, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+Worker time-to-ready for every `elliptics_connect_mode`.
+
+Workers are started at once, each of them builds its Storage and serves
+a first request. Remotes take a while to connect to and one of them
+is much slower than the others, as a remote on an overloaded host is.
+`init` is how long building Storage takes (the worker can not accept
+requests meanwhile), `first_request` is how long after its start
+a worker has answered the first request.
+
+Runs on top of the in-process fake of the bindings (tests/fake):
+
+    python -m benchmarks.startup [workers] [remotes] [slow_remote_seconds]
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(ROOT, 'tests', 'fake'))
+
+from docker_registry.drivers import elliptics as elliptics_driver  # noqa
+from docker_registry import testing  # noqa
+
+elliptics = elliptics_driver.elliptics
+
+# seconds to connect to a remote
+CONNECT_LATENCY = 0.05
+MODES = ('eager', 'lazy')
+
+
+def run(mode, workers, remotes, slow):
+    elliptics.reset()
+    nodes = ['host%d:1025:2' % n for n in xrange(remotes)]
+    elliptics.backend.connect_latency = dict(
+        (node, CONNECT_LATENCY) for node in nodes)
+    elliptics.backend.connect_latency[nodes[-1]] = slow
+    config = testing.Config({'elliptics_nodes': nodes,
+                             'elliptics_groups': [1, 2, 3],
+                             'elliptics_connect_mode': mode,
+                             'elliptics_route_refresh_interval': 0})
+    init = []
+    first_request = []
+
+    def worker(n):
+        started = time.time()
+        storage = elliptics_driver.Storage(config=config)
+        init.append(time.time() - started)
+        storage.put_content('images/%d/json' % n, '{}')
+        first_request.append(time.time() - started)
+
+    threads = [threading.Thread(target=worker, args=(n,))
+               for n in xrange(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return {'init_sec': {'mean': sum(init) / len(init), 'max': max(init)},
+            'first_request_sec': {
+                'mean': sum(first_request) / len(first_request),
+                'max': max(first_request)}}
+
+
+def main(workers=16, remotes=8, slow=1.0):
+    results = dict((mode, run(mode, int(workers), int(remotes), float(slow)))
+                   for mode in MODES)
+    print(json.dumps(results, indent=4, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -16,8 +16,20 @@ Packages: http://repo.reverbrain.com/
 import os
 import types
 
+import collections
+import errno
+import fnmatch
+import hashlib
 import itertools
+import json
 import logging
+import shutil
+import socket
+import struct
+import threading
+import time
+import uuid
+import zlib
 
 
 def import_non_local(name, custom_name=None):
@@ -31,6 +43,13 @@ def import_non_local(name, custom_name=None):
 
 elliptics = import_non_local('elliptics')
 
+try:
+    import gevent
+    import gevent.event
+    import gevent.monkey
+except ImportError:  # pragma: no cover
+    gevent = None
+
 from docker_registry.core import driver
 from docker_registry.core import exceptions
 from docker_registry.core import lru
@@ -38,6 +57,10 @@ from docker_registry.core import lru
 logger = logging.getLogger(__name__)
 
 DEFAULT_NAMESPACE = "DOCKER"
+# content of keys imitating directories
+FAKE_DIR_CONTENT = "DIRECTORY"
+# index every key is marked with
+GLOBAL_INDEX = "docker"
 
 
 DEFAUL_WAIT_TIMEOUT = 60
@@ -47,6 +70,776 @@ DEFAULT_NET_THREAD_NUM = 2
 DEFAULT_NONBLOCKING_IO_THREAD_NUM = 2
 DEFAULT_GROUPS = [1]
 DEFAULT_VERBOSITY = 'error'
+DEFAULT_STREAM_WRITE_INFLIGHT = 4
+DEFAULT_STREAM_READ_AHEAD = 2
+DEFAULT_DIR_CACHE_SIZE = 0
+DEFAULT_DIR_CACHE_TTL = 60
+DEFAULT_EXISTS_CACHE_SIZE = 10000
+DEFAULT_EXISTS_CACHE_TTL = 2
+DEFAULT_REMOVE_CONCURRENCY = 32
+DEFAULT_LOOKUP_CONCURRENCY = 64
+DEFAULT_LISTING_CACHE_SIZE = 0
+DEFAULT_LISTING_CACHE_TTL = 30
+DEFAULT_STAT_CACHE_SIZE = 10000
+DEFAULT_STAT_CACHE_TTL = 10
+DEFAULT_WAIT_MODE = 'thread'
+DEFAULT_CONNECT_MODE = 'eager'
+CONNECT_MODES = ('eager', 'lazy')
+DEFAULT_ROUTE_REFRESH_INTERVAL = 60
+DEFAULT_GLOBAL_INDEX = 'single'
+DEFAULT_GLOBAL_INDEX_SHARDS = 16
+GLOBAL_INDEX_MODES = ('single', 'sharded', 'none')
+# 1 Gb
+DEFAULT_DISK_CACHE_SIZE = 1024 ** 3
+# keys which are not changed once written: the disk cache of a process
+# can not get stale because of writes of the others and any replica
+# is as good as the latest one
+IMMUTABLE_PREFIX = 'images/'
+DEFAULT_IMAGES_READ_MODE = 'latest'
+IMAGES_READ_MODES = ('latest', 'fastest')
+DEFAULT_HEDGE_PERCENTILE = 0
+DEFAULT_HEDGE_BUDGET = 0.05
+DEFAULT_STRIPE_SIZE = 0
+# content of a striped object key: the magic, size, stripe size and
+# the generation of its stripes padded to MANIFEST_SIZE
+STRIPE_MAGIC = "STRIPED1"
+MANIFEST_SIZE = 64
+# content of a deduplicated object key: the magic, size, digest
+# and the key of the blob padded to REFERENCE_SIZE
+REFERENCE_MAGIC = "DEDUP1"
+REFERENCE_SIZE = 128
+DEFAULT_COMPRESS_MIN_SIZE = 512
+# 1 day
+DEFAULT_UPLOAD_TTL = 24 * 60 * 60
+# index sidecar keys of uploads in progress are marked with
+UPLOADS_INDEX = "#uploads"
+# header of a compressed object, followed by the size of its content
+# (8 bytes, big endian) and zlib stream of it. Raw objects are told apart
+# by the leading zero byte JSON never starts with
+COMPRESSED_MAGIC = "\x00zlib1\x00"
+COMPRESSED_HEADER_SIZE = len(COMPRESSED_MAGIC) + 8
+# deduplicated content is stored once under a key of this prefix,
+# such keys are never changed once written
+BLOB_PREFIX = '#blob/'
+
+# `is_dir` is None if it is unknown yet,
+# `stripe_size` is 0 unless the object is striped,
+# `target` is the blob key of a deduplicated object,
+# `generation` names the stripes of a striped object
+Stat = collections.namedtuple('Stat', ['size', 'mtime', 'is_dir',
+                                       'stripe_size', 'target',
+                                       'generation'])
+Stat.__new__.__defaults__ = (0, None, '')
+
+
+def fake_dir_index(path):
+    """Name of the index fake subdirectories of `path` are marked with."""
+    return "%s#dirs" % path
+
+
+def as_str(data):
+    """Return `data` as str, converting (copying) it only if it is not."""
+    return data if isinstance(data, str) else str(data)
+
+
+def striped_index(path):
+    """Name of the index objects of `path` kept in other keys
+    (striped and deduplicated ones) are marked with.
+    """
+    return "%s#striped" % path
+
+
+def stripe_key(path, number, generation=''):
+    if generation:
+        return "%s#%s#stripe%d" % (path, generation, number)
+    return "%s#stripe%d" % (path, number)
+
+
+def new_generation():
+    """Name of the stripes of an object being written, so an upload
+    never writes over the stripes of the object stored.
+    """
+    return uuid.uuid4().hex[:16]
+
+
+def make_manifest(size, stripe_size, generation=''):
+    return ("%s %d %d %s" % (STRIPE_MAGIC, size, stripe_size,
+                             generation)).ljust(MANIFEST_SIZE)
+
+
+def parse_manifest(data):
+    """Return `(size, stripe_size, generation)` of a manifest or None.
+    Manifests written before generations have an empty one.
+    """
+    if len(data) != MANIFEST_SIZE or not data.startswith(STRIPE_MAGIC + " "):
+        return None
+    fields = data.split()
+    generation = fields[3] if len(fields) > 3 else ''
+    return int(fields[1]), int(fields[2]), generation
+
+
+def upload_key(path):
+    """Key holding the checkpoint of an upload of `path` in progress."""
+    return "%s#upload" % path
+
+
+def stripe_keys(path, stat):
+    """Keys of all stripes of `path` with Stat `stat`."""
+    if not stat.stripe_size:
+        return []
+    return [stripe_key(path, n, stat.generation)
+            for n in xrange(-(-stat.size // stat.stripe_size))]
+
+
+def compress(content):
+    """Return `content` with the compressed header or None if it
+    does not get smaller.
+    """
+    data = (COMPRESSED_MAGIC + struct.pack('>Q', len(content)) +
+            zlib.compress(content))
+    if len(data) >= len(content):
+        return None
+    return data
+
+
+def compressed_size(header):
+    """Return the content size a compressed object header tells
+    or None if it is not one.
+    """
+    if (len(header) < COMPRESSED_HEADER_SIZE or
+            not header.startswith(COMPRESSED_MAGIC)):
+        return None
+    return struct.unpack('>Q', header[len(COMPRESSED_MAGIC):
+                                      COMPRESSED_HEADER_SIZE])[0]
+
+
+def decompress(data):
+    """Return the content of an object stored as `data`."""
+    size = compressed_size(data)
+    if size is None:
+        return data
+    try:
+        content = zlib.decompress(data[COMPRESSED_HEADER_SIZE:])
+    except zlib.error:
+        # a raw object which happens to start with the header
+        return data
+    if len(content) != size:
+        return data
+    return content
+
+
+def make_reference(size, digest, blob):
+    return ("%s %d %s %s" % (REFERENCE_MAGIC, size, digest, blob)).ljust(
+        REFERENCE_SIZE)
+
+
+def parse_reference(data):
+    """Return `(size, digest, blob)` of a reference or None."""
+    if (len(data) != REFERENCE_SIZE or
+            not data.startswith(REFERENCE_MAGIC + " ")):
+        return None
+    _, size, digest, blob = data.split()
+    return int(size), digest, blob
+
+
+def content_key(digest):
+    """Key holding the name of the blob with content `digest`."""
+    return "#sha256/%s" % digest
+
+
+def refs_index(digest):
+    """Name of the index references to content `digest` are marked with."""
+    return "#refs/%s" % digest
+
+
+def global_index_shard(key, shards):
+    """Name of the shard of the global index `key` is marked with."""
+    return "%s#%d" % (GLOBAL_INDEX, (zlib.crc32(key) & 0xffffffff) % shards)
+
+
+def number_option(config, name, default, minimum=0, cast=int):
+    value = getattr(config, name)
+    value = default if value is None else cast(value)
+    if value < minimum:
+        raise exceptions.ConfigError("%s must be at least %s"
+                                     % (name, minimum))
+    return value
+
+
+def original(module, name):
+    """`module.name` as it was before gevent monkey patching.
+    Elliptics calls block the OS thread they are made in, so background
+    work is done in OS threads even if `thread` is patched.
+    """
+    if gevent is not None:
+        return gevent.monkey.get_original(module, name)
+    return getattr(__import__(module), name)
+
+
+def remote_addresses(remote, getaddrinfo=socket.getaddrinfo):
+    """Addresses remote `host:port:family` may be routed by.
+    A host name is resolved: routes name the addresses of remotes.
+    """
+    try:
+        host, port, family = remote.rsplit(':', 2)
+        infos = getaddrinfo(host, int(port), int(family), socket.SOCK_STREAM)
+    except (ValueError, socket.error):
+        return set([remote])
+    return set([remote] + ["%s:%s:%s" % (info[4][0], port, family)
+                           for info in infos])
+
+
+class LRUCache(object):
+    """Thread-safe mapping bounded by `size` items.
+    The least recently used items are evicted first.
+    Items older than `ttl` seconds are expired (if `ttl` is set).
+    Zero `size` disables the cache.
+    """
+
+    def __init__(self, size, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, stamp = self._items.pop(key)
+            except KeyError:
+                return default
+            if self.ttl and time.time() - stamp > self.ttl:
+                return default
+            self._items[key] = (value, stamp)
+            return value
+
+    def set(self, key, value):
+        if not self.size:
+            return
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (value, time.time())
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def update(self, key, func):
+        """Replace a cached value with `func(value)`.
+        The age of the item is kept.
+        """
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return
+            value, stamp = item
+            if self.ttl and time.time() - stamp > self.ttl:
+                return
+            self._items[key] = (func(value), stamp)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            try:
+                return self._items.pop(key)[0]
+            except KeyError:
+                return default
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __contains__(self, key):
+        marker = object()
+        return self.get(key, marker) is not marker
+
+    def __len__(self):
+        return len(self._items)
+
+
+class DiskCache(object):
+    """Whole objects kept in files under `root` within `size` bytes.
+    The least recently used objects are evicted first.
+    Every instance has a directory of its own, directories left
+    by processes which are gone are removed.
+    Zero `size` or no `root` disables the cache.
+    """
+
+    def __init__(self, root, size):
+        self.size = size if root else 0
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        # path -> size of its file
+        self._entries = collections.OrderedDict()
+        # path -> token of the fill which may store it
+        self._filling = {}
+        self._lock = threading.Lock()
+        self.root = None
+        if self.size:
+            self._clean(root)
+            self.root = os.path.join(root, '%d.%x' % (os.getpid(), id(self)))
+            os.makedirs(self.root)
+
+    @staticmethod
+    def _clean(root):
+        if not os.path.isdir(root):
+            return
+        for name in os.listdir(root):
+            pid = name.partition('.')[0]
+            if not pid.isdigit():
+                continue
+            try:
+                os.kill(int(pid), 0)
+                continue
+            except OSError as err:
+                if err.errno != errno.ESRCH:
+                    continue
+            shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+
+    def _file(self, path):
+        return os.path.join(self.root, hashlib.sha1(path).hexdigest())
+
+    def _unlink(self, filename):
+        try:
+            os.unlink(filename)
+        except OSError as err:
+            logger.warning("Unable to remove %s: %s", filename, err)
+
+    def open(self, path):
+        """Return an open file with the cached object or None."""
+        if not self.size:
+            return None
+        with self._lock:
+            nbytes = self._entries.pop(path, None)
+            if nbytes is not None:
+                try:
+                    # an evicted file stays readable while it is open
+                    f = open(self._file(path), 'rb')
+                except IOError as err:
+                    logger.warning("Unable to open cached %s: %s", path, err)
+                    self.used -= nbytes
+                else:
+                    self._entries[path] = nbytes
+                    self.hits += 1
+                    return f
+            self.misses += 1
+            return None
+
+    def size_of(self, path):
+        """Return the size of the cached object or None."""
+        with self._lock:
+            return self._entries.get(path)
+
+    def fill(self, path, chunks):
+        """Yield `chunks` of the whole object `path` writing them aside.
+        The file is put in place once all of them are consumed,
+        unless `path` has been invalidated meanwhile.
+        """
+        if not self.size:
+            for chunk in chunks:
+                yield chunk
+            return
+
+        token = object()
+        with self._lock:
+            self._filling[path] = token
+        tmp = '%s.%x.tmp' % (self._file(path), id(token))
+        nbytes = 0
+        try:
+            f = open(tmp, 'wb')
+        except IOError as err:
+            logger.warning("Unable to cache %s: %s", path, err)
+            f = None
+        try:
+            for chunk in chunks:
+                if f is not None:
+                    nbytes += len(chunk)
+                    try:
+                        if nbytes > self.size:
+                            raise IOError("%s is larger than the cache"
+                                          % path)
+                        f.write(chunk)
+                    except IOError as err:
+                        logger.warning("Unable to cache %s: %s", path, err)
+                        f.close()
+                        self._unlink(tmp)
+                        f = None
+                yield chunk
+            if f is not None:
+                f.close()
+                f = None
+                self._commit(path, token, tmp, nbytes)
+        finally:
+            if f is not None:
+                # the reader has gone or failed
+                f.close()
+                self._unlink(tmp)
+            with self._lock:
+                if self._filling.get(path) is token:
+                    del self._filling[path]
+
+    def _commit(self, path, token, tmp, nbytes):
+        with self._lock:
+            if self._filling.get(path) is not token:
+                self._unlink(tmp)
+                return
+            del self._filling[path]
+            os.rename(tmp, self._file(path))
+            self.used += nbytes - self._entries.pop(path, 0)
+            self._entries[path] = nbytes
+            while self.used > self.size:
+                evicted, evicted_bytes = self._entries.popitem(last=False)
+                self.used -= evicted_bytes
+                self._unlink(self._file(evicted))
+
+    def invalidate(self, path):
+        if not self.size:
+            return
+        with self._lock:
+            self._filling.pop(path, None)
+            nbytes = self._entries.pop(path, None)
+            if nbytes is not None:
+                self.used -= nbytes
+                self._unlink(self._file(path))
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.0
+
+
+class GroupScores(object):
+    """Moving average of read latency of every group.
+    A failure counts as `penalty` seconds. Scores halve every `forget`
+    seconds a group is not sampled for, so a group which has been slow
+    or failing is tried again after a while.
+    """
+
+    def __init__(self, groups, alpha=0.2, penalty=1.0, forget=60.0):
+        self.alpha = alpha
+        self.penalty = penalty
+        self.forget = forget
+        self._groups = list(groups)
+        # group -> (score, time of the last sample)
+        self._scores = dict((group, (0.0, 0.0)) for group in self._groups)
+        self._lock = threading.Lock()
+
+    def _score(self, group, now):
+        score, sampled = self._scores[group]
+        return score * 0.5 ** ((now - sampled) / self.forget)
+
+    def add(self, group, seconds):
+        with self._lock:
+            if group not in self._scores:
+                return
+            now = time.time()
+            score = self._score(group, now)
+            self._scores[group] = (score + self.alpha * (seconds - score),
+                                   now)
+
+    def fail(self, group):
+        self.add(group, self.penalty)
+
+    def score(self, group):
+        with self._lock:
+            return self._score(group, time.time())
+
+    def order(self):
+        """Groups from the best to the worst, ties in configured order."""
+        with self._lock:
+            now = time.time()
+            return sorted(self._groups,
+                          key=lambda group: self._score(group, now))
+
+
+class DigestReader(object):
+    """File-like wrapper computing sha256 and size of what is read."""
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size):
+        buf = self.fp.read(size)
+        self.digest.update(buf)
+        self.size += len(buf)
+        return buf
+
+
+class LatencyWindow(object):
+    """Percentiles of the last `size` latencies.
+    The sorted copy percentiles are taken from is refreshed
+    every `refresh` samples.
+    """
+
+    def __init__(self, size=1000, refresh=100, min_samples=20):
+        self.refresh = refresh
+        self.min_samples = min_samples
+        self._samples = collections.deque(maxlen=size)
+        self._sorted = []
+        self._added = 0
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+            self._added += 1
+            if (self._added % self.refresh == 0 or
+                    len(self._sorted) < self.min_samples):
+                self._sorted = sorted(self._samples)
+
+    def percentile(self, p):
+        """Return the `p`th percentile or None if there are few samples."""
+        samples = self._sorted
+        if len(samples) < self.min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * p / 100.0))]
+
+
+class FastestRead(object):
+    """Read of an immutable key from `order` groups in turn, the best
+    scored one first. It is hedged with a read from the rest if it is late.
+    """
+
+    def __init__(self, path, offset, size, order, result):
+        self.path = path
+        self.offset = offset
+        self.size = size
+        self.order = order
+        self.result = result
+        self.started = time.time()
+
+
+class Metrics(object):
+    """Latency histograms, bytes, errors and per group outcomes
+    of Elliptics operations.
+    """
+
+    # upper bounds of latency buckets in seconds
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+               1, 2.5, 5, 10, float('inf'))
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ops = {}
+        self._stop_dumping = None
+
+    def _new_op(self):
+        return {'count': 0,
+                'seconds': 0.0,
+                'buckets': [0] * len(self.BUCKETS),
+                'bytes': 0,
+                'errors': {},
+                'groups': {}}
+
+    def add(self, op, seconds, nbytes=0, code=0, groups=None):
+        """Account an operation. `groups` maps group ids to error codes."""
+        with self._lock:
+            stats = self._ops.get(op)
+            if stats is None:
+                stats = self._ops[op] = self._new_op()
+            stats['count'] += 1
+            stats['seconds'] += seconds
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    stats['buckets'][i] += 1
+                    break
+            stats['bytes'] += nbytes
+            if code != 0:
+                stats['errors'][code] = stats['errors'].get(code, 0) + 1
+            for group, group_code in (groups or {}).items():
+                outcomes = stats['groups'].setdefault(group,
+                                                      {'ok': 0, 'error': 0})
+                outcomes['ok' if group_code == 0 else 'error'] += 1
+
+    def record(self, op, r, nbytes=0):
+        """Account a completed async result `r`."""
+        elapsed = r.elapsed_time()
+        groups = {}
+        for entry in r.get():
+            group = getattr(entry, 'group_id', None)
+            if group is not None:
+                groups[group] = entry.error.code
+        self.add(op, elapsed.tsec + elapsed.tnsec / 1e9,
+                 nbytes, r.error().code, groups)
+
+    def snapshot(self):
+        with self._lock:
+            result = {}
+            for op, stats in self._ops.items():
+                result[op] = {
+                    'count': stats['count'],
+                    'seconds': stats['seconds'],
+                    'bytes': stats['bytes'],
+                    'latency': dict(zip(map(str, self.BUCKETS),
+                                        stats['buckets'])),
+                    'errors': dict(stats['errors']),
+                    'groups': dict((group, dict(outcomes)) for group, outcomes
+                                   in stats['groups'].items())}
+            return result
+
+    def reset(self):
+        with self._lock:
+            self._ops.clear()
+
+    def prometheus(self):
+        """Format the metrics in Prometheus text exposition format."""
+        lines = ['# TYPE elliptics_op_seconds histogram']
+        snapshot = self.snapshot()
+        for op, stats in sorted(snapshot.items()):
+            total = 0
+            for bound in self.BUCKETS:
+                total += stats['latency'][str(bound)]
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('elliptics_op_seconds_bucket{op="%s",le="%s"} %d'
+                             % (op, le, total))
+            lines.append('elliptics_op_seconds_sum{op="%s"} %f'
+                         % (op, stats['seconds']))
+            lines.append('elliptics_op_seconds_count{op="%s"} %d'
+                         % (op, stats['count']))
+        lines.append('# TYPE elliptics_op_bytes_total counter')
+        for op, stats in sorted(snapshot.items()):
+            lines.append('elliptics_op_bytes_total{op="%s"} %d'
+                         % (op, stats['bytes']))
+        lines.append('# TYPE elliptics_op_errors_total counter')
+        for op, stats in sorted(snapshot.items()):
+            for code, count in sorted(stats['errors'].items()):
+                lines.append('elliptics_op_errors_total{op="%s",code="%d"} %d'
+                             % (op, code, count))
+        lines.append('# TYPE elliptics_op_group_results_total counter')
+        for op, stats in sorted(snapshot.items()):
+            for group, outcomes in sorted(stats['groups'].items()):
+                for outcome, count in sorted(outcomes.items()):
+                    lines.append('elliptics_op_group_results_total'
+                                 '{op="%s",group="%s",result="%s"} %d'
+                                 % (op, group, outcome, count))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path=None):
+        """Log the metrics as JSON or write them to Prometheus
+        text file `path` (atomically).
+        """
+        if path is None:
+            logger.info("elliptics metrics %s",
+                        json.dumps(self.snapshot(), sort_keys=True))
+            return
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(self.prometheus())
+        os.rename(tmp, path)
+
+    def start_dumping(self, interval, path=None):
+        stop = self._stop_dumping = threading.Event()
+
+        def loop():
+            while not stop.wait(interval):
+                try:
+                    self.dump(path)
+                except Exception as err:
+                    logger.error("Unable to dump metrics: %s", err)
+
+        dumper = threading.Thread(target=loop, name='elliptics-metrics')
+        dumper.daemon = True
+        dumper.start()
+        return dumper
+
+    def stop_dumping(self):
+        if self._stop_dumping is not None:
+            self._stop_dumping.set()
+
+
+class HandledResult(object):
+    """Entries and error of an async result which have been handed
+    to a connected handler. The bindings do not keep them for get()
+    then, so they are read from here.
+    """
+
+    def __init__(self, r, results, error):
+        self._elapsed = r.elapsed_time()
+        self._results = results
+        self._error = error
+
+    def get(self):
+        return list(self._results)
+
+    def error(self):
+        return self._error
+
+    def elapsed_time(self):
+        return self._elapsed
+
+    def __iter__(self):
+        return iter(self._results)
+
+
+class ThreadWaiter(object):
+    """Waits for Elliptics async results blocking the calling thread.
+    Both wait() and iterate() return what the entries are read from.
+    """
+
+    def event(self):
+        return threading.Event()
+
+    def wait(self, r):
+        r.wait()
+        return r
+
+    def iterate(self, r):
+        # entries are yielded as they arrive
+        return r
+
+
+class GeventEvent(object):
+    """Event that can be set from any thread (i.e. from Elliptics
+    handlers) and waited for by a greenlet without blocking the hub.
+    """
+
+    def __init__(self):
+        loop = gevent.get_hub().loop
+        # `async` has been renamed to `async_` in gevent 1.3
+        make_async = getattr(loop, 'async_', None) or getattr(loop, 'async')
+        self._watcher = make_async()
+        self._event = gevent.event.Event()
+        self._watcher.start(self._event.set)
+        self._lock = gevent.monkey.get_original('thread', 'allocate_lock')()
+        self._closed = False
+
+    def set(self):
+        with self._lock:
+            if not self._closed:
+                self._watcher.send()
+
+    def wait(self, timeout=None):
+        try:
+            return self._event.wait(timeout)
+        finally:
+            with self._lock:
+                self._closed = True
+                self._watcher.close()
+
+
+class GeventWaiter(object):
+    """Waits for Elliptics async results letting other greenlets run."""
+
+    def event(self):
+        return GeventEvent()
+
+    def wait(self, r):
+        event = self.event()
+        handled = []
+
+        def handler(results, error):
+            handled.append(HandledResult(r, results, error))
+            event.set()
+
+        r.connect(handler)
+        event.wait()
+        return handled[0]
+
+    def iterate(self, r):
+        return self.wait(r)
+
+
+WAITERS = {'thread': ThreadWaiter,
+           'gevent': GeventWaiter}
 
 
 class Storage(driver.Base):
@@ -54,8 +847,141 @@ class Storage(driver.Base):
     def __init__(self, path=None, config=None):
         # Turn on streaming support
         self.supports_bytes_range = True
+        # How to wait for Elliptics: block a thread or switch greenlets
+        wait_mode = config.elliptics_wait_mode or DEFAULT_WAIT_MODE
+        if wait_mode not in WAITERS:
+            raise exceptions.ConfigError(
+                'Invalid wait mode %s. Use one of %s'
+                % (wait_mode, ','.join(sorted(WAITERS))))
+        if wait_mode == 'gevent' and gevent is None:
+            raise exceptions.ConfigError("gevent wait mode requires gevent")
+        self._waiter = WAITERS[wait_mode]()
+        # Instrumentation of Elliptics operations
+        self.metrics = Metrics()
+        # Dump metrics every `metrics_interval` seconds if it's set
+        metrics_interval = number_option(config, 'elliptics_metrics_interval',
+                                         0, cast=float)
+        if metrics_interval:
+            self.metrics.start_dumping(metrics_interval,
+                                       config.elliptics_metrics_file)
         # Increase buffer size up to 640 Kb
         self.buffer_size = 128 * 1024
+        # Number of chunk writes stream_write keeps on the wire
+        self.stream_write_inflight = number_option(
+            config, 'elliptics_stream_write_inflight',
+            DEFAULT_STREAM_WRITE_INFLIGHT, minimum=1)
+        # Objects larger than this are written as stripes of this size
+        self.stripe_size = number_option(config, 'elliptics_stripe_size',
+                                         DEFAULT_STRIPE_SIZE)
+        if self.stripe_size % self.buffer_size:
+            raise exceptions.ConfigError(
+                "elliptics_stripe_size must be a multiple of %d"
+                % self.buffer_size)
+        # Checkpoint striped uploads, so a retry continues where
+        # an interrupted one has stopped
+        self.resumable_uploads = bool(config.elliptics_resumable_uploads)
+        if self.resumable_uploads and not self.stripe_size:
+            raise exceptions.ConfigError(
+                "elliptics_resumable_uploads requires elliptics_stripe_size")
+        # Seconds after which clean_uploads() drops an interrupted upload
+        self.upload_ttl = number_option(config, 'elliptics_upload_ttl',
+                                        DEFAULT_UPLOAD_TTL, cast=float)
+        # Bytes of retried uploads which have not been written again
+        self.upload_bytes_resumed = 0
+        # Store uploads once per content, paths are references to it
+        self.dedup = bool(config.elliptics_dedup)
+        # Bytes of uploads found stored already
+        self.dedup_bytes_saved = 0
+        # put_content compresses paths matching these patterns
+        self.compress_patterns = config.elliptics_compress_patterns or []
+        if isinstance(self.compress_patterns, types.StringTypes):
+            self.compress_patterns = self.compress_patterns.split()
+        # Smaller contents are stored as they are
+        self.compress_min_size = number_option(
+            config, 'elliptics_compress_min_size', DEFAULT_COMPRESS_MIN_SIZE)
+        # Bytes put_content has not written thanks to compression
+        self.compressed_bytes_saved = 0
+        # Number of chunks stream_read prefetches
+        self.stream_read_ahead = number_option(
+            config, 'elliptics_stream_read_ahead', DEFAULT_STREAM_READ_AHEAD)
+        # Fake directories known to exist
+        self._known_dirs = LRUCache(
+            number_option(config, 'elliptics_dir_cache_size',
+                          DEFAULT_DIR_CACHE_SIZE),
+            number_option(config, 'elliptics_dir_cache_ttl',
+                          DEFAULT_DIR_CACHE_TTL, cast=float))
+        # Number of fake directory writes saved by the cache
+        self.dir_writes_skipped = 0
+        # Number of keys removed concurrently by remove()
+        self.remove_concurrency = number_option(
+            config, 'elliptics_remove_concurrency',
+            DEFAULT_REMOVE_CONCURRENCY, minimum=1)
+        # Number of keys stat_directory() looks up and get_contents() reads
+        # at a time
+        self.lookup_concurrency = number_option(
+            config, 'elliptics_lookup_concurrency',
+            DEFAULT_LOOKUP_CONCURRENCY, minimum=1)
+        # Recent answers of exists(), both positive and negative
+        self._exists_cache = LRUCache(
+            number_option(config, 'elliptics_exists_cache_size',
+                          DEFAULT_EXISTS_CACHE_SIZE),
+            number_option(config, 'elliptics_exists_cache_ttl',
+                          DEFAULT_EXISTS_CACHE_TTL, cast=float))
+        # Size, mtime and kind of recently looked up keys
+        self._stats = LRUCache(
+            number_option(config, 'elliptics_stat_cache_size',
+                          DEFAULT_STAT_CACHE_SIZE),
+            number_option(config, 'elliptics_stat_cache_ttl',
+                          DEFAULT_STAT_CACHE_TTL, cast=float))
+        # Recently listed directories, kept up to date by writes and removes
+        self._listings = LRUCache(
+            number_option(config, 'elliptics_listing_cache_size',
+                          DEFAULT_LISTING_CACHE_SIZE),
+            number_option(config, 'elliptics_listing_cache_ttl',
+                          DEFAULT_LISTING_CACHE_TTL, cast=float))
+        # Maintain one global index, N shards of it or none at all
+        self.global_index = (config.elliptics_global_index or
+                             DEFAULT_GLOBAL_INDEX)
+        if self.global_index not in GLOBAL_INDEX_MODES:
+            raise exceptions.ConfigError(
+                'Invalid global index mode %s. Use one of %s'
+                % (self.global_index, ','.join(GLOBAL_INDEX_MODES)))
+        self.global_index_shards = number_option(
+            config, 'elliptics_global_index_shards',
+            DEFAULT_GLOBAL_INDEX_SHARDS, minimum=1)
+        # Objects under IMMUTABLE_PREFIX kept on a local disk
+        self.disk_cache = DiskCache(
+            config.elliptics_disk_cache_dir,
+            number_option(config, 'elliptics_disk_cache_size',
+                          DEFAULT_DISK_CACHE_SIZE))
+        # Read immutable keys from the latest replica or the fastest group
+        self.images_read_mode = (config.elliptics_images_read_mode or
+                                 DEFAULT_IMAGES_READ_MODE)
+        if self.images_read_mode not in IMAGES_READ_MODES:
+            raise exceptions.ConfigError(
+                'Invalid images read mode %s. Use one of %s'
+                % (self.images_read_mode, ','.join(IMAGES_READ_MODES)))
+        # Hedge `fastest` reads slower than this percentile of them
+        self.hedge_percentile = number_option(
+            config, 'elliptics_hedge_percentile', DEFAULT_HEDGE_PERCENTILE,
+            cast=float)
+        if self.hedge_percentile >= 100:
+            raise exceptions.ConfigError(
+                "elliptics_hedge_percentile must be less than 100")
+        if self.hedge_percentile and self.images_read_mode != 'fastest':
+            raise exceptions.ConfigError(
+                "hedged reads require the fastest images read mode")
+        # at most this share of reads is hedged
+        self.hedge_budget = number_option(
+            config, 'elliptics_hedge_budget', DEFAULT_HEDGE_BUDGET,
+            cast=float)
+        self._read_latencies = LatencyWindow()
+        # Numbers of hedgeable reads, hedges sent and hedges answered first
+        self.hedged_reads = 0
+        self.hedges_fired = 0
+        self.hedges_won = 0
+        # Fake subdirectories of recently listed directories
+        self._subdirs = LRUCache(self._stats.size, self._stats.ttl)
         # Create default Elliptics config
         cfg = elliptics.Config()
         # The parameter which sets the time to wait for the operation complete
@@ -87,6 +1013,8 @@ class Storage(driver.Base):
 
         if len(self.groups) == 0:
             raise exceptions.ConfigError("elliptics_groups must be specified")
+        # Read latency of groups for the `fastest` images read mode
+        self.group_scores = GroupScores(self.groups)
 
         # loglevel of elliptics logger
         elliptics_log_level = (config.elliptics_verbosity or
@@ -118,6 +1046,45 @@ class Storage(driver.Base):
             raise exceptions.ConfigError("elliptics_nodes must be list,"
                                          "tuple or string")
 
+        # Connect before returning or in background
+        self.connect_mode = (config.elliptics_connect_mode or
+                             DEFAULT_CONNECT_MODE)
+        if self.connect_mode not in CONNECT_MODES:
+            raise exceptions.ConfigError(
+                'Invalid connect mode %s. Use one of %s'
+                % (self.connect_mode, ','.join(CONNECT_MODES)))
+        # Remotes missing in routes are re-added this often in lazy mode
+        self.route_refresh_interval = number_option(
+            config, 'elliptics_route_refresh_interval',
+            DEFAULT_ROUTE_REFRESH_INTERVAL, cast=float)
+        self._remotes = remotes
+        # Set once operations may be sent: a route is there
+        # or no remote could be connected to. It is shared with
+        # the OS threads of a lazy connect, so is the lock
+        self._ready = False
+        self._ready_lock = original('thread', 'allocate_lock')()
+        self._ready_waiters = []
+        # Set once a route has been seen, until then routes are checked
+        # by every operation
+        self._routed = False
+        # Seconds from the start of connecting until a route has appeared
+        self.time_to_ready = None
+        self._stop_refreshing = False
+
+        # Preconfigured sessions, operations work with their clones
+        self._session_templates = dict(
+            (checker, self._new_session(checker))
+            for checker in (elliptics.checkers.quorum,
+                            elliptics.checkers.at_least_one,
+                            elliptics.checkers.no_check))
+
+        if self.connect_mode == 'lazy':
+            self.s_connect_lazily()
+            if self.route_refresh_interval:
+                self.s_start_refreshing()
+            return
+
+        started = time.time()
         try:
             logger.info("Remotes %s is being added", remotes)
             self._elliptics_node.add_remotes(remotes)
@@ -125,107 +1092,664 @@ class Storage(driver.Base):
         except Exception as err:
             logger.error("Failed to add remotes %s: %s", remotes, err)
 
-        routes = self._session.routes.addresses()
+        routes = self.s_routes()
         if not routes:
             # routing table is empty,
             # as no remotes have been successfully added or conencted.
-            logger.error("routes %s, %s", routes, self._session.routes)
+            logger.error("routes %s, %s", routes,
+                         self._session_templates[
+                             elliptics.checkers.quorum].routes)
             raise exceptions.ConnectionError("Unable to connect to Elliptics")
+        self.time_to_ready = time.time() - started
+        self._routed = True
+        self._ready = True
 
-    @property
-    def _session(self):
+    def s_routes(self):
+        """Addresses of the routing table."""
+        session = self._session_templates[elliptics.checkers.quorum]
+        return [str(address) for address in session.routes.addresses()]
+
+    def s_set_ready(self):
+        with self._ready_lock:
+            if self._ready:
+                return
+            self._ready = True
+            waiters, self._ready_waiters = self._ready_waiters, []
+        for event in waiters:
+            event.set()
+
+    def s_wait_ready(self):
+        """Block until a lazy connect has a route.
+        Raises ConnectionError if no remote could be connected to.
+        """
+        if self._routed:
+            return
+        event = self._waiter.event()
+        with self._ready_lock:
+            ready = self._ready
+            if not ready:
+                self._ready_waiters.append(event)
+        if not ready:
+            event.wait()
+        # the routes of a failed connect may have been refreshed since
+        if not self.s_routes():
+            raise exceptions.ConnectionError("Unable to connect to Elliptics")
+        self._routed = True
+
+    def s_connect_lazily(self):
+        """Add remotes in background, one OS thread per remote, so a slow
+        remote does not delay the others. Operations wait in
+        s_wait_ready until the first of them is connected.
+        """
+        started = time.time()
+        lock = original('thread', 'allocate_lock')()
+        left = [len(self._remotes)]
+
+        def connect(remote):
+            try:
+                self._elliptics_node.add_remotes([remote])
+                logger.info("Remote %s has been added", remote)
+            except Exception as err:
+                logger.error("Failed to add remote %s: %s", remote, err)
+            with lock:
+                left[0] -= 1
+                done = not left[0]
+            if self._ready:
+                return
+            if self.s_routes():
+                self.time_to_ready = time.time() - started
+                self.s_set_ready()
+            elif done:
+                logger.error("Unable to connect to any of %s", self._remotes)
+                self.s_set_ready()
+
+        logger.info("Remotes %s are being added in background", self._remotes)
+        start_thread = original('thread', 'start_new_thread')
+        for remote in self._remotes:
+            start_thread(connect, (remote,))
+        if not self._remotes:
+            self.s_set_ready()
+
+    def s_refresh_routes(self):
+        """Re-add remotes which have dropped out of routes.
+        Returns the remotes which have been re-added.
+        It blocks in name resolution, which is left to the refresher
+        thread under gevent too.
+        """
+        routes = set(self.s_routes())
+        getaddrinfo = original('socket', 'getaddrinfo')
+        added = []
+        for remote in self._remotes:
+            if remote_addresses(remote, getaddrinfo) & routes:
+                continue
+            try:
+                self._elliptics_node.add_remotes([remote])
+            except Exception as err:
+                logger.warning("Failed to re-add remote %s: %s",
+                               remote, err)
+            else:
+                added.append(remote)
+        if added:
+            logger.info("Remotes %s have been re-added", added)
+            if not self._ready:
+                self.s_set_ready()
+        return added
+
+    def s_start_refreshing(self):
+        sleep = original('time', 'sleep')
+
+        def loop():
+            while True:
+                sleep(self.route_refresh_interval)
+                if self._stop_refreshing:
+                    return
+                try:
+                    self.s_refresh_routes()
+                except Exception as err:
+                    logger.error("Unable to refresh routes: %s", err)
+
+        original('thread', 'start_new_thread')(loop, ())
+
+    def stop_refreshing(self):
+        self._stop_refreshing = True
+
+    def _new_session(self, checker):
         session = elliptics.Session(self._elliptics_node)
         session.groups = self.groups
         session.set_namespace(self.namespace)
         session.exceptions_policy = elliptics.exceptions_policy.no_exceptions
+        session.set_checker(checker)
+        return session
+
+    def _clone_session(self, checker):
+        self.s_wait_ready()
+        return self._session_templates[checker].clone()
+
+    @property
+    def _session(self):
         # data should be stored in number of copies at least groups/2 + 1,
         # otherwise exception will be raised
         # i.e 3 groups -> 2 copies, 1 groups -> 1 copy
-        session.set_checker(elliptics.checkers.quorum)
-        return session
+        return self._clone_session(elliptics.checkers.quorum)
+
+    def s_wait(self, r):
+        """Wait for `r`, return what its entries are read from."""
+        return self._waiter.wait(r)
+
+    def _forget(self, key):
+        # drop cached metadata of a changed key
+        self._exists_cache.pop(key)
+        self._stats.pop(key)
+        self.disk_cache.invalidate(key)
+        self._subdirs.pop(os.path.dirname(key))
+
+    def s_bounded(self, start, items, limit):
+        """Call `start(item)` for every item keeping at most `limit` of them
+        in flight. `start` returns a list of async results.
+        Yields `(item, results)` once all results of the item are ready.
+        """
+        pending = collections.deque()
+        for item in items:
+            if len(pending) >= limit:
+                done, results = pending.popleft()
+                yield done, [self.s_wait(r) for r in results]
+            pending.append((item, start(item)))
+
+        for done, results in pending:
+            yield done, [self.s_wait(r) for r in results]
 
     def s_find(self, tags):
-        r = self._session.find_all_indexes(list(tags))
-        r.wait()
+        r = self.s_wait(self._session.find_all_indexes(list(tags)))
+        self.metrics.record('s_find', r)
         result = r.get()
         return [str(i.indexes[0].data) for i in itertools.chain(result)]
 
-    def s_remove(self, key):
-        fail = False
-        r = self._session.remove(key)
-        r.wait()
-        err = r.error()
-        if err.code != 0:
-            logger.warning("Unable to remove key %s %s", key, err.message)
-            fail = True
+    def s_global_tags(self, key):
+        """Global indexes `key` is marked with."""
+        if self.global_index == 'single':
+            return (GLOBAL_INDEX,)
+        if self.global_index == 'sharded':
+            return (global_index_shard(key, self.global_index_shards),)
+        return ()
 
-        r = self._session.set_indexes(key, [], [])
-        r.wait()
-        err = r.error()
-        if err.code != 0:
-            logger.warning("Unable to remove key %s indexes %s",
-                           key, err.message)
-        if fail:
+    def s_dir_tags(self, path):
+        """Indexes to intersect to list fake directory `path`.
+        The directory index alone is enough unless the global index
+        is maintained, which it is not in all of its shards.
+        """
+        if self.global_index == 'single':
+            return [GLOBAL_INDEX, path]
+        return [path]
+
+    def s_lookup(self, key, latest=False):
+        """Lookup `key` in all groups at once.
+        Returns the first found lookup result or None, with `latest`
+        all groups are waited for and the newest replica is returned.
+        """
+        found = []
+        finished = []
+        done = self._waiter.event()
+        started = time.time()
+
+        # handlers are called from Elliptics threads,
+        # list.append is atomic
+        def on_result(result):
+            if result.error.code == 0:
+                found.append(result)
+                if not latest:
+                    done.set()
+
+        def on_final(error):
+            finished.append(error)
+            if len(finished) == len(self.groups):
+                done.set()
+
+        session = self._clone_session(elliptics.checkers.no_check)
+        for group in self.groups:
+            gsession = session.clone()
+            gsession.set_groups([group])
+            gsession.lookup(key).connect(on_result, on_final)
+        done.wait()
+        if latest:
+            found.sort(key=lambda r: (r.timestamp.tsec, r.timestamp.tnsec),
+                       reverse=True)
+        if found:
+            self.metrics.add('s_lookup', time.time() - started,
+                             groups={found[0].group_id: 0})
+            return found[0]
+        self.metrics.add('s_lookup', time.time() - started,
+                         code=finished[-1].code or -errno.ENOENT)
+        return None
+
+    def s_remove(self, key):
+        if key in self.s_remove_many([key]):
             raise exceptions.FileNotFoundError("No such file %s" % key)
 
+    def s_remove_many(self, keys):
+        """Remove data and indexes of `keys`, `remove_concurrency` keys
+        at a time. Returns a dict of keys which data removal has failed
+        with the corresponding errors.
+        """
+        session = self._session
+
+        def start(key):
+            self._forget(key)
+            self._known_dirs.pop(key)
+            self._listings.update(os.path.dirname(key),
+                                  lambda keys: keys - frozenset([key]))
+            self._listings.pop(key)
+            return [session.remove(key), session.set_indexes(key, [], [])]
+
+        failed = {}
+        for key, (r, r_indexes) in self.s_bounded(start, keys,
+                                                  self.remove_concurrency):
+            self.metrics.record('s_remove', r)
+            self.metrics.record('s_remove_indexes', r_indexes)
+            err = r.error()
+            if err.code != 0:
+                logger.warning("Unable to remove key %s %s",
+                               key, err.message)
+                failed[key] = err
+
+            err = r_indexes.error()
+            if err.code != 0:
+                logger.warning("Unable to remove key %s indexes %s",
+                               key, err.message)
+        return failed
+
+    def s_walk(self, path, dir_tags=None):
+        """Return all keys of fake directory `path` and its subdirectories.
+        `dir_tags(dirname)` gives indexes to list a directory by.
+        """
+        session = self._session
+        dir_tags = dir_tags or self.s_dir_tags
+
+        def start(dirname):
+            return [session.find_all_indexes(dir_tags(dirname))]
+
+        found = []
+        seen = set([path])
+        level = [path]
+        while level:
+            children = []
+            for _, (r,) in self.s_bounded(start, level,
+                                          self.remove_concurrency):
+                self.metrics.record('s_find', r)
+                for i in r.get():
+                    key = str(i.indexes[0].data)
+                    if key not in seen:
+                        seen.add(key)
+                        children.append(key)
+            found.extend(children)
+            level = children
+        return found
+
     def s_read(self, path, offset=0, size=0):
-        session = self._session.clone()
-        session.set_checker(elliptics.checkers.at_least_one)
-        r = session.read_latest(path, offset=offset, size=size)
-        r.wait()
+        return self.s_read_wait(path, self.s_read_async(path, offset, size))
+
+    def s_read_fastest(self, path):
+        return (self.images_read_mode == 'fastest' and
+                path.startswith((IMMUTABLE_PREFIX, BLOB_PREFIX)))
+
+    def s_read_async(self, path, offset=0, size=0):
+        session = self._clone_session(elliptics.checkers.at_least_one)
+        if self.s_read_fastest(path):
+            # groups are tried one by one from the best scored one
+            order = self.group_scores.order()
+            session.set_groups(order)
+            r = session.read_data(path, offset=offset, size=size)
+            return FastestRead(path, offset, size, order, r)
+        return session.read_latest(path, offset=offset, size=size)
+
+    def s_hedge(self, read):
+        """Wait for `read` sending the same read to the other groups
+        if it has not been answered within `hedge_percentile` of read
+        latency. Returns the async result answered first successfully.
+        """
+        self.hedged_reads += 1
+        finished = []
+        # the event the handlers set now
+        current = [self._waiter.event()]
+
+        def on_final(name, r):
+            def handler(results, error):
+                finished.append((name, HandledResult(r, results, error)))
+                current[0].set()
+            return handler
+
+        read.result.connect(on_final('read', read.result))
+        delay = self._read_latencies.percentile(self.hedge_percentile)
+        if (delay is None or len(read.order) < 2 or
+                self.hedges_fired >= self.hedge_budget * self.hedged_reads):
+            # wait as long as it takes
+            delay = None
+        else:
+            delay = max(0.0, delay - (time.time() - read.started))
+        if current[0].wait(delay):
+            # the read may have been answered long before it is waited
+            # for (i.e. a read ahead), so its own latency is sampled
+            r = finished[0][1]
+            elapsed = r.elapsed_time()
+            self._read_latencies.add(elapsed.tsec + elapsed.tnsec / 1e9)
+            return r
+
+        self.hedges_fired += 1
+        session = self._clone_session(elliptics.checkers.at_least_one)
+        session.set_groups(read.order[1:])
+        hedge = session.read_data(read.path, offset=read.offset,
+                                  size=read.size)
+        hedge.connect(on_final('hedge', hedge))
+        while True:
+            current[0] = self._waiter.event()
+            done = list(finished)
+            ok = [name for name, r in done if r.error().code == 0]
+            if ok or len(done) == 2:
+                break
+            current[0].wait()
+
+        done = dict(done)
+        if 'read' in done:
+            elapsed = done['read'].elapsed_time()
+            self._read_latencies.add(elapsed.tsec + elapsed.tnsec / 1e9)
+        else:
+            # the first group has been at least that slow
+            self._read_latencies.add(time.time() - read.started)
+        winner = ok[0] if ok else 'read'
+        if winner == 'hedge':
+            self.hedges_won += 1
+        return done[winner]
+
+    def s_score_read(self, order, r):
+        """Account the outcome of a read of `order` groups in turn."""
+        err = r.error()
+        if err.code == -errno.ENOENT:
+            return
+        served = r.get()[0].group_id if err.code == 0 else None
+        # groups ranked above the one which has answered have failed
+        for group in order:
+            if group == served:
+                elapsed = r.elapsed_time()
+                self.group_scores.add(group,
+                                      elapsed.tsec + elapsed.tnsec / 1e9)
+                break
+            self.group_scores.fail(group)
+
+    def s_read_wait(self, path, r):
+        if isinstance(r, FastestRead):
+            read = r
+            if self.hedge_percentile:
+                r = self.s_hedge(read)
+            else:
+                r = self.s_wait(read.result)
+            # scores may have changed since the read has been sent
+            self.s_score_read(read.order, r)
+        else:
+            r = self.s_wait(r)
         err = r.error()
         if err.code != 0:
+            self.metrics.record('s_read', r)
             raise exceptions.FileNotFoundError("No such file %s" % path)
 
-        res = r.get()[0]
-        return str(res.data)
+        data = as_str(r.get()[0].data)
+        self.metrics.record('s_read', r, len(data))
+        return data
 
     def s_write(self, key, value, tags):
-        # Write data with given key
-        r = self._session.write_data(key, str(value))
-        r.wait()
-        err = r.error()
-        if err.code != 0:
-            raise exceptions.UnspecifiedError("Writing failed %s" % err)
+        self.s_write_many([(key, value, tags)])
 
-        # Set indexes
-        r = self._session.update_indexes(key, list(tags), [key] * len(tags))
-        r.wait()
-        err = r.error()
-        if err.code != 0:
-            raise exceptions.UnspecifiedError("Indexe setting failed %s" % err)
+    def s_write_many(self, items, op='s_write', fake_dirs=()):
+        """Write `(key, value, tags)` items and `(key, tags)` fake
+        directories concurrently: data and indexes of all of them
+        are sent at once and waited for together.
+        `op` names the operation in metrics.
+        """
+        items = [(key, value, tags, op) for key, value, tags in items]
+        items.extend((key, FAKE_DIR_CONTENT, tags, 's_write_fake_dir')
+                     for key, tags in fake_dirs)
+        session = self._session
+        results = [(session.write_data(key, as_str(value)),
+                    session.update_indexes(key, list(tags),
+                                           [key] * len(tags)))
+                   for key, value, tags, _ in items]
+        results = [(self.s_wait(r), self.s_wait(r_indexes))
+                   for r, r_indexes in results]
+        for (key, value, _, op), (r, r_indexes) in zip(items, results):
+            self._forget(key)
+            self.metrics.record(op, r, len(value))
+            self.metrics.record(op + '_indexes', r_indexes)
+
+        failed = [(key, tags, r.error(), r_indexes.error())
+                  for (key, _, tags, _), (r, r_indexes) in zip(items, results)
+                  if r.error().code != 0]
+        if failed:
+            # do not leave keys which have never been written in listings
+            for key, tags, _, index_err in failed:
+                if index_err.code == 0 and self.s_lookup(key) is None:
+                    self.s_wait(session.remove_indexes(key, list(tags)))
+            raise exceptions.UnspecifiedError("Writing failed %s"
+                                              % failed[0][2])
+        for _, r_indexes in results:
+            err = r_indexes.error()
+            if err.code != 0:
+                raise exceptions.UnspecifiedError(
+                    "Indexe setting failed %s" % err)
+
+        for key, _, _, _ in items:
+            self._listings.update(os.path.dirname(key),
+                                  lambda keys: keys | frozenset([key]))
 
     def s_append(self, key, content):
+        self._forget(key)
         session = self._session
         session.ioflags = elliptics.io_flags.append
 
         # set offset to resolve function overloading
-        r = session.write_data(key, content, offset=0)
-        r.wait()
+        r = self.s_wait(session.write_data(key, content, offset=0))
+        self.metrics.record('s_append', r, len(content))
         err = r.error()
         if err.code != 0:
             raise exceptions.UnspecifiedError("Writing failed {0}".format(err))
 
+    def s_write_at(self, key, content, offset):
+        # the result is not waited here,
+        # so a caller can keep several writes in flight
+        self._forget(key)
+        return self._session.write_data(key, content, offset=offset)
+
+    def s_wait_writes(self, key, pending, keep=0, done=None):
+        """Wait for the oldest `(offset, size, async_result)` writes of `key`
+        in `pending` until only `keep` of them stay in flight, calling
+        `done(offset, size)` for every one of them (if it is given).
+        If any of them has failed the rest are waited as well
+        and UnspecifiedError is raised.
+        """
+        while len(pending) > keep:
+            offset, size, r = pending.popleft()
+            r = self.s_wait(r)
+            self.metrics.record('s_write_at', r, size)
+            err = r.error()
+            if err.code != 0:
+                # do not leave writes behind
+                for _, _, rest in pending:
+                    self.s_wait(rest)
+                pending.clear()
+                raise exceptions.UnspecifiedError(
+                    "Writing %s failed at offset %d %s" % (key, offset, err))
+            if done is not None:
+                done(offset, size)
+
     def s_write_file(self, path, content):
-        tag, _, _ = path.rpartition('/')
-        if len(content) == 0:
-            content = "EMPTY"
-        logger.debug("put_content: write %s with tag %s", path, tag)
-        self.s_write(path, content, ('docker', tag))
-        self.create_fake_dir_struct(path)
+        self.s_write_files([(path, content)])
         return path
 
+    def s_write_files(self, files, striped=False):
+        """Write `(path, content)` files of one logical operation
+        (i.e. `json`, `ancestry` and `_checksum` of an image)
+        along with their missing fake directories in a single round:
+        all data and index updates are in flight at once.
+        `striped` files are manifests of striped objects.
+        """
+        items = []
+        for path, content in files:
+            tag, _, _ = path.rpartition('/')
+            if len(content) == 0:
+                content = "EMPTY"
+            logger.debug("put_content: write %s with tag %s", path, tag)
+            tags = self.s_global_tags(path) + (tag,)
+            if striped:
+                tags += (striped_index(tag),)
+            items.append((path, content, tags))
+        missing = self.s_missing_fake_dirs(path for path, _ in files)
+        self.s_write_many(items, fake_dirs=missing)
+        for fakedir_key, _ in missing:
+            self._known_dirs.set(fakedir_key, True)
+
+    def s_disk_cached(self, path):
+        """Return an open file with `path` from the disk cache or None."""
+        if not path.startswith(IMMUTABLE_PREFIX):
+            return None
+        return self.disk_cache.open(path)
+
     @lru.get
     def get_content(self, path):
+        cached = self.s_disk_cached(path)
+        if cached is not None:
+            with cached:
+                return cached.read()
+
+        def read():
+            yield self.s_read_whole(path)
+
         try:
-            return self.s_read(path)
+            if path.startswith(IMMUTABLE_PREFIX):
+                # the fill starts before the read, so a write
+                # in the meantime keeps stale data out of the cache
+                return ''.join(self.disk_cache.fill(path, read()))
+            return self.s_read_whole(path)
         except Exception:
             raise exceptions.FileNotFoundError("File not found %s" % path)
 
+    def get_contents(self, paths):
+        """Bulk get_content: read `paths` concurrently, `lookup_concurrency`
+        of them at a time. Returns a `{path: content}` mapping where
+        paths which could not be read map to FileNotFoundError instead.
+        Contents are looked up in and stored into the lru cache at once.
+        """
+        paths = sorted(set(paths))
+        contents = self.s_lru_get_many(paths)
+        missing = []
+        for path in paths:
+            if path in contents:
+                continue
+            cached = self.s_disk_cached(path)
+            if cached is not None:
+                with cached:
+                    contents[path] = cached.read()
+            else:
+                missing.append(path)
+
+        fetched = {}
+
+        def finish(path, r):
+            try:
+                data = self.s_read_wait(path, r)
+                if (parse_manifest(data) is not None or
+                        parse_reference(data) is not None):
+                    data = self.s_read_whole(path)
+                fetched[path] = decompress(data)
+            except Exception:
+                contents[path] = exceptions.FileNotFoundError(
+                    "File not found %s" % path)
+
+        pending = collections.deque()
+        for path in missing:
+            if len(pending) >= self.lookup_concurrency:
+                finish(*pending.popleft())
+            pending.append((path, self.s_read_async(path)))
+        while pending:
+            finish(*pending.popleft())
+
+        self.s_lru_set_many(fetched)
+        contents.update(fetched)
+        return contents
+
+    def s_lru_get_many(self, paths):
+        """Return `{path: content}` of `paths` found in the lru cache."""
+        if lru.redis_conn is None or not paths:
+            return {}
+        try:
+            values = lru.redis_conn.mget([lru.cache_key(path)
+                                          for path in paths])
+        except lru.redis.exceptions.ConnectionError as e:
+            logger.warning("LRU: Redis connection error: %s", e)
+            return {}
+        return dict((path, value) for path, value in zip(paths, values)
+                    if value is not None)
+
+    def s_lru_set_many(self, contents):
+        """Store a `{path: content}` mapping into the lru cache."""
+        if lru.redis_conn is None or not contents:
+            return
+        pipeline = lru.redis_conn.pipeline(transaction=False)
+        for path, content in contents.items():
+            pipeline.set(lru.cache_key(path), content)
+        try:
+            pipeline.execute()
+        except lru.redis.exceptions.ConnectionError as e:
+            logger.warning("LRU: Redis connection error: %s", e)
+
+    def s_lru_remove_many(self, paths):
+        """Drop `paths` from the lru cache."""
+        if lru.redis_conn is None or not paths:
+            return
+        try:
+            lru.redis_conn.delete(*[lru.cache_key(path) for path in paths])
+        except lru.redis.exceptions.ConnectionError as e:
+            logger.warning("LRU: Redis connection error: %s", e)
+
+    def s_read_whole(self, path):
+        """Read `path`, all stripes of it if it is striped,
+        the content it refers to if it is deduplicated.
+        """
+        data = self.s_read(path)
+        if (parse_manifest(data) is not None or
+                parse_reference(data) is not None):
+            return ''.join(self.s_read_chunks(path))
+        return decompress(data)
+
     @lru.set
     def put_content(self, path, content):
         logger.debug("put_content %s %d", path, len(content))
-        return self.s_write_file(path, content)
+        return self.s_write_file(path, self.s_compress(path, content))
+
+    def s_compress(self, path, content):
+        """Return `content` to store under `path`: compressed if `path`
+        matches `compress_patterns` and it is large enough to pay off.
+        """
+        if (len(content) < self.compress_min_size or
+                not self.s_compressible(path)):
+            return content
+        data = compress(content)
+        if data is None:
+            return content
+        self.compressed_bytes_saved += len(content) - len(data)
+        return data
+
+    def s_compressible(self, path):
+        """Whether `path` matches `compress_patterns`."""
+        return any(fnmatch.fnmatchcase(path, pattern)
+                   for pattern in self.compress_patterns)
+
+    def put_contents(self, files):
+        """Batch put_content: write a `{path: content}` mapping
+        in a single round.
+        """
+        files = sorted(files.items())
+        logger.debug("put_contents %s", [path for path, _ in files])
+        self.s_lru_remove_many([path for path, _ in files])
+        self.s_write_files([(path, self.s_compress(path, content))
+                            for path, content in files])
+        return [path for path, _ in files]
 
     def create_fake_dir_struct(self, path):
         """`path` is full filename (i.e. to create structure for file 'a/b/c'
@@ -240,99 +1764,845 @@ class Storage(driver.Base):
         to support existance operation.
         Listing of `path` is performed as looking for all key marked
         with `path` index.
+        Fake directories are marked with `fake_dir_index` of their parent
+        as well, to tell them from files without reading them.
         """
         logger.debug("creating fake directory structure %s", path)
-        # get parent dir for a given filepath
-        fakedir_key = os.path.dirname(path)
-        while True:
-            _tag = os.path.dirname(fakedir_key)
-            logger.debug("creating fake dir %s %s", fakedir_key, _tag)
-            self.s_write(fakedir_key, "DIRECTORY", ('docker', _tag))
-            fakedir_key = _tag
-            if not fakedir_key:  # root has been reached. fakedir_key is empty.
-                break
+        missing = self.s_missing_fake_dirs([path])
+        if missing:
+            self.s_write_many([], fake_dirs=missing)
+            for fakedir_key, _ in missing:
+                self._known_dirs.set(fakedir_key, True)
         logger.debug("fake directory structure %s has been created", path)
 
+    def s_missing_fake_dirs(self, paths):
+        """Return `(key, tags)` of fake directories of `paths`
+        which are not known to exist, each one once.
+        """
+        missing = []
+        queued = set()
+        for path in paths:
+            # get parent dir for a given filepath
+            fakedir_key = os.path.dirname(path)
+            fakedirs = []
+            while True:
+                fakedirs.append((fakedir_key, os.path.dirname(fakedir_key)))
+                fakedir_key = os.path.dirname(fakedir_key)
+                if not fakedir_key:  # root has been reached
+                    break
+
+            # a known directory has got all its parents written as well
+            written = 0
+            for fakedir_key, _tag in fakedirs:
+                if fakedir_key in self._known_dirs or fakedir_key in queued:
+                    break
+                queued.add(fakedir_key)
+                missing.append((fakedir_key,
+                                self.s_global_tags(fakedir_key) +
+                                (_tag, fake_dir_index(_tag))))
+                written += 1
+            self.dir_writes_skipped += len(fakedirs) - written
+        if missing:
+            logger.debug("creating fake dirs %s", missing)
+        return missing
+
     def stream_write(self, path, fp):
-        first_chunk = True
-        while True:
+        previous = self.s_stat(path)
+        old_digest = None
+        if previous is not None and previous.target is not None:
+            old_digest = self.s_digest(path)
+        digest = None
+        stripes = []
+        if self.dedup:
+            digest = self.s_write_dedup(path, fp)
+        elif self.stripe_size:
+            stripes = self.s_write_striped(path, fp,
+                                           upload=self.s_upload(path))
+        else:
+            self.s_write_chunks(path, fp)
+        # the size might have been looked up in the middle of the upload
+        self._forget(path)
+
+        if previous is None:
+            return
+        if previous.stripe_size and previous.target is None:
+            # stripes of the previous object, the manifest refers
+            # to the new ones already
+            self.s_remove_many([key for key in stripe_keys(path, previous)
+                                if key not in set(stripes)])
+        if old_digest is not None and old_digest != digest:
+            self.s_wait(self._session.remove_indexes(
+                path, [refs_index(old_digest)]))
+        if old_digest is not None:
+            # the same content may be referred to by another blob now
+            self.s_release(old_digest, previous.target)
+        if ((previous.stripe_size or previous.target is not None) and
+                not stripes and digest is None):
+            self.s_wait(self._session.remove_indexes(
+                path, [striped_index(os.path.dirname(path))]))
+
+    def s_write_plain(self, key, data):
+        """Write `data` to `key` without any indexes."""
+        self.s_wait_writes(key, collections.deque(
+            [(0, len(data), self.s_write_at(key, data, 0))]))
+
+    def s_write_dedup(self, path, fp):
+        """Upload `fp` to a new blob key and refer to it from `path`.
+        If the same content is stored already the new blob is dropped
+        and the stored one is referred to instead.
+        Returns the sha256 of the content or None if it is empty.
+        """
+        reader = DigestReader(fp)
+        blob = BLOB_PREFIX + uuid.uuid4().hex
+        upload = self.s_upload(path)
+        if upload is not None:
+            # an interrupted upload is continued in the same blob
+            state = self.s_load_checkpoint(upload)
+            # unless it has been completed: the blob may be referred to
+            if (state is not None and
+                    state['key'].startswith(BLOB_PREFIX) and
+                    self.s_stat(state['key']) is None):
+                blob = state['key']
+        if self.stripe_size:
+            stripes = self.s_write_striped(blob, reader, indexed=False,
+                                           upload=upload)
+        else:
             try:
-                buf = fp.read(self.buffer_size)
-                if not buf:
-                    break
+                self.s_write_chunks(blob, reader, indexed=False)
+            except exceptions.UnspecifiedError:
+                # no key refers to a partially written blob
+                self.s_remove_many([blob])
+                raise
+            stripes = []
+        if not reader.size:
+            # nothing has been written, as without deduplication
+            return None
+        digest = reader.digest.hexdigest()
 
-                # add buffer-in-the-middle
-                # not to write small chunks
+        def drop(stored):
+            self.s_remove_many([blob] + stripes)
+            self.dedup_bytes_saved += reader.size
+            logger.info("%s is stored as %s already, %d bytes saved",
+                        path, stored, reader.size)
 
-                if not first_chunk:
-                    self.s_append(path, buf)
-                else:
-                    # first of all the old file should be rewritten if exists.
-                    # all tags will be set up.
-                    self.s_write_file(path, buf)
-                    first_chunk = False
+        # the reference is marked before the content key is looked at,
+        # so s_release either sees it or leaves the content key to us
+        r = self.s_wait(self._session.update_indexes(
+            path, [refs_index(digest)], [path]))
+        self.metrics.record('s_write_indexes', r)
+        if r.error().code != 0:
+            self.s_remove_many([blob] + stripes)
+            raise exceptions.UnspecifiedError(
+                "Indexe setting failed %s" % r.error())
+
+        key = content_key(digest)
+        stored = self.s_content_blob(digest)
+        if stored is not None and self.s_stat(stored) is not None:
+            drop(stored)
+            blob = stored
+        else:
+            self.s_write_plain(key, blob)
+            # a concurrent upload of the same content may have missed
+            # the content key as well, the last write of it wins.
+            # Uploads which may have read our blob from it meanwhile
+            # keep it referred to, s_release removes it after them.
+            stored = self.s_content_blob(digest)
+            if (stored is not None and stored != blob and
+                    self.s_stat(stored) is not None and
+                    not self.s_referred(blob, digest, [
+                        key for key in self.s_find((refs_index(digest),))
+                        if key != path])):
+                drop(stored)
+                blob = stored
+        self.s_write_files([(path, make_reference(reader.size, digest,
+                                                  blob))], striped=True)
+        return digest
+
+    def s_digest(self, path):
+        """Return the content digest of deduplicated `path` or None."""
+        try:
+            reference = parse_reference(self.s_read(path))
+        except exceptions.FileNotFoundError:
+            return None
+        return reference and reference[1]
+
+    def s_content_blob(self, digest):
+        """Return the blob the content key of `digest` names or None."""
+        try:
+            return self.s_read(content_key(digest))
+        except exceptions.FileNotFoundError:
+            return None
+
+    def s_release(self, digest, blob=None):
+        """Remove the blob with content `digest` once no key refers
+        to it any more. `blob` is the one the released key referred to:
+        an upload which has lost the race for the content key may have
+        been left referring to its own blob, which is removed once no
+        key refers to it either.
+        """
+        index = refs_index(digest)
+        key = content_key(digest)
+        referrers = self.s_find((index,))
+        stored = self.s_content_blob(digest)
+        if not referrers and stored is not None:
+            self.s_remove_many([key])
+            referrers = self.s_find((index,))
+            if referrers:
+                # an upload of the same content has referred to it meanwhile
+                self.s_write_plain(key, stored)
+            else:
+                self.s_remove_blob(stored)
+                logger.info("%s is not referred to any more, removed %s",
+                            digest, stored)
+        if blob is None or blob == stored:
+            return
+        if self.s_referred(blob, digest, referrers):
+            return
+        self.s_remove_blob(blob)
+        logger.info("%s is not referred to any more, removed %s",
+                    digest, blob)
+
+    def s_referred(self, blob, digest, paths):
+        """Whether any of `paths` marked as referrers of `digest` refers
+        to `blob` or may be about to: an upload whose reference is not
+        written yet may have read `blob` from the content key.
+        """
+        unwritten = []
+        for path in paths:
+            try:
+                reference = parse_reference(self.s_read(path))
+            except exceptions.FileNotFoundError:
+                reference = None
+            if reference is None or reference[1] != digest:
+                unwritten.append(path)
+            elif reference[2] == blob:
+                return True
+        if not unwritten:
+            return False
+        # remove() unmarks referrers before their keys are gone, those
+        # still marked are uploads which have not written a reference yet
+        return bool(set(unwritten) & set(self.s_find((refs_index(digest),))))
+
+    def s_remove_blob(self, blob):
+        stat = self.s_stat(blob)
+        self.s_remove_many((stat and stripe_keys(blob, stat) or []) + [blob])
 
+    def s_write_chunks(self, path, fp, indexed=True):
+        # The first chunk rewrites the old file and sets up all tags.
+        # The rest are written by offset, so up to `stream_write_inflight`
+        # of them are on the wire while the next one is read from `fp`.
+        pending = collections.deque()
+        offset = 0
+        while True:
+            try:
+                buf = fp.read(self.buffer_size)
             except IOError as err:
                 logger.error("unable to read from a given socket %s", err)
                 break
+            if not buf:
+                break
+
+            if offset == 0 and indexed:
+                self.s_write_file(path, buf)
+            elif offset == 0:
+                self.s_write_plain(path, buf)
+            else:
+                self.s_wait_writes(path, pending,
+                                   keep=self.stream_write_inflight - 1)
+                pending.append((offset, len(buf),
+                                self.s_write_at(path, buf, offset)))
+            offset += len(buf)
+
+        # commit: every chunk must be written before we return
+        self.s_wait_writes(path, pending)
         # should I clean not completely written file
         # in case of error?
 
+    def s_read_stripe(self, fp, strict=False):
+        """Read up to `stripe_size` bytes from `fp`.
+        A request body returns the whole stripe at once as a rule,
+        which is passed on as is: joining a single chunk copies nothing.
+        IOError is raised if `strict`, otherwise it ends the body.
+        """
+        chunks = []
+        left = self.stripe_size
+        while left:
+            try:
+                buf = fp.read(left)
+            except IOError as err:
+                logger.error("unable to read from a given socket %s", err)
+                if strict:
+                    raise
+                break
+            if not buf:
+                break
+            chunks.append(buf)
+            left -= len(buf)
+        return ''.join(chunks)
+
+    def s_write_striped(self, path, fp, indexed=True, upload=None):
+        """Write objects larger than `stripe_size` as stripe keys,
+        up to `stream_write_inflight` of them at a time, and a manifest
+        under `path` once all of them are written.
+        Stripes are written under a new generation, the manifest switches
+        the object to them, so the stored object stays whole until then.
+        Smaller objects are written as usual.
+        With `upload` (the path being uploaded) written stripes are
+        checkpointed along with the rolling sha256 of the content up to
+        them. A read error of `fp` is raised then, and a retry continues
+        the generation skipping the stripes with the same rolling sha256.
+        Returns the stripe keys.
+        """
+        strict = upload is not None
+        stripe = self.s_read_stripe(fp, strict)
+        following = ''
+        if len(stripe) == self.stripe_size:
+            following = self.s_read_stripe(fp, strict)
+        state = upload and self.s_load_checkpoint(upload)
+        if not following:
+            if indexed:
+                self.s_write_file(path, stripe)
+            elif stripe:
+                self.s_write_plain(path, stripe)
+            if state:
+                self.s_finish_upload(upload, path, 0, state)
+            return []
+
+        # rolling sha256 of stripes stored by an interrupted upload
+        stored = []
+        generation = new_generation()
+        if state and state['key'] == path:
+            previous = self.s_stat(path)
+            # unless its manifest has been written: the stripes are live
+            if (previous is None or
+                    previous.generation != state['generation']):
+                stored = state['digests']
+                generation = state['generation']
+        # rolling sha256 of stripes written: checkpointed ones
+        # and ones in flight by offset
+        committed = []
+        written = {}
+        rolling = hashlib.sha256()
+
+        def checkpoint(offset, size):
+            committed.append(written.pop(offset))
+            self.s_save_checkpoint(upload, path, generation, committed)
+
+        done = checkpoint if upload else None
+        digest = None
+        pending = collections.deque()
+        number = size = skipped = 0
+        try:
+            while stripe:
+                if upload:
+                    rolling.update(stripe)
+                    digest = rolling.hexdigest()
+                if number < len(stored) and stored[number] == digest:
+                    # the same content has been written up to here
+                    committed.append(digest)
+                    skipped += len(stripe)
+                else:
+                    stored = []
+                    self.s_wait_writes(path, pending, done=done,
+                                       keep=self.stream_write_inflight - 1)
+                    if upload:
+                        written[size] = digest
+                    pending.append((size, len(stripe), self.s_write_at(
+                        stripe_key(path, number, generation), stripe, 0)))
+                number += 1
+                size += len(stripe)
+                stripe, following = following, (
+                    following and self.s_read_stripe(fp, strict))
+            self.s_wait_writes(path, pending, done=done)
+        except IOError:
+            # checkpoint what is on the wire for a retry
+            self.s_wait_writes(path, pending, done=done)
+            raise
+        except exceptions.UnspecifiedError:
+            if not upload:
+                # nothing refers to the stripes of the new generation
+                self.s_remove_many([stripe_key(path, n, generation)
+                                    for n in xrange(number)])
+            raise
+        keys = [stripe_key(path, n, generation) for n in xrange(number)]
+        manifest = make_manifest(size, self.stripe_size, generation)
+        if indexed:
+            self.s_write_files([(path, manifest)], striped=True)
+        else:
+            self.s_write_plain(path, manifest)
+        if skipped:
+            self.upload_bytes_resumed += skipped
+            logger.info("upload of %s has been resumed, %d bytes skipped",
+                        upload, skipped)
+        if upload:
+            self.s_finish_upload(upload, path, number, state, generation)
+        return keys
+
+    def s_upload(self, path):
+        """Path to checkpoint an upload of `path` under or None."""
+        return path if self.resumable_uploads else None
+
+    def s_load_checkpoint(self, path):
+        """Return the checkpoint of an interrupted upload of `path`:
+        `key` stripes are written to, their `generation`, `digests`
+        of stripes written (none if they are of another stripe size)
+        and a number of stripes it might have `written`.
+        None if there is no such upload.
+        """
+        try:
+            state = json.loads(self.s_read(upload_key(path)))
+        except (exceptions.FileNotFoundError, ValueError):
+            return None
+        if state['stripe_size'] != self.stripe_size:
+            state['digests'] = []
+        state.setdefault('generation', '')
+        return state
+
+    def s_save_checkpoint(self, path, key, generation, digests):
+        state = {'key': key,
+                 'generation': generation,
+                 'stripe_size': self.stripe_size,
+                 'digests': digests,
+                 # stripes in flight might have been written as well
+                 'written': len(digests) + self.stream_write_inflight,
+                 'mtime': time.time()}
+        sidecar = upload_key(path)
+        self.s_write_plain(sidecar, json.dumps(state))
+        if len(digests) == 1:
+            # clean_uploads() finds interrupted uploads by it
+            r = self.s_wait(self._session.update_indexes(
+                sidecar, [UPLOADS_INDEX], [path]))
+            self.metrics.record('s_write_indexes', r)
+
+    def s_finish_upload(self, path, key, stripes, state=None,
+                        generation=''):
+        """Remove the checkpoint of an upload of `path` and stripes
+        an interrupted upload has written beyond the `stripes`
+        of `generation` of `key`.
+        """
+        keys = [upload_key(path)]
+        if state is not None:
+            keep = 0
+            if state['key'] == key and state['generation'] == generation:
+                keep = stripes
+            keys.extend(stripe_key(state['key'], n, state['generation'])
+                        for n in xrange(keep, state['written']))
+        failed = self.s_remove_many(keys)
+        # most of the stripes have never been written
+        failed = dict((k, err) for k, err in failed.items()
+                      if err.code != -errno.ENOENT)
+        if failed:
+            logger.warning("Unable to clean up the upload of %s: %s",
+                           path, sorted(failed))
+
+    def clean_uploads(self, ttl=None):
+        """Remove what uploads interrupted more than `ttl` seconds
+        (`upload_ttl` by default) ago have written.
+        Returns the paths of the uploads removed.
+        """
+        ttl = self.upload_ttl if ttl is None else ttl
+        removed = []
+        for path in self.s_find([UPLOADS_INDEX]):
+            state = self.s_load_checkpoint(path)
+            if state is not None and time.time() - state['mtime'] < ttl:
+                continue
+            stripes = 0
+            generation = ''
+            if state is not None:
+                # the object stored under the key keeps its stripes
+                stat = self.s_stat(state['key'])
+                if stat is not None and stat.target is None:
+                    stripes = len(stripe_keys(state['key'], stat))
+                    generation = stat.generation
+            self.s_finish_upload(path, state and state['key'], stripes,
+                                 state, generation)
+            removed.append(path)
+        if removed:
+            logger.info("interrupted uploads of %s have been removed",
+                        removed)
+        return removed
+
     def stream_read(self, path, bytes_range=None):
         logger.debug("read range %s from %s", str(bytes_range), path)
-        if not self.exists(path):
+        cached = self.s_disk_cached(path)
+        if cached is not None:
+            chunks = self.s_read_file(cached, bytes_range)
+        else:
+            chunks = self.s_read_chunks(path, bytes_range)
+            if bytes_range is None and path.startswith(IMMUTABLE_PREFIX):
+                chunks = self.disk_cache.fill(path, chunks)
+        for chunk in chunks:
+            yield chunk
+
+    def s_read_file(self, f, bytes_range=None):
+        """Yield `buffer_size` chunks of a local file."""
+        with f:
+            offset, end = 0, os.fstat(f.fileno()).st_size
+            if bytes_range is not None:
+                offset = bytes_range[0]
+                end = min(end, bytes_range[1] + 1)
+            f.seek(offset)
+            while offset < end:
+                chunk = f.read(min(self.buffer_size, end - offset))
+                if not chunk:
+                    break
+                offset += len(chunk)
+                yield chunk
+
+    def s_slices(self, content, bytes_range=None):
+        """Yield `buffer_size` chunks of `content` in memory."""
+        offset, end = 0, len(content)
+        if bytes_range is not None:
+            offset = bytes_range[0]
+            end = min(end, bytes_range[1] + 1)
+        while offset < end:
+            yield content[offset:min(offset + self.buffer_size, end)]
+            offset += self.buffer_size
+
+    def s_pieces(self, path, stripe_size, offset, end, chunk,
+                 generation=''):
+        """Yield `(key, offset, size)` reads of at most `chunk` bytes
+        covering `offset:end` of `path`, none of them crosses a stripe.
+        """
+        while offset < end:
+            if not stripe_size:
+                size = min(chunk, end - offset)
+                yield path, offset, size
+            else:
+                number, key_offset = divmod(offset, stripe_size)
+                size = min(chunk, end - offset, stripe_size - key_offset)
+                yield stripe_key(path, number, generation), key_offset, size
+            offset += size
+
+    def s_read_chunks(self, path, bytes_range=None):
+        # lookup tells both existance and size, the first group to answer
+        # may hold a stale replica which would truncate the stream.
+        # Fastest reads trade that for not waiting for the slowest group
+        stat = self.s_stat(path, latest=not self.s_read_fastest(path))
+        if stat is None:
             raise exceptions.FileNotFoundError(
                 'No such directory: \'{0}\''.format(path))
 
-        if bytes_range is None:
-            yield self.s_read(path)
-        else:
+        if (not stat.stripe_size and stat.target is None and
+                self.s_compressible(path)):
+            # metadata which may be compressed is small, it is read whole
+            # and served decompressed
+            content = decompress(self.s_read(path))
+            for chunk in self.s_slices(content, bytes_range):
+                yield chunk
+            return
+
+        offset, end = 0, stat.size
+        if bytes_range is not None:
             offset = bytes_range[0]
-            size = bytes_range[1] - bytes_range[0] + 1
-            yield self.s_read(path, offset=offset, size=size)
+            end = min(stat.size, bytes_range[1] + 1)
+
+        # `buffer_size` chunks (stripes of striped objects) are read
+        # one by one, `stream_read_ahead` next ones are being fetched
+        # meanwhile
+        pending = collections.deque()
+        for key, key_offset, size in self.s_pieces(
+                stat.target or path, stat.stripe_size, offset, end,
+                stat.stripe_size or self.buffer_size, stat.generation):
+            pending.append((key, self.s_read_async(key, key_offset, size)))
+            if len(pending) > self.stream_read_ahead:
+                yield self.s_read_wait(*pending.popleft())
+
+        while pending:
+            yield self.s_read_wait(*pending.popleft())
 
     def list_directory(self, path=None):
         if path is None:  # pragma: no cover
             path = ""
 
-        if not self.exists(path) and path:
-            raise exceptions.FileNotFoundError(
-                'No such directory: \'{0}\''.format(path))
+        listing = self._listings.get(path)
+        if listing is not None:
+            for item in sorted(listing):
+                yield item
+            return
 
-        for item in self.s_find(('docker', path)):
+        r = self._waiter.iterate(
+            self._session.find_all_indexes(self.s_dir_tags(path)))
+        items = []
+        for entry in r:
+            item = str(entry.indexes[0].data)
+            items.append(item)
             yield item
+        self.metrics.record('s_find', r)
+
+        # an empty listing is either an empty directory or no directory
+        if not items and path and not self.exists(path):
+            raise exceptions.FileNotFoundError(
+                'No such directory: \'{0}\''.format(path))
+        if r.error().code == 0:
+            self._listings.set(path, frozenset(items))
 
     def exists(self, path):
         logger.debug("Check existance of %s", path)
-        try:
-            # read is used instead of lookup
-            # just for future quorum reading check
-            self.s_read(path, 0, 1)
-        except exceptions.FileNotFoundError:
-            logger.debug("%s doesn't exist", path)
-            return False
-        else:
-            logger.debug("%s exists", path)
-            return True
+        found = self._exists_cache.get(path)
+        if found is None:
+            # stats are cached for longer than answers are kept for,
+            # so they are not looked at. Nor is the size read
+            found = self.s_lookup(path) is not None
+            self._exists_cache.set(path, found)
+        logger.debug("%s %s", path, "exists" if found else "doesn't exist")
+        return found
 
     @lru.remove
     def remove(self, path):
-        try:
-            for subdir in self.list_directory(path):
-                self.s_remove(subdir)
-        except exceptions.FileNotFoundError as err:
-            logger.warning(err)
-        self.s_remove(path)
+        keys = self.s_walk(path)
+        # removals of the deepest keys are issued first
+        keys.reverse()
+        # lru.remove drops `path` alone
+        self.s_lru_remove_many(keys)
+        referrers = []
+        stripes = []
+        for key, stat in self.s_indirect(keys + [path]):
+            if stat.target is not None:
+                digest = self.s_digest(key)
+                if digest is not None:
+                    referrers.append((key, digest, stat.target))
+            else:
+                stripes.extend(stripe_keys(key, stat))
+        # referrers are unmarked first, so s_referred does not take
+        # the ones being removed for uploads in flight
+        for r in [self._session.remove_indexes(key, [refs_index(digest)])
+                  for key, digest, _ in referrers]:
+            self.s_wait(r)
+        keys = stripes + keys
+        failed = self.s_remove_many(keys + [path])
+        # blobs are removed once the last key referring to them is
+        for digest, blob in set((digest, blob)
+                                for _, digest, blob in referrers):
+            self.s_release(digest, blob)
+        # children may have been removed by a concurrent remove()
+        failed = dict((key, err) for key, err in failed.items()
+                      if key == path or err.code != -errno.ENOENT)
+        if failed.keys() == [path]:
+            raise exceptions.FileNotFoundError("No such file %s" % path)
+        if failed:
+            raise exceptions.UnspecifiedError(
+                "Unable to remove %d of %d keys of %s: %s" % (
+                    len(failed), len(keys) + 1, path,
+                    ", ".join("%s (%s)" % (key, err.message)
+                              for key, err in sorted(failed.items()))))
+
+    def s_indirect(self, keys):
+        """Return `(key, Stat)` of `keys` kept in other keys.
+        Those are looked up among keys marked with striped indexes.
+        """
+        keys = set(keys)
+        session = self._session
+
+        def start(dirname):
+            return [session.find_all_indexes([striped_index(dirname)])]
+
+        found = []
+        for _, (r,) in self.s_bounded(
+                start, set(os.path.dirname(key) for key in keys),
+                self.lookup_concurrency):
+            self.metrics.record('s_find', r)
+            for i in r.get():
+                key = str(i.indexes[0].data)
+                stat = self.s_stat(key) if key in keys else None
+                if stat is not None and (stat.stripe_size or stat.target):
+                    found.append((key, stat))
+        return found
+
+    def rebuild_global_index(self, path='', old_shards=None):
+        """Mark keys under `path` with the global index of the current
+        mode and remove them from the indexes of the others.
+        Keys are found by directory indexes alone, so keys missing from
+        the global index are found as well. `old_shards` is the number
+        of shards keys were written with if it has been changed.
+        Returns the number of keys updated.
+        """
+        keys = self.s_walk(path, dir_tags=lambda dirname: [dirname])
+        if path:
+            keys.append(path)
+        stale = set([GLOBAL_INDEX])
+        for shards in set([old_shards or self.global_index_shards,
+                           self.global_index_shards]):
+            stale.update("%s#%d" % (GLOBAL_INDEX, n) for n in xrange(shards))
+        session = self._session
+
+        def start(key):
+            tags = list(self.s_global_tags(key))
+            results = [session.remove_indexes(
+                key, sorted(stale.difference(tags)))]
+            if tags:
+                results.append(session.update_indexes(key, tags,
+                                                      [key] * len(tags)))
+            return results
+
+        failed = []
+        for key, results in self.s_bounded(start, keys,
+                                           self.remove_concurrency):
+            for r in results:
+                self.metrics.record('s_reindex', r)
+                err = r.error()
+                if err.code != 0:
+                    logger.warning("Unable to reindex key %s %s",
+                                   key, err.message)
+                    failed.append(key)
+        if failed:
+            raise exceptions.UnspecifiedError(
+                "Unable to reindex %d of %d keys of %s"
+                % (len(set(failed)), len(keys), path))
+        return len(keys)
+
+    def _make_stat(self, path, lookup, subdirs=(), striped=None,
+                   content=None):
+        """Return Stat of `path` by its `lookup` result. Keys of the size
+        of a manifest or a reference are read unless `striped`, the keys
+        marked with the striped index of their directory, is given and
+        misses `path`. `content` is the data of `path` if it has been
+        read along with the lookup.
+        """
+        def read():
+            return self.s_read(path) if content is None else content
+
+        probed = striped is None or path in striped
+        is_dir = False
+        if path in self._known_dirs or path in subdirs:
+            is_dir = True
+        elif lookup.size == len(FAKE_DIR_CONTENT):
+            is_dir = None
+        stat = Stat(lookup.size, lookup.timestamp.tsec, is_dir)
+        size = None
+        if (lookup.size > COMPRESSED_HEADER_SIZE and
+                self.s_compressible(path)):
+            # the size of the content of a compressed object
+            try:
+                size = compressed_size(
+                    self.s_read(path, 0, COMPRESSED_HEADER_SIZE))
+            except exceptions.FileNotFoundError:
+                pass
+        if size is not None:
+            stat = stat._replace(size=size)
+        elif lookup.size == MANIFEST_SIZE and probed:
+            # a file of the same size as a manifest of a striped object
+            try:
+                manifest = parse_manifest(read())
+            except exceptions.FileNotFoundError:
+                manifest = None
+            if manifest is not None:
+                size, stripe_size, generation = manifest
+                stat = Stat(size, lookup.timestamp.tsec, False, stripe_size,
+                            generation=generation)
+        elif lookup.size == REFERENCE_SIZE and probed:
+            # a file of the same size as a reference to deduplicated content
+            try:
+                reference = parse_reference(read())
+            except exceptions.FileNotFoundError:
+                reference = None
+            blob = reference and self.s_stat(reference[2])
+            if blob is not None:
+                stat = Stat(reference[0], lookup.timestamp.tsec, False,
+                            blob.stripe_size, reference[2], blob.generation)
+        self._stats.set(path, stat)
+        return stat
+
+    def s_stat(self, path, latest=False):
+        """Return Stat of `path` or None if there is no such key.
+        Stats are cached for `elliptics_stat_cache_ttl` seconds,
+        with `latest` the cache is bypassed and the newest replica
+        is looked up.
+        """
+        stat = None if latest else self._stats.get(path)
+        if stat is None:
+            result = self.s_lookup(path, latest)
+            if result is None:
+                return None
+            stat = self._make_stat(path, result)
+        return stat
+
+    def s_subdirs(self, path):
+        """Return a set of fake subdirectories of `path`."""
+        subdirs = self._subdirs.get(path)
+        if subdirs is None:
+            subdirs = set(self.s_find((fake_dir_index(path),)))
+            self._subdirs.set(path, subdirs)
+        return subdirs
+
+    def stat(self, path):
+        """Return Stat of `path` with known `is_dir`."""
+        stat = self.s_stat(path)
+        if stat is None:
+            raise exceptions.FileNotFoundError("No such file %s" % path)
+        if stat.is_dir is None:
+            # a file of the same size as a directory
+            is_dir = path in self.s_subdirs(os.path.dirname(path))
+            if not is_dir:
+                # directories created before they got marked
+                is_dir = self.s_read(path) == FAKE_DIR_CONTENT
+            stat = stat._replace(is_dir=is_dir)
+            self._stats.set(path, stat)
+        return stat
+
+    def stat_directory(self, path):
+        """List fake directory `path` and return `(key, Stat)` of its
+        children. Children missing in the stat cache are looked up
+        concurrently, `lookup_concurrency` at a time. Only children
+        marked with the striped index are read, along with their lookup.
+        """
+        session = self._session
+        r = session.find_all_indexes(self.s_dir_tags(path))
+        r_dirs = session.find_all_indexes([fake_dir_index(path)])
+        r_striped = session.find_all_indexes([striped_index(path)])
+        r, r_dirs, r_striped = [self.s_wait(result)
+                                for result in (r, r_dirs, r_striped)]
+        for result in (r, r_dirs, r_striped):
+            self.metrics.record('s_find', result)
+        children = [str(i.indexes[0].data) for i in r.get()]
+        subdirs = set(str(i.indexes[0].data) for i in r_dirs.get())
+        striped = set(str(i.indexes[0].data) for i in r_striped.get())
+        self._subdirs.set(path, subdirs)
+        if not children and path and not self.exists(path):
+            raise exceptions.FileNotFoundError(
+                'No such directory: \'{0}\''.format(path))
+
+        stats = {}
+        for key in children:
+            stat = self._stats.get(key)
+            if stat is not None and stat.is_dir is None and key in subdirs:
+                stat = stat._replace(is_dir=True)
+                self._stats.set(key, stat)
+            stats[key] = stat
+        missing = [key for key, stat in stats.items() if stat is None]
+        session = self._clone_session(elliptics.checkers.at_least_one)
+
+        def start(key):
+            if key in striped:
+                return [session.lookup(key), session.read_latest(key)]
+            return [session.lookup(key)]
+
+        for key, results in self.s_bounded(start, missing,
+                                           self.lookup_concurrency):
+            r = results[0]
+            self.metrics.record('s_lookup', r)
+            found = [e for e in r.get() if e.error.code == 0]
+            content = None
+            if len(results) > 1 and results[1].error().code == 0:
+                content = as_str(results[1].get()[0].data)
+                self.metrics.record('s_read', results[1], len(content))
+            if found:
+                stats[key] = self._make_stat(key, found[0], subdirs,
+                                             striped, content)
+            else:
+                # removed in the meantime
+                del stats[key]
+        return sorted(stats.items())
 
     def get_size(self, path):
         logger.debug("get_size of %s", path)
-        r = self._session.lookup(path)
-        r.wait()
-        lookups = r.get()
-        err = r.error()
-        if err.code != 0:
+        if path.startswith(IMMUTABLE_PREFIX):
+            size = self.disk_cache.size_of(path)
+            if size is not None:
+                return size
+        stat = self.s_stat(path)
+        if stat is None:
             raise exceptions.FileNotFoundError(
-                "Unable to get size of %s %s" % (path, err))
-        size = lookups[0].size
-        logger.debug("size of %s = %d", path, size)
-        return size
+                "Unable to get size of %s" % path)
+        logger.debug("size of %s = %d", path, stat.size)
+        return stat.size
@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 from __future__ import with_statement
 
-import elliptics
+import errno
 import logging
 import os
 import stat
@@ -13,6 +13,8 @@ from fuse import LoggingMixIn
 from fuse import Operations
 import yaml
 
+from docker_registry.core import exceptions
+from docker_registry.drivers.elliptics import LRUCache
 from docker_registry.drivers.elliptics import Storage
 from docker_registry.lib import config
 
@@ -20,8 +22,79 @@ logging.basicConfig()
 log = logging.getLogger("")
 log.setLevel(logging.DEBUG)
 
-DIRECTORY_CONTENT = "DIRECTORY"
-MAGIC_NUMBER = len(DIRECTORY_CONTENT)
+BLOCK_SIZE = 128 * 1024
+# 64 Mb
+CACHED_BLOCKS = 512
+READ_AHEAD_BLOCKS = 8
+LISTINGS = 1024
+# seconds
+LISTING_TTL = 10
+
+
+class BlockCache(object):
+    """LRU cache of file blocks read with ranged reads.
+    Blocks following a sequential read are fetched in advance.
+    """
+
+    def __init__(self, storage, block_size=BLOCK_SIZE,
+                 blocks=CACHED_BLOCKS, read_ahead=READ_AHEAD_BLOCKS):
+        self.storage = storage
+        self.block_size = block_size
+        self.read_ahead = read_ahead
+        # (path, mtime, block number) -> data or (key, async result)
+        # of read-ahead
+        self._blocks = LRUCache(blocks)
+        # path -> end of the last read
+        self._last_read = LRUCache(blocks)
+
+    def _fetch(self, path, info, number):
+        offset = number * self.block_size
+        end = min(offset + self.block_size, info.size)
+        # stripes are a multiple of the block size,
+        # so a block is a single piece
+        (key, key_offset, length), = self.storage.s_pieces(
+            info.target or path, info.stripe_size, offset, end,
+            self.block_size, info.generation)
+        r = self.storage.s_read_async(key, key_offset, length)
+        self._blocks.set((path, info.mtime, number), (key, r))
+        return key, r
+
+    def _block(self, path, info, number):
+        block = self._blocks.get((path, info.mtime, number))
+        if block is None:
+            block = self._fetch(path, info, number)
+        if not isinstance(block, str):
+            block = self.storage.s_read_wait(*block)
+            self._blocks.set((path, info.mtime, number), block)
+        return block
+
+    def read(self, path, length, offset):
+        info = self.storage.stat(path)
+        end = min(offset + length, info.size)
+        if offset >= end:
+            return ""
+        if self.storage.s_compressible(path):
+            # small metadata which may be stored compressed
+            return "".join(self.storage.stream_read(path, (offset, end - 1)))
+
+        first = offset // self.block_size
+        last = (end - 1) // self.block_size
+        stop = last + 1
+        if self._last_read.get(path) == offset:
+            # sequential read
+            stop = min(stop + self.read_ahead,
+                       (info.size - 1) // self.block_size + 1)
+        self._last_read.set(path, end)
+        # all the missing blocks are read concurrently
+        for number in xrange(first, stop):
+            if (path, info.mtime, number) not in self._blocks:
+                self._fetch(path, info, number)
+
+        data = "".join(self._block(path, info, number)
+                       for number in xrange(first, last + 1))
+        start = offset - first * self.block_size
+        return data[start:start + end - offset]
+
 
 class RegistryFS(LoggingMixIn, Operations):
     def __init__(self):
@@ -31,6 +104,9 @@ class RegistryFS(LoggingMixIn, Operations):
         except Exception as err:
             log.error(err)
             raise FuseOSError(-100)
+        self.blocks = BlockCache(self.storage)
+        # path -> names of its entries
+        self.listings = LRUCache(LISTINGS, LISTING_TTL)
 
     def transform_path(self, path):
         # strip a starting slash
@@ -39,13 +115,22 @@ class RegistryFS(LoggingMixIn, Operations):
 
     def readdir(self, path, fh):
         path = self.transform_path(path)
-
-        def apply(item, path):
-            if item.startswith(path):
-                item = item[len(path):]
-            return item.lstrip("/")
-
-        return (apply(i, path) for i in self.storage.list_directory(path) if i)
+        names = self.listings.get(path)
+        if names is None:
+            def apply(item, path):
+                if item.startswith(path):
+                    item = item[len(path):]
+                return item.lstrip("/")
+
+            # stats of the entries are cached by the storage,
+            # so getattr of them does not go to Elliptics
+            try:
+                entries = self.storage.stat_directory(path)
+            except exceptions.FileNotFoundError:
+                raise FuseOSError(errno.ENOENT)
+            names = [apply(key, path) for key, _ in entries if key]
+            self.listings.set(path, names)
+        return names
 
     def getattr(self, path, fh=None):
         if path == "/":
@@ -54,26 +139,18 @@ class RegistryFS(LoggingMixIn, Operations):
                         for key in dir(r) if key.startswith("st_"))
 
         path = self.transform_path(path)
-        session = self.storage._session.clone()
-        session.set_checker(elliptics.checkers.no_check)
-        for group in self.storage.groups:
-            print "lookup %s as group %d", path, group
-            gsession = session.clone()
-            gsession.set_groups([group])
-            ares = gsession.lookup(path)
-            ares.wait()
-            lookup_res = ares.get()
-            if lookup_res: break
-        # ugly hack
-        for i in lookup_res:
-            res = {'st_atime': i.timestamp.tsec,
-                   'st_ctime': i.timestamp.tsec,
-                   'st_mode': 0o777,  # ugly hack
-                   'st_mtime': i.timestamp.tsec,
-                   'st_nlink': 1,
-                   'st_size': i.size}
-        if res['st_size'] == MAGIC_NUMBER and\
-           self.storage.get_content(path) == DIRECTORY_CONTENT:
+        try:
+            info = self.storage.stat(path)
+        except exceptions.FileNotFoundError:
+            raise FuseOSError(errno.ENOENT)
+
+        res = {'st_atime': info.mtime,
+               'st_ctime': info.mtime,
+               'st_mode': 0o777,  # ugly hack
+               'st_mtime': info.mtime,
+               'st_nlink': 1,
+               'st_size': info.size}
+        if info.is_dir:
             res['st_mode'] |= stat.S_IFDIR
         else:
             res['st_mode'] |= stat.S_IFREG
@@ -82,7 +159,10 @@ class RegistryFS(LoggingMixIn, Operations):
 
     def read(self, path, length, offset, fh):
         path = self.transform_path(path)
-        return self.storage.get_content(path)
+        try:
+            return self.blocks.read(path, length, offset)
+        except exceptions.FileNotFoundError:
+            raise FuseOSError(errno.ENOENT)
 
 
 def main(mountpoint):
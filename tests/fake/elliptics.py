@@ -0,0 +1,673 @@
+# -*- coding: utf-8 -*-
+"""
+tests.fake.elliptics
+~~~~~~~~~~~~~~~~~~~~
+
+In-process stand-in for the Elliptics python bindings.
+
+Only the part of the API used by docker_registry.drivers.elliptics
+is implemented. All the data lives in the module level `backend`,
+which tests can inspect and tune: per group latency, bandwidth,
+jitter and failures. Operations with a non zero latency complete
+in a background thread, so the driver sees real asynchronous results.
+
+Put the directory of this file into sys.path (but not as the first
+item) and `import_non_local('elliptics')` will pick it up.
+"""
+
+import itertools
+import random
+import threading
+import time
+
+try:
+    from gevent.monkey import get_original
+except ImportError:  # pragma: no cover
+    get_original = None
+
+# connecting blocks the OS thread, as the real bindings do,
+# even if `time` is monkey patched by gevent
+block = get_original('time', 'sleep') if get_original else time.sleep
+
+
+class log_level(object):
+    error = 0
+    info = 1
+    notice = 2
+    debug = 3
+    data = 4
+
+    names = {'error': error,
+             'info': info,
+             'notice': notice,
+             'debug': debug,
+             'data': data}
+
+
+class config_flags(object):
+    no_route_list = 1 << 0
+    mix_stats = 1 << 1
+    no_csum = 1 << 2
+
+
+class io_flags(object):
+    default = 0
+    append = 1 << 0
+    prepare = 1 << 4
+    commit = 1 << 5
+    plain_write = 1 << 7
+
+
+class checkers(object):
+    no_check = 0
+    at_least_one = 1
+    all = 2
+    quorum = 3
+
+
+class exceptions_policy(object):
+    no_exceptions = 0
+    throw_at_start = 1
+    throw_at_wait = 2
+    throw_at_get = 4
+    throw_at_iterator_end = 8
+    default_exceptions = throw_at_wait | throw_at_get | throw_at_iterator_end
+
+
+ENOENT = -2
+EIO = -5
+ENXIO = -6
+E2BIG = -7
+ETIMEDOUT = -110
+
+
+class Error(Exception):
+    def __init__(self, code=0, message=""):
+        super(Error, self).__init__(message)
+        self.code = code
+        self.message = message
+
+    def __str__(self):
+        return "%s: %d" % (self.message, self.code)
+
+
+class NotFoundError(Error):
+    pass
+
+
+class TimeoutError(Error):
+    pass
+
+
+class Time(object):
+    def __init__(self, tsec=0, tnsec=0):
+        self.tsec = tsec
+        self.tnsec = tnsec
+
+    @classmethod
+    def now(cls):
+        now = time.time()
+        return cls(int(now), int((now - int(now)) * 10 ** 9))
+
+
+class _Options(object):
+    pass
+
+
+class Config(object):
+    def __init__(self):
+        self.config = _Options()
+
+
+class Logger(object):
+    def __init__(self, path, level):
+        self.path = path
+        self.level = level
+
+
+class Record(object):
+    def __init__(self, data, version):
+        self.data = data
+        # strictly increasing, so read_latest is deterministic
+        self.version = version
+        self.timestamp = Time.now()
+
+
+class Group(object):
+    def __init__(self, group_id):
+        self.group_id = group_id
+        # seconds per operation
+        self.latency = 0.0
+        # random extra latency in [0, jitter) per operation
+        self.jitter = 0.0
+        # bytes per second, None means unlimited
+        self.bandwidth = None
+        # probability of a failure per operation
+        self.failure_rate = 0.0
+        # seconds per update of a secondary index, plus seconds per entry
+        # the index already has. Updates of an index are serialized.
+        self.index_latency = 0.0
+        self.index_entry_cost = 0.0
+        # index -> time its last queued update completes
+        self.index_busy = {}
+        self.down = False
+        self.records = {}
+        # index -> {key: data}
+        self.indexes = {}
+        # key -> set of indexes
+        self.key_indexes = {}
+
+    def delay(self, nbytes=0):
+        delay = self.latency
+        if self.jitter:
+            delay += random.random() * self.jitter
+        if self.bandwidth:
+            delay += float(nbytes) / self.bandwidth
+        return delay
+
+    def index_delay(self, index, now):
+        """Queue an update of `index`, return seconds until it is done."""
+        cost = (self.index_latency +
+                self.index_entry_cost * len(self.indexes.get(index, ())))
+        if not cost:
+            return 0.0
+        done = max(now, self.index_busy.get(index, 0.0)) + cost
+        self.index_busy[index] = done
+        return done - now
+
+    def fails(self):
+        return self.down or (self.failure_rate and
+                             random.random() < self.failure_rate)
+
+
+class Backend(object):
+    """Shared state of the fake cluster."""
+
+    def __init__(self, groups=(1, 2, 3)):
+        self.lock = threading.RLock()
+        self.groups = dict((g, Group(g)) for g in groups)
+        # remotes add_remotes() fails to connect to
+        self.unreachable = set()
+        # remote -> seconds add_remotes() takes to connect to it
+        self.connect_latency = {}
+        # keys every operation fails on
+        self.broken_keys = set()
+        # names of operations which fail on every key
+        self.broken_ops = set()
+        self.ops = {}
+        self.inflight = 0
+        self.max_inflight = 0
+        self.inflight_bytes = 0
+        self.max_inflight_bytes = 0
+        self._versions = itertools.count(1)
+
+    def group(self, group_id):
+        return self.groups.get(group_id)
+
+    def configure(self, groups=None, **kwargs):
+        """Set Group attributes (latency, bandwidth...) of `groups`."""
+        for group_id in groups or self.groups:
+            for name, value in kwargs.items():
+                setattr(self.groups[group_id], name, value)
+
+    def count(self, name):
+        return self.ops.get(name, 0)
+
+    def _started(self, name, nbytes):
+        with self.lock:
+            self.ops[name] = self.ops.get(name, 0) + 1
+            self.inflight += 1
+            self.inflight_bytes += nbytes
+            self.max_inflight = max(self.max_inflight, self.inflight)
+            self.max_inflight_bytes = max(self.max_inflight_bytes,
+                                          self.inflight_bytes)
+
+    def _finished(self, nbytes):
+        with self.lock:
+            self.inflight -= 1
+            self.inflight_bytes -= nbytes
+
+    def next_version(self):
+        return next(self._versions)
+
+
+backend = Backend()
+
+
+def reset(groups=(1, 2, 3)):
+    """Replace the module level backend with an empty one."""
+    global backend
+    backend = Backend(groups)
+    return backend
+
+
+class Result(object):
+    def __init__(self, group_id, **kwargs):
+        self.group_id = group_id
+        self.error = Error()
+        self.__dict__.update(kwargs)
+
+
+class IndexEntry(object):
+    def __init__(self, index, data):
+        self.index = index
+        self.data = data
+
+
+class AsyncResult(object):
+    def __init__(self, session, name, func, delay=0.0, nbytes=0):
+        self._session = session
+        self._func = func
+        self._nbytes = nbytes
+        self._results = []
+        self._error = Error()
+        self._event = threading.Event()
+        self._handlers = []
+        self._lock = threading.Lock()
+        self._started = time.time()
+        self._elapsed = 0.0
+        self._backend = session._backend
+        self._backend._started(name, nbytes)
+        if delay > 0:
+            timer = threading.Timer(delay, self._complete)
+            timer.daemon = True
+            timer.start()
+        else:
+            self._complete()
+
+    def _complete(self):
+        try:
+            results, error = self._func()
+        except Exception as err:
+            results, error = [], Error(EIO, str(err))
+        self._backend._finished(self._nbytes)
+        self._elapsed = time.time() - self._started
+        with self._lock:
+            handlers, self._handlers = self._handlers, []
+            # as with the bindings, entries handed to connected handlers
+            # are not kept for get()
+            self._results = [] if handlers else results
+            self._error = error
+            self._event.set()
+        for handler in handlers:
+            self._notify(results, *handler)
+
+    def _notify(self, results, result_handler, final_handler):
+        if final_handler is None:
+            result_handler(list(results), self._error)
+            return
+        for result in results:
+            result_handler(result)
+        final_handler(self._error)
+
+    def _raise(self, policy):
+        if self._session.exceptions_policy & policy and self._error.code:
+            if self._error.code == ENOENT:
+                raise NotFoundError(self._error.code, self._error.message)
+            raise Error(self._error.code, self._error.message)
+
+    def connect(self, result_handler, final_handler=None):
+        """connect(final_handler(results, error)) or
+        connect(result_handler(result), final_handler(error))
+        """
+        with self._lock:
+            if not self._event.is_set():
+                self._handlers.append((result_handler, final_handler))
+                return
+        self._notify(self._results, result_handler, final_handler)
+
+    def wait(self):
+        self._event.wait()
+        self._raise(exceptions_policy.throw_at_wait)
+
+    def ready(self):
+        return self._event.is_set()
+
+    def successful(self):
+        return self.ready() and self._error.code == 0
+
+    def get(self):
+        self._event.wait()
+        self._raise(exceptions_policy.throw_at_get)
+        return list(self._results)
+
+    def error(self):
+        self._event.wait()
+        return self._error
+
+    def elapsed_time(self):
+        return Time(int(self._elapsed), int(self._elapsed % 1 * 10 ** 9))
+
+    def __iter__(self):
+        return iter(self.get())
+
+
+class Routes(object):
+    def __init__(self, addresses):
+        self._addresses = addresses
+
+    def addresses(self):
+        return list(self._addresses)
+
+    def __repr__(self):
+        return "<Routes %s>" % self._addresses
+
+
+class Node(object):
+    def __init__(self, log, cfg):
+        self.log = log
+        self.config = cfg
+        self.backend = backend
+        self.routes = []
+
+    def add_remotes(self, remotes):
+        # remotes are connected to in parallel
+        delay = max([self.backend.connect_latency.get(r, 0.0)
+                     for r in remotes] or [0.0])
+        if delay:
+            block(delay)
+        added = [r for r in remotes if r not in self.backend.unreachable]
+        if not added:
+            raise Error(ENXIO, "Failed to connect to any of %s" % remotes)
+        with self.backend.lock:
+            for remote in added:
+                if remote not in self.routes:
+                    self.routes.append(remote)
+
+
+def _checked(checker, total, succeeded):
+    if checker == checkers.no_check:
+        return True
+    if checker == checkers.at_least_one:
+        return succeeded >= 1
+    if checker == checkers.all:
+        return succeeded == total
+    return succeeded > total // 2
+
+
+class Session(object):
+    def __init__(self, node):
+        self._node = node
+        self._groups = []
+        self.namespace = ""
+        self.exceptions_policy = exceptions_policy.default_exceptions
+        self.checker = checkers.at_least_one
+        self.ioflags = io_flags.default
+
+    @property
+    def _backend(self):
+        return self._node.backend
+
+    def clone(self):
+        # a single copy, as the bindings copy the native session
+        session = Session.__new__(Session)
+        session.__dict__.update(self.__dict__)
+        session._groups = list(self._groups)
+        return session
+
+    @property
+    def groups(self):
+        return list(self._groups)
+
+    @groups.setter
+    def groups(self, groups):
+        self._groups = list(groups)
+
+    def set_groups(self, groups):
+        self.groups = groups
+
+    def set_namespace(self, namespace):
+        self.namespace = namespace
+
+    def set_checker(self, checker):
+        self.checker = checker
+
+    def set_exceptions_policy(self, policy):
+        self.exceptions_policy = policy
+
+    @property
+    def routes(self):
+        return Routes(self._node.routes)
+
+    # helpers
+
+    def _id(self, key):
+        return (self.namespace, key)
+
+    def _live_groups(self):
+        return [self._backend.group(g) for g in self._groups]
+
+    def _async(self, name, func, delay=0.0, nbytes=0):
+        return AsyncResult(self, name, func, delay, nbytes)
+
+    def _fanout(self, name, apply, nbytes=0, key=None, indexes=()):
+        """Apply `apply(group)` to every group of the session
+        and check the outcome with the session checker.
+        `indexes` are the secondary indexes the operation updates.
+        """
+        group_ids = list(self._groups)
+        groups = self._live_groups()
+        present = [g for g in groups if g is not None]
+        delay = max([g.delay(nbytes) for g in present] or [0])
+        if indexes:
+            with self._backend.lock:
+                now = time.time()
+                delay += max([g.index_delay(self._id(i), now)
+                              for g in present for i in indexes] or [0])
+        checker = self.checker
+
+        def run():
+            # failed groups are reported as entries with an error
+            results = []
+            succeeded = 0
+            error = Error()
+            with self._backend.lock:
+                for group_id, group in zip(group_ids, groups):
+                    if key in self._backend.broken_keys:
+                        res = Error(EIO, "key %s is broken" % key)
+                    elif name in self._backend.broken_ops:
+                        res = Error(EIO, "%s is broken" % name)
+                    elif group is None or group.fails():
+                        res = Error(ENXIO, "group is unavailable")
+                    else:
+                        res = apply(group)
+                    if isinstance(res, Error):
+                        error = res
+                        res = Result(group_id, error=res)
+                    else:
+                        succeeded += 1
+                    results.append(res)
+            if succeeded and _checked(checker, len(groups), succeeded):
+                return results, Error()
+            if not succeeded and not error.code:
+                error = Error(ENXIO, "no groups")
+            return results, error
+
+        return self._async(name, run, delay, nbytes)
+
+    def _first(self, name, apply, pick=None, nbytes=0, key=None):
+        """Apply `apply(group)` to groups in order until it succeeds.
+        `pick` chooses among the groups which have the key instead
+        (read_latest).
+        """
+        groups = [g for g in self._live_groups() if g is not None]
+        failing = None
+        if pick is None:
+            # groups are asked one by one, so their latencies add up
+            # until the one which does not fail
+            failing = set(g.group_id for g in groups if g.fails())
+            delay = 0.0
+            for group in groups:
+                delay += group.delay(nbytes)
+                if group.group_id not in failing:
+                    break
+        else:
+            delay = max([g.delay(nbytes) for g in groups] or [0])
+
+        def run():
+            error = Error(ENXIO, "no groups")
+            with self._backend.lock:
+                candidates = groups
+                if pick is not None:
+                    candidates = pick(groups)
+                for group in candidates:
+                    if key in self._backend.broken_keys:
+                        error = Error(EIO, "key %s is broken" % key)
+                        continue
+                    if (group.fails() if failing is None
+                            else group.group_id in failing):
+                        error = Error(ENXIO, "group is unavailable")
+                        continue
+                    res = apply(group)
+                    if isinstance(res, Error):
+                        error = res
+                        continue
+                    return [res], Error()
+            return [], error
+
+        return self._async(name, run, delay, nbytes)
+
+    # data
+
+    def write_data(self, key, data, offset=0):
+        key_id = self._id(key)
+        data = str(data)
+        append = self.ioflags & io_flags.append
+
+        def apply(group):
+            record = group.records.get(key_id)
+            old = record.data if record is not None else ""
+            if append:
+                new = old + data
+            elif offset == 0:
+                new = data
+            else:
+                if len(old) < offset:
+                    old += "\0" * (offset - len(old))
+                new = old[:offset] + data + old[offset + len(data):]
+            record = Record(new, self._backend.next_version())
+            group.records[key_id] = record
+            return Result(group.group_id, size=len(new),
+                          timestamp=record.timestamp)
+
+        return self._fanout('write_data', apply, len(data), key=key)
+
+    def _read(self, name, key, offset, size, latest):
+        key_id = self._id(key)
+
+        def apply(group):
+            record = group.records.get(key_id)
+            if record is None:
+                return Error(ENOENT, "No such key %s" % key)
+            if offset > len(record.data):
+                return Error(E2BIG, "offset is beyond the end of %s" % key)
+            end = offset + size if size else len(record.data)
+            return Result(group.group_id, data=record.data[offset:end],
+                          size=len(record.data), offset=offset,
+                          timestamp=record.timestamp)
+
+        def newest(groups):
+            def version(group):
+                record = group.records.get(key_id)
+                return record.version if record is not None else 0
+            return sorted(groups, key=version, reverse=True)
+
+        return self._first(name, apply, pick=newest if latest else None,
+                           nbytes=size, key=key)
+
+    def read_data(self, key, offset=0, size=0):
+        return self._read('read_data', key, offset, size, latest=False)
+
+    def read_latest(self, key, offset=0, size=0):
+        return self._read('read_latest', key, offset, size, latest=True)
+
+    def _lookup_apply(self, key):
+        key_id = self._id(key)
+
+        def apply(group):
+            record = group.records.get(key_id)
+            if record is None:
+                return Error(ENOENT, "No such key %s" % key)
+            return Result(group.group_id, size=len(record.data),
+                          timestamp=record.timestamp, offset=0,
+                          path="fake://%d" % group.group_id)
+        return apply
+
+    def lookup(self, key):
+        return self._first('lookup', self._lookup_apply(key), key=key)
+
+    def parallel_lookup(self, key):
+        return self._fanout('parallel_lookup', self._lookup_apply(key),
+                            key=key)
+
+    def remove(self, key):
+        key_id = self._id(key)
+
+        def apply(group):
+            if group.records.pop(key_id, None) is None:
+                return Error(ENOENT, "No such key %s" % key)
+            return Result(group.group_id)
+
+        return self._fanout('remove', apply, key=key)
+
+    # secondary indexes
+
+    def _index_apply(self, key, indexes, datas, replace):
+        def apply(group):
+            current = group.key_indexes.setdefault(key, set())
+            if replace:
+                for index in current:
+                    group.indexes.get(self._id(index), {}).pop(key, None)
+                current.clear()
+            for index, data in zip(indexes, datas):
+                group.indexes.setdefault(self._id(index), {})[key] = data
+                current.add(index)
+            return Result(group.group_id)
+        return apply
+
+    def set_indexes(self, key, indexes, datas):
+        return self._fanout('set_indexes',
+                            self._index_apply(key, indexes, datas, True),
+                            key=key, indexes=indexes)
+
+    def update_indexes(self, key, indexes, datas):
+        return self._fanout('update_indexes',
+                            self._index_apply(key, indexes, datas, False),
+                            key=key, indexes=indexes)
+
+    def remove_indexes(self, key, indexes):
+        def apply(group):
+            current = group.key_indexes.setdefault(key, set())
+            for index in indexes:
+                group.indexes.get(self._id(index), {}).pop(key, None)
+                current.discard(index)
+            return Result(group.group_id)
+
+        return self._fanout('remove_indexes', apply, key=key,
+                            indexes=indexes)
+
+    def find_all_indexes(self, indexes):
+        indexes = list(indexes)
+        groups = [g for g in self._live_groups() if g is not None]
+        delay = max([g.delay() for g in groups] or [0])
+
+        def run():
+            with self._backend.lock:
+                for group in groups:
+                    if group.fails():
+                        continue
+                    found = [group.indexes.get(self._id(i), {})
+                             for i in indexes]
+                    keys = set(found[0]) if found else set()
+                    for entries in found[1:]:
+                        keys &= set(entries)
+                    results = []
+                    for key in sorted(keys):
+                        entries = [IndexEntry(i, found[n][key])
+                                   for n, i in enumerate(indexes)]
+                        results.append(Result(group.group_id, id=key,
+                                              indexes=entries))
+                    return results, Error()
+            return [], Error(ENXIO, "group is unavailable")
+
+        return self._async('find_all_indexes', run, delay)
@@ -0,0 +1,1951 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import imp
+import json
+import logging
+import os
+import random
+import shutil
+import string
+import StringIO
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+
+from docker_registry.core import driver
+from docker_registry.core import exceptions
+from docker_registry.core import lru
+from docker_registry import testing
+
+from nose import SkipTest
+from nose import tools
+
+logger = logging.getLogger(__name__)
+
+FAKE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake')
+# the fake is used by import_non_local only if real bindings are absent
+if FAKE_DIR not in sys.path:
+    sys.path.append(FAKE_DIR)
+
+from docker_registry.drivers import elliptics as elliptics_driver  # noqa
+
+fake = imp.load_source('fake_elliptics', os.path.join(FAKE_DIR,
+                                                      'elliptics.py'))
+
+FAKE_REMOTE = "fakehost:1025:2"
+
+
+class FakeBackendMixin(object):
+    """Runs the driver on top of tests/fake/elliptics.py."""
+
+    extra_config = {}
+
+    def setUp(self):
+        self.backend = fake.reset()
+        self._real_elliptics = elliptics_driver.elliptics
+        elliptics_driver.elliptics = fake
+        self.scheme = 'elliptics'
+        self.path = ''
+        self._storage = self.make_storage(self.extra_config)
+
+    def make_storage(self, extra_config):
+        config = {'elliptics_nodes': FAKE_REMOTE,
+                  'elliptics_groups': [1, 2, 3]}
+        config.update(extra_config)
+        self.config = testing.Config(config)
+        storage = driver.fetch(self.scheme)
+        return storage(self.path, self.config)
+
+    def tearDown(self):
+        elliptics_driver.elliptics = self._real_elliptics
+
+    def gen_random_string(self, length=16):
+        return ''.join([random.choice(string.ascii_uppercase + string.digits)
+                        for x in range(length)]).lower()
+
+
+class TestFakeDriver(FakeBackendMixin, testing.Driver):
+    """The common driver test suite on the fake backend."""
+
+    def __init__(self):
+        pass
+
+    @tools.raises(exceptions.FileNotFoundError)
+    def test_remove_inexistent_path(self):
+        filename = self.gen_random_string()
+        self._storage.remove("/".join((filename, filename)))
+
+
+class TestFakeGeventDriver(TestFakeDriver):
+    extra_config = {'elliptics_wait_mode': 'gevent'}
+
+    def setUp(self):
+        if elliptics_driver.gevent is None:
+            raise SkipTest("gevent is not installed")
+        super(TestFakeGeventDriver, self).setUp()
+
+
+class TestStreamWrite(FakeBackendMixin):
+    def setUp(self):
+        super(TestStreamWrite, self).setUp()
+        self._storage.buffer_size = 100
+        self.path = "/".join((self.gen_random_string(),
+                              self.gen_random_string()))
+
+    def test_chunks_order(self):
+        # chunks complete in random order
+        self.backend.configure(latency=0.001, jitter=0.01)
+        content = self.gen_random_string(length=2050)
+        self._storage.stream_write(self.path, StringIO.StringIO(content))
+        assert self._storage.get_content(self.path) == content
+        assert self.backend.max_inflight > 1
+
+    def test_memory_ceiling(self):
+        self.backend.configure(latency=0.005)
+        self._storage.stream_write_inflight = 3
+        content = self.gen_random_string(length=3000)
+        self._storage.stream_write(self.path, StringIO.StringIO(content))
+        assert self._storage.get_content(self.path) == content
+        # every pending write holds one chunk
+        assert self.backend.max_inflight_bytes <= 3 * 100
+        # the first chunk is sent along with its indexes and
+        # data and indexes of the fake directory
+        assert self.backend.max_inflight == 4
+
+    def test_sequential(self):
+        self._storage.stream_write_inflight = 1
+        content = self.gen_random_string(length=250)
+        self._storage.stream_write(self.path, StringIO.StringIO(content))
+        assert self._storage.get_content(self.path) == content
+        assert self.backend.max_inflight == 1
+
+    @tools.raises(exceptions.UnspecifiedError)
+    def test_chunk_failure(self):
+        self.backend.configure(latency=0.001)
+        fp = StringIO.StringIO(self.gen_random_string(length=1000))
+        self._storage.s_write_file(self.path, fp.read(100))
+        # the quorum is lost after the first chunk
+        self.backend.configure(groups=[1, 2], down=True)
+        fp.seek(0)
+        try:
+            self._storage.stream_write(self.path, fp)
+        finally:
+            # nothing is left in flight
+            assert self.backend.inflight == 0
+
+    def test_read_error(self):
+        class BrokenSocket(object):
+            def __init__(self, data):
+                self.fp = StringIO.StringIO(data)
+
+            def read(self, size):
+                if self.fp.tell() >= 300:
+                    raise IOError("connection reset")
+                return self.fp.read(size)
+
+        content = self.gen_random_string(length=500)
+        self._storage.stream_write(self.path, BrokenSocket(content))
+        assert self._storage.get_content(self.path) == content[:300]
+        assert self.backend.inflight == 0
+
+
+class TestStreamRead(FakeBackendMixin):
+    def setUp(self):
+        super(TestStreamRead, self).setUp()
+        self._storage.buffer_size = 100
+        self.path = self.gen_random_string()
+        self.content = self.gen_random_string(length=1050)
+        self._storage.put_content(self.path, self.content)
+
+    def test_chunks(self):
+        chunks = list(self._storage.stream_read(self.path))
+        assert "".join(chunks) == self.content
+        assert [len(c) for c in chunks] == [100] * 10 + [50]
+
+    def test_read_ahead(self):
+        self.backend.configure(latency=0.005)
+        self._storage.stream_read_ahead = 2
+        reads = self.backend.count('read_latest')
+        for chunk in self._storage.stream_read(self.path):
+            # the current chunk is read, two more are being fetched
+            assert self.backend.inflight <= 2
+        assert self.backend.max_inflight == 3
+        assert self.backend.count('read_latest') - reads == 11
+
+    def test_bytes_range(self):
+        chunks = list(self._storage.stream_read(self.path, (150, 420)))
+        assert "".join(chunks) == self.content[150:421]
+        assert [len(c) for c in chunks] == [100, 100, 71]
+
+    def test_bytes_range_beyond_end(self):
+        chunks = list(self._storage.stream_read(self.path, (1000, 5000)))
+        assert "".join(chunks) == self.content[1000:]
+
+    def test_stale_replica(self):
+        path = self.gen_random_string()
+        self._storage.put_content(path, 'old')
+        stale = self.backend.group(1).records[('DOCKER', path)]
+        self._storage.put_content(path, self.content)
+        # group 1 has missed the last write and answers first
+        self.backend.group(1).records[('DOCKER', path)] = stale
+        self.backend.configure(groups=[2, 3], latency=0.005)
+        assert "".join(self._storage.stream_read(path)) == self.content
+
+
+class TestFakeDirCache(FakeBackendMixin):
+    extra_config = {'elliptics_dir_cache_size': 10000}
+
+    def test_known_dirs_are_skipped(self):
+        self._storage.put_content('images/a/json', 'data')
+        writes = self.backend.count('write_data')
+        self._storage.put_content('images/a/ancestry', 'data')
+        # only the file itself
+        assert self.backend.count('write_data') - writes == 1
+        assert self._storage.dir_writes_skipped == 2
+
+        self._storage.put_content('images/b/json', 'data')
+        # the file and `images/b`
+        assert self.backend.count('write_data') - writes == 3
+        assert self._storage.dir_writes_skipped == 3
+        assert sorted(self._storage.list_directory('images')) == [
+            'images/a', 'images/b']
+
+    def test_missing_dirs_are_written_concurrently(self):
+        self.backend.configure(latency=0.005)
+        self._storage.put_content('a/b/c/d', 'data')
+        # data and indexes of the file and 3 directories
+        assert self.backend.max_inflight == 8
+        for path in ('a', 'a/b', 'a/b/c'):
+            assert self._storage.exists(path)
+
+    def test_remove_forgets_dir(self):
+        self._storage.put_content('a/b/c', 'data')
+        self._storage.remove('a/b')
+        self._storage.put_content('a/b/d', 'data')
+        assert self._storage.exists('a/b')
+        assert list(self._storage.list_directory('a/b')) == ['a/b/d']
+
+    def test_ttl(self):
+        self._storage._known_dirs.ttl = 0.01
+        self._storage.put_content('a/b', 'data')
+        time.sleep(0.02)
+        self._storage.put_content('a/c', 'data')
+        assert self._storage.dir_writes_skipped == 0
+
+    def test_disabled_by_default(self):
+        storage = self.make_storage({})
+        storage.put_content('a/b', 'data')
+        storage.put_content('a/c', 'data')
+        assert storage.dir_writes_skipped == 0
+
+    def test_removed_by_other_worker(self):
+        storage = self.make_storage({})
+        other = self.make_storage({})
+        storage.put_content('repositories/library/foo/tag_latest', 'a')
+        other.remove('repositories/library/foo')
+        storage.put_content('repositories/library/foo/tag_latest', 'a')
+        assert other.exists('repositories/library/foo')
+        assert list(other.list_directory('repositories/library')) == [
+            'repositories/library/foo']
+
+
+class TestExists(FakeBackendMixin):
+    def test_negative_cache(self):
+        assert not self._storage.exists('a')
+        lookups = self.backend.count('lookup')
+        assert not self._storage.exists('a')
+        assert self.backend.count('lookup') == lookups
+        assert self.backend.count('read_latest') == 0
+
+    def test_removed_by_other_worker(self):
+        self._storage.put_content('a', 'data')
+        assert self._storage.get_size('a') == 4
+        self.make_storage({}).remove('a')
+        self._storage._exists_cache.clear()
+        # the stat is still cached, the answer has expired
+        assert self._storage._stats.get('a') is not None
+        assert not self._storage.exists('a')
+
+    def test_put_content_invalidates(self):
+        assert not self._storage.exists('a/b')
+        assert not self._storage.exists('a')
+        self._storage.put_content('a/b', 'data')
+        assert self._storage.exists('a/b')
+        assert self._storage.exists('a')
+
+    def test_stream_write_invalidates(self):
+        assert not self._storage.exists('a')
+        self._storage.stream_write('a', StringIO.StringIO('data'))
+        assert self._storage.exists('a')
+
+    def test_remove_invalidates(self):
+        self._storage.put_content('a/b', 'data')
+        assert self._storage.exists('a/b')
+        self._storage.remove('a')
+        assert not self._storage.exists('a/b')
+        assert not self._storage.exists('a')
+
+    def test_first_group_answer_wins(self):
+        self._storage.put_content('a', 'data')
+        self._storage._exists_cache.clear()
+        self.backend.configure(groups=[1, 2], latency=1)
+        started = time.time()
+        assert self._storage.exists('a')
+        assert time.time() - started < 0.5
+
+    def test_missing_in_some_groups(self):
+        self._storage.put_content('a', 'data')
+        self._storage._exists_cache.clear()
+        for group_id in (1, 2):
+            self.backend.group(group_id).records.clear()
+        assert self._storage.exists('a')
+
+    def test_list_directory_skips_exists(self):
+        self._storage.put_content('a/b', 'data')
+        self._storage._exists_cache.clear()
+        lookups = self.backend.count('lookup')
+        assert list(self._storage.list_directory('a')) == ['a/b']
+        assert self.backend.count('lookup') == lookups
+
+
+class TestRemove(FakeBackendMixin):
+    def setUp(self):
+        super(TestRemove, self).setUp()
+        self.files = ['repo/tags/tag%d' % i for i in range(20)]
+        self.files += ['repo/images/a/json', 'repo/images/b/json', 'repo/json']
+        for path in self.files:
+            self._storage.put_content(path, 'data')
+
+    def test_recursive(self):
+        self._storage.remove('repo')
+        self._storage._exists_cache.clear()
+        for path in self.files + ['repo', 'repo/tags', 'repo/images/a']:
+            assert not self._storage.exists(path)
+        for group in self.backend.groups.values():
+            assert not [k for _, k in group.records if k.startswith('repo')]
+
+    def test_concurrency(self):
+        self.backend.configure(latency=0.005)
+        self._storage.remove_concurrency = 4
+        self._storage.remove('repo/tags')
+        # data and indexes removal of every key
+        assert self.backend.max_inflight == 4 * 2
+        assert list(self._storage.list_directory('repo')) == [
+            'repo/images', 'repo/json']
+
+    def test_failures_are_collected(self):
+        self._storage.remove_concurrency = 3
+        self.backend.broken_keys.add('repo/images/a/json')
+        try:
+            self._storage.remove('repo')
+            assert False
+        except exceptions.UnspecifiedError as err:
+            assert 'repo/images/a/json' in str(err)
+        # everything else is removed
+        self.backend.broken_keys.clear()
+        self._storage._exists_cache.clear()
+        assert self._storage.exists('repo/images/a/json')
+        for path in self.files:
+            if path != 'repo/images/a/json':
+                assert not self._storage.exists(path)
+
+    def test_lru(self):
+        redis = FakeRedis()
+        saved = lru.redis_conn, lru.cache_prefix
+        lru.redis_conn, lru.cache_prefix = redis, 'cache_path:/'
+        try:
+            for path in self.files + ['other/json']:
+                redis.data[lru.cache_key(path)] = 'data'
+            self._storage.remove('repo')
+            assert redis.data.keys() == ['cache_path:/other/json']
+        finally:
+            lru.redis_conn, lru.cache_prefix = saved
+
+
+class TestStatCache(FakeBackendMixin):
+    def setUp(self):
+        super(TestStatCache, self).setUp()
+        self._storage.put_content('a/b', 'data')
+
+    def lookups(self):
+        return self.backend.count('lookup')
+
+    def test_get_size_is_cached(self):
+        assert self._storage.get_size('a/b') == 4
+        lookups = self.lookups()
+        assert self._storage.get_size('a/b') == 4
+        assert self.lookups() == lookups
+
+    def test_writes_invalidate(self):
+        assert self._storage.get_size('a/b') == 4
+        self._storage.put_content('a/b', 'content')
+        assert self._storage.get_size('a/b') == 7
+        self._storage.s_append('a/b', 'more')
+        assert self._storage.get_size('a/b') == 11
+        self._storage.stream_write('a/b', StringIO.StringIO('x' * 300))
+        assert self._storage.get_size('a/b') == 300
+
+    @tools.raises(exceptions.FileNotFoundError)
+    def test_remove_invalidates(self):
+        assert self._storage.get_size('a/b') == 4
+        self._storage.remove('a/b')
+        self._storage.get_size('a/b')
+
+    def test_ttl(self):
+        self._storage._stats.ttl = 0.01
+        assert self._storage.get_size('a/b') == 4
+        lookups = self.lookups()
+        time.sleep(0.02)
+        assert self._storage.get_size('a/b') == 4
+        assert self.lookups() > lookups
+
+    def test_stat(self):
+        stat = self._storage.stat('a')
+        assert stat.is_dir
+        assert stat.size == len(elliptics_driver.FAKE_DIR_CONTENT)
+        assert not self._storage.stat('a/b').is_dir
+
+        # same size as a directory
+        self._storage.put_content('c', 'DIRECTORZ')
+        self._storage._known_dirs.clear()
+        assert self._storage.s_stat('c').is_dir is None
+        assert not self._storage.stat('c').is_dir
+        assert self._storage.s_stat('c').is_dir is False
+
+
+class TestGeventWait(FakeBackendMixin):
+    extra_config = {'elliptics_wait_mode': 'gevent'}
+
+    def setUp(self):
+        if elliptics_driver.gevent is None:
+            raise SkipTest("gevent is not installed")
+        super(TestGeventWait, self).setUp()
+        for i in range(5):
+            self._storage.put_content('a/%d' % i, 'data%d' % i)
+        self.backend.configure(latency=0.1)
+
+    def pull(self, storage):
+        import gevent
+        started = time.time()
+        jobs = [gevent.spawn(storage.get_content, 'a/%d' % i)
+                for i in range(5)]
+        gevent.joinall(jobs, raise_error=True)
+        assert [job.value for job in jobs] == ['data%d' % i
+                                               for i in range(5)]
+        return time.time() - started
+
+    def test_requests_overlap(self):
+        assert self.pull(self._storage) < 0.3
+
+    def test_thread_mode_blocks_the_hub(self):
+        storage = self.make_storage({})
+        assert self.pull(storage) >= 0.5
+
+    def test_stream_and_exists(self):
+        import gevent
+        self._storage.buffer_size = 2
+        jobs = [gevent.spawn(lambda: "".join(self._storage.stream_read(
+                    'a/0'))),
+                gevent.spawn(self._storage.exists, 'a/1'),
+                gevent.spawn(self._storage.exists, 'b')]
+        gevent.joinall(jobs, raise_error=True)
+        assert [job.value for job in jobs] == ['data0', True, False]
+
+
+class TestMetrics(FakeBackendMixin):
+    def test_operations(self):
+        self._storage.buffer_size = 100
+        self._storage.put_content('a/b', 'data')
+        self._storage.get_content('a/b')
+        self._storage.stream_write('c', StringIO.StringIO('x' * 300))
+        self._storage.exists('a/c')
+        list(self._storage.list_directory('a'))
+        self._storage.remove('a')
+        metrics = self._storage.metrics.snapshot()
+        for op in ('s_write', 's_write_indexes', 's_write_fake_dir',
+                   's_write_fake_dir_indexes', 's_read', 's_write_at',
+                   's_lookup', 's_find', 's_remove', 's_remove_indexes'):
+            assert metrics[op]['count'] > 0, op
+        assert metrics['s_write']['bytes'] == 4 + 100
+        assert metrics['s_write_at']['bytes'] == 200
+        assert metrics['s_read']['bytes'] == 4
+        assert metrics['s_write']['groups'] == {1: {'ok': 2, 'error': 0},
+                                                2: {'ok': 2, 'error': 0},
+                                                3: {'ok': 2, 'error': 0}}
+        # `a/c` and `c` before it is written
+        assert metrics['s_lookup']['errors'] == {-2: 2}
+
+    def test_latency_and_errors(self):
+        self.backend.configure(latency=0.03)
+        self.backend.configure(groups=[3], down=True)
+        self._storage.put_content('a', 'data')
+        try:
+            self._storage.get_content('b')
+        except exceptions.FileNotFoundError:
+            pass
+        metrics = self._storage.metrics.snapshot()
+        latency = metrics['s_write']['latency']
+        assert latency['0.025'] == 0 and latency['0.05'] == 1
+        assert metrics['s_write']['groups'][3] == {'ok': 0, 'error': 1}
+        assert sum(metrics['s_read']['errors'].values()) == 1
+
+    def test_prometheus(self):
+        self._storage.put_content('a', 'data')
+        text = self._storage.metrics.prometheus()
+        assert 'elliptics_op_seconds_count{op="s_write"} 1' in text
+        assert 'elliptics_op_seconds_bucket{op="s_write",le="+Inf"} 1' in text
+        assert 'elliptics_op_bytes_total{op="s_write"} 4' in text
+        assert ('elliptics_op_group_results_total'
+                '{op="s_write",group="1",result="ok"} 1') in text
+
+    def test_dump(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'elliptics.prom')
+            storage = self.make_storage({
+                'elliptics_metrics_interval': 0.01,
+                'elliptics_metrics_file': path})
+            storage.put_content('a', 'data')
+            time.sleep(0.05)
+            with open(path) as f:
+                assert 'op="s_write"' in f.read()
+        finally:
+            storage.metrics.stop_dumping()
+            shutil.rmtree(directory)
+
+
+class TestStatDirectory(FakeBackendMixin):
+    def setUp(self):
+        super(TestStatDirectory, self).setUp()
+        self._storage.put_content('a/file', 'data')
+        self._storage.put_content('a/nine_byte', '123456789')
+        self._storage.put_content('a/b/c', 'data')
+        self._storage._stats.clear()
+        self._storage._known_dirs.clear()
+
+    def test_children_attributes(self):
+        reads = self.backend.count('read_latest')
+        entries = self._storage.stat_directory('a')
+        assert [key for key, _ in entries] == ['a/b', 'a/file', 'a/nine_byte']
+        stats = dict(entries)
+        assert stats['a/b'].is_dir
+        assert stats['a/file'] == (4, stats['a/file'].mtime, False, 0, None,
+                                   '')
+        lookups = self.backend.count('lookup')
+        finds = self.backend.count('find_all_indexes')
+        for key in ('a/b', 'a/file', 'a/nine_byte'):
+            self._storage.stat(key)
+        assert self.backend.count('lookup') == lookups
+        assert self.backend.count('find_all_indexes') == finds
+        # only the file of a directory size is read
+        assert self.backend.count('read_latest') - reads == 1
+        assert not self._storage.stat('a/nine_byte').is_dir
+
+    def test_stat_without_listing(self):
+        reads = self.backend.count('read_latest')
+        assert self._storage.stat('a/b').is_dir
+        assert self._storage.stat('a').is_dir
+        assert self.backend.count('read_latest') == reads
+
+    def test_unmarked_directory(self):
+        # directories written before they got marked
+        for group in self.backend.groups.values():
+            group.indexes.pop(('DOCKER', elliptics_driver.fake_dir_index('a')))
+        assert self._storage.stat('a/b').is_dir
+
+    @tools.raises(exceptions.FileNotFoundError)
+    def test_inexistent(self):
+        self._storage.stat_directory('x')
+
+    def test_lookups_are_concurrent(self):
+        for name in ('x', 'y', 'z'):
+            self._storage.put_content('a/%s' % name, 'data')
+        self._storage._stats.clear()
+        self.backend.configure(latency=0.005)
+        # more than the 3 index finds sent at once
+        self._storage.lookup_concurrency = 4
+        self._storage.stat_directory('a')
+        assert self.backend.max_inflight == 4
+
+    def test_probed_only_if_striped(self):
+        # a tag of the size of a manifest is not read
+        tag = 'a' * elliptics_driver.MANIFEST_SIZE
+        self._storage.put_content('a/tag', tag)
+        self._storage._stats.clear()
+        self._storage._exists_cache.clear()
+        reads = self.backend.count('read_latest')
+        assert self._storage.exists('a/tag')
+        stats = dict(self._storage.stat_directory('a'))
+        assert stats['a/tag'].size == len(tag)
+        assert self.backend.count('read_latest') == reads
+
+
+class TestListingCache(FakeBackendMixin):
+    extra_config = {'elliptics_listing_cache_size': 100}
+
+    def setUp(self):
+        super(TestListingCache, self).setUp()
+        for tag in ('latest', 'v1'):
+            self._storage.put_content('repo/tags/%s' % tag, 'id')
+
+    def listing(self, path='repo/tags'):
+        return list(self._storage.list_directory(path))
+
+    def finds(self):
+        return self.backend.count('find_all_indexes')
+
+    def test_served_from_memory(self):
+        assert self.listing() == ['repo/tags/latest', 'repo/tags/v1']
+        finds = self.finds()
+        assert self.listing() == ['repo/tags/latest', 'repo/tags/v1']
+        assert self.finds() == finds
+
+    def test_incremental_updates(self):
+        self.listing()
+        self.listing('repo')
+        finds = self.finds()
+        self._storage.put_content('repo/tags/v2', 'id')
+        self._storage.remove('repo/tags/latest')
+        self._storage.put_content('repo/images/a', 'id')
+        assert self.listing() == ['repo/tags/v1', 'repo/tags/v2']
+        assert self.listing('repo') == ['repo/images', 'repo/tags']
+        # the removal walks `repo/tags/latest`
+        # and looks for striped objects in `repo/tags`
+        assert self.finds() == finds + 2
+
+    @tools.raises(exceptions.FileNotFoundError)
+    def test_removed_directory(self):
+        self.listing()
+        self._storage.remove('repo/tags')
+        self.listing()
+
+    def test_ttl(self):
+        self._storage._listings.ttl = 0.01
+        self.listing()
+        time.sleep(0.02)
+        finds = self.finds()
+        self.listing()
+        assert self.finds() == finds + 1
+
+    def test_disabled_by_default(self):
+        storage = self.make_storage({})
+        list(storage.list_directory('repo/tags'))
+        finds = self.finds()
+        list(storage.list_directory('repo/tags'))
+        assert self.finds() == finds + 1
+
+
+class TestFakeShardedIndexDriver(TestFakeDriver):
+    extra_config = {'elliptics_global_index': 'sharded',
+                    'elliptics_global_index_shards': 4}
+
+
+class TestFakeNoGlobalIndexDriver(TestFakeDriver):
+    extra_config = {'elliptics_global_index': 'none'}
+
+
+class TestGlobalIndex(FakeBackendMixin):
+    keys = ['repo/tags/latest', 'repo/tags/v1', 'images/1/json']
+
+    def setUp(self):
+        super(TestGlobalIndex, self).setUp()
+        for key in self.keys:
+            self._storage.put_content(key, 'x')
+
+    def marked(self, index):
+        group = self.backend.group(1)
+        return sorted(group.indexes.get(('DOCKER', index), {}))
+
+    def all_keys(self):
+        return sorted(self.keys + ['repo', 'repo/tags', 'images', 'images/1'])
+
+    def sharded(self, shards):
+        return sorted(key for n in range(shards)
+                      for key in self.marked('docker#%d' % n))
+
+    def test_single(self):
+        assert self.marked('docker') == self.all_keys()
+
+    def test_sharded(self):
+        storage = self.make_storage({'elliptics_global_index': 'sharded',
+                                     'elliptics_global_index_shards': 4})
+        storage.put_content('images/2/json', 'x')
+        assert 'images/2/json' in self.marked(
+            elliptics_driver.global_index_shard('images/2/json', 4))
+        assert 'images/2/json' not in self.marked('docker')
+        # keys marked before are listed as well
+        assert list(storage.list_directory('images')) == ['images/1',
+                                                          'images/2']
+
+    def test_rebuild(self):
+        storage = self.make_storage({'elliptics_global_index': 'sharded',
+                                     'elliptics_global_index_shards': 4})
+        assert storage.rebuild_global_index() == len(self.all_keys())
+        assert self.marked('docker') == []
+        assert self.sharded(4) == self.all_keys()
+
+        storage = self.make_storage({'elliptics_global_index': 'sharded',
+                                     'elliptics_global_index_shards': 2})
+        storage.rebuild_global_index(old_shards=4)
+        assert self.sharded(4) == self.sharded(2) == self.all_keys()
+
+        storage = self.make_storage({'elliptics_global_index': 'none'})
+        storage.rebuild_global_index(old_shards=2)
+        assert self.sharded(4) == []
+        # back to the single index, keys missing from it are found
+        self._storage.rebuild_global_index()
+        assert self.marked('docker') == self.all_keys()
+        assert list(self._storage.list_directory('repo/tags')) == [
+            'repo/tags/latest', 'repo/tags/v1']
+
+    def test_rebuild_subtree(self):
+        storage = self.make_storage({'elliptics_global_index': 'none'})
+        assert storage.rebuild_global_index('repo') == 4
+        assert self.marked('docker') == ['images', 'images/1',
+                                         'images/1/json']
+
+    @tools.raises(exceptions.UnspecifiedError)
+    def test_rebuild_failure(self):
+        self.backend.broken_keys.add('repo/tags/v1')
+        self._storage.rebuild_global_index()
+
+
+class TestConcurrentWrite(FakeBackendMixin):
+    extra_config = {'elliptics_dir_cache_size': 10000}
+    latency = 0.05
+
+    def setUp(self):
+        super(TestConcurrentWrite, self).setUp()
+        self._storage.put_content('images/a/json', 'data')
+        self.backend.configure(latency=self.latency)
+
+    def test_single_round(self):
+        started = time.time()
+        self._storage.put_content('images/a/ancestry', 'data')
+        # data and indexes are written together
+        assert time.time() - started < 1.5 * self.latency
+        assert self.backend.max_inflight == 2
+
+    def test_batch(self):
+        started = time.time()
+        files = {'images/b/json': 'data',
+                 'images/b/ancestry': '[]',
+                 'images/b/_checksum': ''}
+        assert self._storage.put_contents(files) == sorted(files)
+        assert time.time() - started < 1.5 * self.latency
+        # 3 files and `images/b` once
+        assert self.backend.max_inflight == 8
+        assert sorted(self._storage.list_directory('images/b')) == sorted(
+            files)
+        assert self._storage.get_content('images/b/ancestry') == '[]'
+        assert self._storage.stat('images/b').is_dir
+
+    @tools.raises(exceptions.UnspecifiedError)
+    def test_index_failure(self):
+        self.backend.broken_ops.add('update_indexes')
+        self._storage.put_content('images/a/ancestry', 'data')
+
+    def test_data_failure(self):
+        self.backend.broken_ops.add('write_data')
+        for path in ('images/a/json', 'images/a/ancestry'):
+            try:
+                self._storage.put_content(path, 'data')
+            except exceptions.UnspecifiedError:
+                pass
+            else:  # pragma: no cover
+                assert False, "writing must fail"
+        # the key written before stays listed, the new one is not
+        assert list(self._storage.list_directory('images/a')) == [
+            'images/a/json']
+
+
+class TestDiskCache(FakeBackendMixin):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.extra_config = {'elliptics_disk_cache_dir': self.root,
+                             'elliptics_disk_cache_size': 250}
+        super(TestDiskCache, self).setUp()
+        self._storage.buffer_size = 30
+        self.cache = self._storage.disk_cache
+        self.content = self.gen_random_string(length=100)
+        self._storage.put_content('images/a/layer', self.content)
+
+    def tearDown(self):
+        super(TestDiskCache, self).tearDown()
+        shutil.rmtree(self.root)
+
+    def read(self, path='images/a/layer', bytes_range=None):
+        return ''.join(self._storage.stream_read(path, bytes_range))
+
+    def reads(self):
+        return self.backend.count('read_latest')
+
+    def files(self):
+        return os.listdir(self.cache.root)
+
+    def test_fill_through(self):
+        assert self.read() == self.content
+        reads = self.reads()
+        assert self.read() == self.content
+        assert self.read(bytes_range=(10, 69)) == self.content[10:70]
+        assert self._storage.get_content('images/a/layer') == self.content
+        assert self._storage.get_size('images/a/layer') == 100
+        assert self.reads() == reads
+        assert self.cache.hits == 3
+        assert self.cache.misses == 1
+        assert self.cache.hit_rate() == 0.75
+
+    def test_get_content(self):
+        self._storage.put_content('images/a/json', '{}')
+        assert self._storage.get_content('images/a/json') == '{}'
+        reads = self.reads()
+        assert self._storage.get_content('images/a/json') == '{}'
+        assert self.reads() == reads
+
+    def test_ranges_are_not_cached(self):
+        self.read(bytes_range=(0, 9))
+        assert self.files() == []
+
+    def test_other_paths(self):
+        self._storage.put_content('repositories/lib/a/tag_latest', 'id')
+        for _ in range(2):
+            self._storage.get_content('repositories/lib/a/tag_latest')
+        assert self.files() == []
+        assert self.cache.misses == 0
+
+    def test_lru_budget(self):
+        for name in ('b', 'c'):
+            self._storage.put_content('images/%s/layer' % name, self.content)
+        for name in ('a', 'b', 'a', 'c'):
+            self.read('images/%s/layer' % name)
+        # `b` is the least recently used one
+        assert self.cache.size_of('images/b/layer') is None
+        assert self.cache.used == 200
+        assert len(self.files()) == 2
+
+    def test_too_large(self):
+        self._storage.put_content('images/b/layer', 'x' * 300)
+        assert self.read('images/b/layer') == 'x' * 300
+        assert self.files() == []
+
+    def test_invalidation(self):
+        self.read()
+        self._storage.put_content('images/a/layer', 'new')
+        assert self.read() == 'new'
+        self._storage.stream_write('images/a/layer',
+                                   StringIO.StringIO(self.content))
+        assert self.read() == self.content
+        self._storage.remove('images/a/layer')
+        assert self.files() == []
+        assert self.cache.used == 0
+
+    def test_write_during_fill(self):
+        chunks = self._storage.stream_read('images/a/layer')
+        next(chunks)
+        content = self.gen_random_string(length=100)
+        self._storage.put_content('images/a/layer', content)
+        list(chunks)
+        assert self.files() == []
+        assert self.read() == content
+
+    def test_reader_gone(self):
+        chunks = self._storage.stream_read('images/a/layer')
+        next(chunks)
+        chunks.close()
+        assert self.files() == []
+
+    def test_dead_processes(self):
+        dead = os.path.join(self.root, '999999999.1')
+        os.mkdir(dead)
+        storage = self.make_storage(self.extra_config)
+        assert os.path.isdir(self.cache.root)
+        assert os.path.isdir(storage.disk_cache.root)
+        assert not os.path.exists(dead)
+
+    def test_disabled_by_default(self):
+        storage = self.make_storage({})
+        assert storage.disk_cache.root is None
+        list(storage.stream_read('images/a/layer'))
+        assert storage.disk_cache.misses == 0
+
+
+class TestFastestReads(FakeBackendMixin):
+    extra_config = {'elliptics_images_read_mode': 'fastest'}
+
+    def setUp(self):
+        super(TestFastestReads, self).setUp()
+        self.content = self.gen_random_string(length=100)
+        self._storage.put_content('images/a/layer', self.content)
+        for group, latency in ((1, 0.03), (2, 0.02), (3, 0.001)):
+            self.backend.configure(groups=[group], latency=latency)
+        self.scores = self._storage.group_scores
+
+    def read(self, path='images/a/layer'):
+        return self._storage.s_read(path)
+
+    def test_best_group_first(self):
+        for _ in range(5):
+            assert self.read() == self.content
+        assert self.scores.order() == [3, 2, 1]
+        started = time.time()
+        for _ in range(5):
+            self.read()
+        assert time.time() - started < 5 * 0.02
+        assert self.backend.count('read_latest') == 0
+
+    def test_stream_read(self):
+        for _ in range(5):
+            self.read()
+        started = time.time()
+        for _ in range(5):
+            assert ''.join(self._storage.stream_read('images/a/layer')) == (
+                self.content)
+        # the lookup does not wait for the slowest group either
+        assert time.time() - started < 5 * 0.02
+
+    def test_fallback(self):
+        for _ in range(5):
+            self.read()
+        self.backend.configure(groups=[3], down=True)
+        assert self.read() == self.content
+        # the failure has been accounted
+        assert self.scores.order()[0] != 3
+        assert self.scores.score(3) > 0.1
+
+    def test_scored_by_issue_order(self):
+        r = self._storage.s_read_async('images/a/layer')
+        # scores change while the read from group 1 is in flight
+        self.scores.order = lambda: [3, 2, 1]
+        assert self._storage.s_read_wait('images/a/layer', r) == self.content
+        assert self.scores.score(2) == self.scores.score(3) == 0
+
+    def test_missing_key(self):
+        try:
+            self.read('images/b/layer')
+        except exceptions.FileNotFoundError:
+            pass
+        assert [self.scores.score(g) for g in (1, 2, 3)] == [0, 0, 0]
+
+    def test_mutable_keys(self):
+        self._storage.put_content('repositories/a/tag_latest', 'id')
+        reads = self.backend.count('read_latest')
+        self._storage.get_content('repositories/a/tag_latest')
+        assert self.backend.count('read_latest') == reads + 1
+
+    def test_latest_by_default(self):
+        storage = self.make_storage({})
+        storage.s_read('images/a/layer')
+        assert self.backend.count('read_latest') == 1
+        assert self.backend.count('read_data') == 0
+
+    def test_forget(self):
+        self.scores.forget = 0.01
+        self.scores.fail(3)
+        assert self.scores.order() == [1, 2, 3]
+        time.sleep(0.1)
+        assert self.scores.score(3) < 0.001
+
+
+class TestHedgedReads(FakeBackendMixin):
+    extra_config = {'elliptics_images_read_mode': 'fastest',
+                    'elliptics_hedge_percentile': 90,
+                    'elliptics_hedge_budget': 0.5}
+
+    def setUp(self):
+        super(TestHedgedReads, self).setUp()
+        self.content = self.gen_random_string(length=100)
+        self._storage.put_content('images/a/layer', self.content)
+        self.prime()
+        self.slow = 0.3
+
+    def prime(self):
+        self._storage.group_scores.order = lambda: [1, 2, 3]
+        # reads usually take 10 ms
+        for _ in range(100):
+            self._storage._read_latencies.add(0.01)
+
+    def read(self):
+        started = time.time()
+        assert self._storage.s_read('images/a/layer') == self.content
+        return time.time() - started
+
+    def test_fired_and_won(self):
+        self.backend.configure(groups=[1], latency=self.slow)
+        assert self.read() < self.slow / 2
+        assert self._storage.hedges_fired == 1
+        assert self._storage.hedges_won == 1
+        # the hedge is read from the other groups
+        assert self.backend.count('read_data') == 2
+
+    def test_not_fired(self):
+        self.backend.configure(latency=0.001)
+        self.read()
+        assert self._storage.hedges_fired == 0
+        assert self.backend.count('read_data') == 1
+
+    def test_lost(self):
+        self.backend.configure(groups=[1], latency=0.05)
+        self.backend.configure(groups=[2, 3], latency=self.slow)
+        assert self.read() < self.slow
+        assert self._storage.hedges_fired == 1
+        assert self._storage.hedges_won == 0
+
+    def test_budget(self):
+        self.backend.configure(groups=[1], latency=0.05)
+        for _ in range(4):
+            self.read()
+        assert self._storage.hedged_reads == 4
+        assert self._storage.hedges_fired == 2
+
+    def test_failed_hedge(self):
+        self.backend.configure(groups=[1], latency=0.05)
+        self.backend.configure(groups=[2, 3], down=True)
+        self.read()
+        assert self._storage.hedges_fired == 1
+        assert self._storage.hedges_won == 0
+
+    def test_answered_read_latency(self):
+        self.backend.configure(latency=0.001)
+        r = self._storage.s_read_async('images/a/layer')
+        # the read has been answered while it was queued
+        time.sleep(0.05)
+        self._storage.s_read_wait('images/a/layer', r)
+        assert max(self._storage._read_latencies._samples) < 0.05
+
+    def test_too_few_samples(self):
+        storage = self.make_storage(self.extra_config)
+        self.backend.configure(groups=[1], latency=0.05)
+        storage.s_read('images/a/layer')
+        assert storage.hedges_fired == 0
+
+    def test_gevent(self):
+        if elliptics_driver.gevent is None:  # pragma: no cover
+            raise SkipTest("gevent is not installed")
+        config = dict(self.extra_config, elliptics_wait_mode='gevent')
+        self._storage = self.make_storage(config)
+        self.prime()
+        self.backend.configure(groups=[1], latency=self.slow)
+        assert self.read() < self.slow / 2
+        assert self._storage.hedges_won == 1
+
+
+class TestStriped(FakeBackendMixin):
+    stripe = 256 * 1024
+    extra_config = {'elliptics_stripe_size': stripe}
+
+    def setUp(self):
+        super(TestStriped, self).setUp()
+        self.content = os.urandom(int(self.stripe * 2.5))
+        self.path = 'images/a/layer'
+
+    def write(self, content=None, storage=None):
+        storage = storage or self._storage
+        storage.stream_write(self.path, StringIO.StringIO(
+            self.content if content is None else content))
+
+    def keys(self):
+        return sorted(key for _, key in self.backend.group(1).records)
+
+    def stripes(self):
+        return [key for key in self.keys() if '#stripe' in key]
+
+    def test_layout(self):
+        self.write()
+        generation = self._storage.stat(self.path).generation
+        assert len(generation) == 16
+        assert self.stripes() == ['images/a/layer#%s#stripe%d' % (
+            generation, n) for n in range(3)]
+        assert len(self._storage.s_read(self.path)) == 64
+        assert self._storage.get_size(self.path) == len(self.content)
+        assert list(self._storage.list_directory('images/a')) == [self.path]
+        assert not self._storage.stat(self.path).is_dir
+
+    def test_stat_directory(self):
+        self.write()
+        self._storage._stats.clear()
+        stats = dict(self._storage.stat_directory('images/a'))
+        assert stats[self.path].size == len(self.content)
+        assert stats[self.path].stripe_size == self.stripe
+
+    def test_read(self):
+        self.write()
+        assert ''.join(self._storage.stream_read(self.path)) == self.content
+        assert self._storage.get_content(self.path) == self.content
+        bytes_range = (self.stripe - 10, 2 * self.stripe + 10)
+        assert ''.join(self._storage.stream_read(self.path, bytes_range)) == (
+            self.content[bytes_range[0]:bytes_range[1] + 1])
+
+    def test_stripes_are_not_copied(self):
+        class Body(object):
+            def __init__(self, data):
+                self.fp = StringIO.StringIO(data)
+                self.returned = []
+
+            def read(self, size):
+                self.returned.append(self.fp.read(size))
+                return self.returned[-1]
+
+        body = Body(self.content)
+        self._storage.stream_write(self.path, body)
+        stored = self.backend.group(1).records[('DOCKER', self.stripes()[0])]
+        assert stored.data is body.returned[0]
+        assert elliptics_driver.as_str(stored.data) is stored.data
+        assert elliptics_driver.as_str(bytearray('ab')) == 'ab'
+
+    def test_parallel(self):
+        self.backend.configure(latency=0.01)
+        self.write()
+        assert self.backend.max_inflight >= 3
+        self.backend.max_inflight = 0
+        storage = self.make_storage(self.extra_config)
+        assert ''.join(storage.stream_read(self.path)) == self.content
+        # all 3 stripes are read at once
+        assert self.backend.max_inflight == 3
+
+    def test_small_objects(self):
+        for size in (10, self.stripe):
+            self.write(self.content[:size])
+            assert self.stripes() == []
+            assert self._storage.stat(self.path).stripe_size == 0
+            assert ''.join(self._storage.stream_read(self.path)) == (
+                self.content[:size])
+
+    def test_single_key_objects(self):
+        self.write(storage=self.make_storage({}))
+        assert self.stripes() == []
+        assert ''.join(self._storage.stream_read(self.path)) == self.content
+        assert self._storage.get_size(self.path) == len(self.content)
+
+    def test_manifest_sized_file(self):
+        self._storage.put_content(self.path, 'x' * 64)
+        assert self._storage.get_size(self.path) == 64
+        assert self._storage.get_content(self.path) == 'x' * 64
+
+    def test_remove(self):
+        self.write()
+        self._storage.remove('images/a')
+        assert self.keys() == ['images']
+
+    def test_failed_overwrite(self):
+        self.write()
+        stripes = self.stripes()
+        write_at = self._storage.s_write_at
+
+        def fail_after_first(key, data, offset):
+            # the first stripe is written, the rest fail
+            r = write_at(key, data, offset)
+            self.backend.broken_ops.add('write_data')
+            return r
+        self._storage.s_write_at = fail_after_first
+        try:
+            self.write(os.urandom(len(self.content)))
+        except exceptions.UnspecifiedError:
+            pass
+        else:  # pragma: no cover
+            assert False, "writing must fail"
+        self.backend.broken_ops.clear()
+        # the stored object is left whole
+        assert self.stripes() == stripes
+        assert ''.join(self._storage.stream_read(self.path)) == self.content
+
+    def test_overwrite(self):
+        self.write()
+        content = self.content[:int(self.stripe * 1.5)]
+        self.write(content)
+        assert len(self.stripes()) == 2
+        assert ''.join(self._storage.stream_read(self.path)) == content
+        self.write(content, storage=self.make_storage({}))
+        assert self.stripes() == []
+        assert self._storage.s_find(
+            [elliptics_driver.striped_index('images/a')]) == []
+        self._storage.remove(self.path)
+        assert self.keys() == ['images', 'images/a']
+
+
+class TestDedup(FakeBackendMixin):
+    extra_config = {'elliptics_dedup': True}
+
+    def setUp(self):
+        super(TestDedup, self).setUp()
+        self.content = os.urandom(300 * 1024)
+
+    def write(self, path, content=None, storage=None):
+        storage = storage or self._storage
+        storage.stream_write(path, StringIO.StringIO(
+            self.content if content is None else content))
+
+    def blobs(self):
+        return sorted(key for _, key in self.backend.group(1).records
+                      if key.startswith(elliptics_driver.BLOB_PREFIX) and
+                      '#stripe' not in key)
+
+    def test_same_content_is_stored_once(self):
+        self.write('images/a/layer')
+        self.write('images/b/layer')
+        assert len(self.blobs()) == 1
+        assert self._storage.dedup_bytes_saved == len(self.content)
+        for path in ('images/a/layer', 'images/b/layer'):
+            assert len(self._storage.s_read(path)) == (
+                elliptics_driver.REFERENCE_SIZE)
+            assert self._storage.get_size(path) == len(self.content)
+            assert ''.join(self._storage.stream_read(path)) == self.content
+            assert self._storage.get_content(path) == self.content
+        bytes_range = (10, 200 * 1024)
+        assert ''.join(self._storage.stream_read('images/b/layer',
+                                                 bytes_range)) == (
+            self.content[bytes_range[0]:bytes_range[1] + 1])
+        assert list(self._storage.list_directory('images/a')) == [
+            'images/a/layer']
+        self._storage._stats.clear()
+        stats = dict(self._storage.stat_directory('images/a'))
+        assert stats['images/a/layer'].size == len(self.content)
+
+    def test_different_content(self):
+        self.write('images/a/layer')
+        self.write('images/b/layer', self.content[:1000])
+        assert len(self.blobs()) == 2
+        assert self._storage.dedup_bytes_saved == 0
+        assert self._storage.get_content('images/b/layer') == (
+            self.content[:1000])
+
+    def test_remove(self):
+        self.write('images/a/layer')
+        self.write('images/b/layer')
+        self._storage.remove('images/a')
+        assert len(self.blobs()) == 1
+        assert self._storage.get_content('images/b/layer') == self.content
+        self._storage.remove('images/b/layer')
+        assert self.blobs() == []
+        assert self._storage.s_find(['#refs/%s' % hashlib.sha256(
+            self.content).hexdigest()]) == []
+
+    def test_overwrite(self):
+        self.write('images/a/layer')
+        self.write('images/a/layer', self.content[:1000])
+        assert len(self.blobs()) == 1
+        assert self._storage.get_content('images/a/layer') == (
+            self.content[:1000])
+        self.write('images/a/layer', storage=self.make_storage({}))
+        assert self.blobs() == []
+        assert self._storage.s_find(
+            [elliptics_driver.striped_index('images/a')]) == []
+        assert self._storage.get_content('images/a/layer') == self.content
+
+    def test_striped(self):
+        config = {'elliptics_dedup': True,
+                  'elliptics_stripe_size': 128 * 1024}
+        storage = self.make_storage(config)
+        self.write('images/a/layer', storage=storage)
+        self.write('images/b/layer', storage=storage)
+        stripes = [key for _, key in self.backend.group(1).records
+                   if '#stripe' in key]
+        assert len(stripes) == 3
+        assert all(key.startswith(self.blobs()[0]) for key in stripes)
+        assert ''.join(storage.stream_read('images/b/layer')) == self.content
+        storage.remove('images/a/layer')
+        storage.remove('images/b/layer')
+        assert [key for _, key in self.backend.group(1).records
+                if key.startswith(elliptics_driver.BLOB_PREFIX)] == []
+
+    def racing_storage(self, stored=None):
+        """Storage whose upload misses the content key as a concurrent
+        upload does, which writes it with `stored` right after us.
+        """
+        storage = self.make_storage(self.extra_config)
+        lookup = storage.s_content_blob
+        calls = []
+
+        def content_blob(digest):
+            calls.append(digest)
+            if len(calls) == 1:
+                return None
+            if len(calls) == 2 and stored is not None:
+                storage.s_write_plain(elliptics_driver.content_key(digest),
+                                      stored)
+            return lookup(digest)
+        storage.s_content_blob = content_blob
+        return storage
+
+    def test_race_lost(self):
+        self.write('images/a/layer')
+        stored = self.blobs()
+        self.write('images/b/layer', storage=self.racing_storage(stored[0]))
+        assert self.blobs() == stored
+        assert self._storage.get_content('images/b/layer') == self.content
+        self._storage.remove('images/a/layer')
+        self._storage.remove('images/b/layer')
+        assert self.blobs() == []
+
+    def test_race_won(self):
+        self.write('images/a/layer')
+        self.write('images/b/layer', storage=self.racing_storage())
+        # the first upload refers to a blob the content key does not name
+        assert len(self.blobs()) == 2
+        self._storage.remove('images/a/layer')
+        assert len(self.blobs()) == 1
+        assert self._storage.get_content('images/b/layer') == self.content
+        self._storage.remove('images/b/layer')
+        assert self.blobs() == []
+
+    def test_concurrent_remove(self):
+        self.backend.configure(latency=0.01, jitter=0.05)
+        paths = ['images/%s/layer' % name for name in 'abcdef']
+
+        def run(job):
+            errors = []
+
+            def target(path):
+                try:
+                    job(path)
+                except Exception as e:
+                    errors.append(e)
+            threads = [threading.Thread(target=target, args=(path,))
+                       for path in paths]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            assert errors == []
+
+        run(self.write)
+        for path in paths:
+            assert self._storage.get_content(path) == self.content
+        run(self._storage.remove)
+        assert self.blobs() == []
+        assert self._storage.s_content_blob(
+            hashlib.sha256(self.content).hexdigest()) is None
+
+    def test_failed_write(self):
+        write_at = self._storage.s_write_at
+
+        def fail_after_first(key, data, offset):
+            # the first chunk is written, the rest fail
+            if offset:
+                self.backend.broken_ops.add('write_data')
+            return write_at(key, data, offset)
+        self._storage.s_write_at = fail_after_first
+        try:
+            self.write('images/a/layer')
+        except exceptions.UnspecifiedError:
+            pass
+        else:  # pragma: no cover
+            assert False, "writing must fail"
+        self.backend.broken_ops.clear()
+        assert self.blobs() == []
+
+    def test_plain_objects(self):
+        self.write('images/a/layer', storage=self.make_storage({}))
+        self.write('images/b/layer')
+        assert self._storage.get_content('images/a/layer') == self.content
+        assert self._storage.get_content('images/b/layer') == self.content
+        self._storage.remove('images/a/layer')
+        assert len(self.blobs()) == 1
+
+    def test_empty(self):
+        self.write('images/a/layer', '')
+        assert self.blobs() == []
+        assert not self._storage.exists('images/a/layer')
+
+
+class FakeRedis(object):
+    """The part of redis.StrictRedis the lru module and the driver use."""
+
+    def __init__(self):
+        self.data = {}
+        self.calls = 0
+
+    def get(self, key):
+        self.calls += 1
+        return self.data.get(key)
+
+    def set(self, key, value):
+        self.calls += 1
+        self.data[key] = value
+
+    def mget(self, keys):
+        self.calls += 1
+        return [self.data.get(key) for key in keys]
+
+    def delete(self, *keys):
+        self.calls += 1
+        for key in keys:
+            self.data.pop(key, None)
+
+    def pipeline(self, transaction=True):
+        redis = self
+
+        class Pipeline(list):
+            def set(self, key, value):
+                self.append((key, value))
+
+            def execute(self):
+                redis.calls += 1
+                redis.data.update(self)
+        return Pipeline()
+
+
+class TestBulkRead(FakeBackendMixin):
+    latency = 0.05
+
+    def setUp(self):
+        super(TestBulkRead, self).setUp()
+        self.files = {}
+        for n in xrange(40):
+            for name in ('json', 'ancestry', '_checksum'):
+                self.files['images/%d/%s' % (n, name)] = '%d %s' % (n, name)
+        self._storage.put_contents(self.files)
+        self.backend.configure(latency=self.latency)
+        self.backend.max_inflight = 0
+
+    def test_single_round(self):
+        started = time.time()
+        assert self._storage.get_contents(self.files) == self.files
+        # 120 reads, `lookup_concurrency` at a time
+        assert time.time() - started < 3.5 * self.latency
+        assert self.backend.max_inflight == 64
+
+    def test_errors(self):
+        contents = self._storage.get_contents(['images/0/json',
+                                               'images/0/layer'])
+        assert contents['images/0/json'] == '0 json'
+        assert isinstance(contents['images/0/layer'],
+                          exceptions.FileNotFoundError)
+
+    def test_striped(self):
+        storage = self.make_storage({'elliptics_stripe_size': 128 * 1024})
+        content = os.urandom(300 * 1024)
+        storage.stream_write('images/0/layer', StringIO.StringIO(content))
+        assert storage.get_contents(['images/0/layer']) == {
+            'images/0/layer': content}
+
+    def test_lru(self):
+        redis = FakeRedis()
+        saved = lru.redis_conn, lru.cache_prefix
+        lru.redis_conn, lru.cache_prefix = redis, 'cache_path:/'
+        try:
+            paths = ['images/0/json', 'images/1/json', 'images/0/layer']
+            self._storage.get_contents(paths)
+            assert sorted(redis.data) == ['cache_path:/images/0/json',
+                                          'cache_path:/images/1/json']
+            # a lookup of all of them and a store of the missing ones
+            assert redis.calls == 2
+            reads = self.backend.count('read_latest')
+            redis.data['cache_path:/images/0/json'] = 'cached'
+            assert self._storage.get_contents(paths[:2]) == {
+                'images/0/json': 'cached', 'images/1/json': '1 json'}
+            assert self.backend.count('read_latest') == reads
+        finally:
+            lru.redis_conn, lru.cache_prefix = saved
+
+
+class TestCompression(FakeBackendMixin):
+    extra_config = {'elliptics_compress_patterns': [
+        'images/*/json', 'images/*/ancestry',
+        'repositories/*/*/_index_images']}
+
+    def setUp(self):
+        super(TestCompression, self).setUp()
+        self.json = json.dumps([{'id': '%064d' % n} for n in xrange(40)])
+
+    def stored(self, path):
+        return self.backend.group(1).records[('DOCKER', path)].data
+
+    def test_put_content(self):
+        self._storage.put_content('images/a/json', self.json)
+        stored = self.stored('images/a/json')
+        assert stored.startswith(elliptics_driver.COMPRESSED_MAGIC)
+        assert len(stored) < len(self.json) / 4
+        assert self._storage.compressed_bytes_saved == (
+            len(self.json) - len(stored))
+        assert self._storage.get_content('images/a/json') == self.json
+        assert self._storage.get_contents(['images/a/json']) == {
+            'images/a/json': self.json}
+
+    def test_put_contents(self):
+        files = {'images/a/ancestry': self.json,
+                 'repositories/library/a/_index_images': self.json,
+                 'repositories/library/a/tag_latest': self.json}
+        self._storage.put_contents(files)
+        assert self.stored('repositories/library/a/tag_latest') == self.json
+        for path in files:
+            assert self._storage.get_content(path) == self.json
+        assert self._storage.get_contents(files) == files
+
+    def test_stored_as_is(self):
+        random_content = os.urandom(4096)
+        for path, content in (('images/a/json', '{}'),
+                              ('images/a/json', random_content),
+                              ('images/a/_checksum', self.json)):
+            self._storage.put_content(path, content)
+            assert self.stored(path) == content
+            assert self._storage.get_content(path) == content
+        assert self._storage.compressed_bytes_saved == 0
+
+    def test_old_objects(self):
+        self.make_storage({}).put_content('images/a/json', self.json)
+        assert self._storage.get_content('images/a/json') == self.json
+        content = elliptics_driver.COMPRESSED_MAGIC + 'not zlib'
+        self.make_storage({}).put_content('images/a/ancestry', content)
+        assert self._storage.get_content('images/a/ancestry') == content
+
+    def test_layers(self):
+        self._storage.stream_write('images/a/json',
+                                   StringIO.StringIO(self.json))
+        assert self.stored('images/a/json') == self.json
+        assert ''.join(self._storage.stream_read('images/a/json',
+                                                 (10, 99))) == (
+            self.json[10:100])
+
+    def test_stream_read(self):
+        self._storage.put_content('images/a/json', self.json)
+        assert self._storage.get_size('images/a/json') == len(self.json)
+        assert ''.join(self._storage.stream_read('images/a/json')) == (
+            self.json)
+        assert ''.join(self._storage.stream_read('images/a/json',
+                                                 (10, 99))) == (
+            self.json[10:100])
+
+    def test_disk_cache(self):
+        root = tempfile.mkdtemp()
+        try:
+            storage = self.make_storage(dict(
+                self.extra_config, elliptics_disk_cache_dir=root))
+            storage.put_content('images/a/json', self.json)
+            assert ''.join(storage.stream_read('images/a/json')) == self.json
+            # served from the disk cache filled by the stream
+            reads = self.backend.count('read_latest')
+            assert storage.get_content('images/a/json') == self.json
+            assert storage.get_size('images/a/json') == len(self.json)
+            assert self.backend.count('read_latest') == reads
+        finally:
+            shutil.rmtree(root)
+
+    def test_min_size(self):
+        storage = self.make_storage(dict(
+            self.extra_config,
+            elliptics_compress_min_size=len(self.json) + 1))
+        storage.put_content('images/a/json', self.json)
+        assert self.stored('images/a/json') == self.json
+
+
+class TestLazyConnect(FakeBackendMixin):
+    slow = 'slowhost:1025:2'
+
+    def setUp(self):
+        super(TestLazyConnect, self).setUp()
+        self.backend.connect_latency = {FAKE_REMOTE: 0.05, self.slow: 0.5}
+        self.config = {'elliptics_nodes': [FAKE_REMOTE, self.slow],
+                       'elliptics_connect_mode': 'lazy',
+                       'elliptics_route_refresh_interval': 0}
+
+    def test_first_request_waits_for_a_route(self):
+        started = time.time()
+        storage = self.make_storage(self.config)
+        assert time.time() - started < 0.05
+        storage.put_content('images/a/json', 'data')
+        assert 0.05 <= time.time() - started < 0.5
+        assert 0.05 <= storage.time_to_ready < 0.5
+        assert storage.s_routes() == [FAKE_REMOTE]
+        time.sleep(0.5)
+        assert sorted(storage.s_routes()) == [FAKE_REMOTE, self.slow]
+
+    def test_eager(self):
+        started = time.time()
+        storage = self.make_storage(dict(self.config,
+                                         elliptics_connect_mode='eager'))
+        # the slowest remote delays the start
+        assert time.time() - started >= 0.5
+        assert storage.time_to_ready >= 0.5
+
+    def test_unreachable(self):
+        self.backend.unreachable.update([FAKE_REMOTE, self.slow])
+        storage = self.make_storage(self.config)
+        # every request fails, not only the first one to wait
+        for request in (lambda: storage.put_content('images/a/json', 'a'),
+                        lambda: storage.put_content('images/b/json', 'b'),
+                        lambda: storage.s_stat('images/a/json')):
+            try:
+                request()
+            except exceptions.ConnectionError:
+                pass
+            else:  # pragma: no cover
+                assert False, "the request must fail"
+
+    def test_gevent(self):
+        if elliptics_driver.gevent is None:
+            raise SkipTest("gevent is not installed")
+        # connecting must not stall the hub of a monkey patched worker,
+        # which takes a process of its own
+        script = """
+import gevent.monkey
+gevent.monkey.patch_all()
+import time
+import gevent
+from docker_registry.core import driver
+from docker_registry.drivers import elliptics as elliptics_driver
+from docker_registry import testing
+
+backend = elliptics_driver.elliptics.reset()
+backend.connect_latency = {%(remote)r: 0.5}
+storage = driver.fetch('elliptics')('', testing.Config({
+    'elliptics_nodes': %(remote)r, 'elliptics_groups': [1],
+    'elliptics_wait_mode': 'gevent', 'elliptics_connect_mode': 'lazy'}))
+ticks = []
+
+def tick():
+    while True:
+        ticks.append(time.time())
+        gevent.sleep(0.01)
+gevent.spawn(tick)
+storage.put_content('images/a/json', 'data')
+print(len(ticks))
+""" % {'remote': FAKE_REMOTE}
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+            [os.path.dirname(os.path.dirname(FAKE_DIR)), FAKE_DIR]))
+        process = subprocess.Popen([sys.executable, '-c', script], env=env,
+                                   stdout=subprocess.PIPE)
+        out = process.communicate()[0]
+        assert process.returncode == 0
+        # greenlets have run meanwhile
+        assert int(out) >= 20
+
+    def test_refresh(self):
+        self.backend.connect_latency = {}
+        storage = self.make_storage(dict(
+            self.config, elliptics_route_refresh_interval=0.05))
+        try:
+            storage.put_content('images/a/json', 'data')
+            time.sleep(0.01)
+            storage._elliptics_node.routes.remove(self.slow)
+            assert storage.s_routes() == [FAKE_REMOTE]
+            time.sleep(0.1)
+            assert sorted(storage.s_routes()) == [FAKE_REMOTE, self.slow]
+        finally:
+            storage.stop_refreshing()
+
+    def test_refresh_routes(self):
+        self.backend.connect_latency = {}
+        self.backend.unreachable.add(self.slow)
+        storage = self.make_storage(self.config)
+        storage.put_content('images/a/json', 'data')
+        assert storage.s_refresh_routes() == []
+        self.backend.unreachable.clear()
+        assert storage.s_refresh_routes() == [self.slow]
+        assert storage.s_refresh_routes() == []
+
+    def test_refresh_resolved_routes(self):
+        self.backend.connect_latency = {}
+        storage = self.make_storage(dict(
+            self.config, elliptics_nodes=['localhost:1025:2']))
+        storage.put_content('images/a/json', 'data')
+        # routes name the address of a remote given by host name
+        storage._elliptics_node.routes[:] = ['127.0.0.1:1025:2']
+        assert storage.s_refresh_routes() == []
+
+
+class DroppingBody(object):
+    """Upload body whose connection drops once `limit` bytes are read."""
+
+    def __init__(self, data, limit):
+        self.fp = StringIO.StringIO(data)
+        self.limit = limit
+
+    def read(self, size):
+        if self.fp.tell() >= self.limit:
+            raise IOError("connection reset by peer")
+        return self.fp.read(min(size, self.limit - self.fp.tell()))
+
+
+class TestResumableUpload(FakeBackendMixin):
+    stripe = 128 * 1024
+    extra_config = {'elliptics_stripe_size': stripe,
+                    'elliptics_resumable_uploads': True}
+
+    def setUp(self):
+        super(TestResumableUpload, self).setUp()
+        self.content = os.urandom(self.stripe * 10 + 100)
+        self.path = 'images/a/layer'
+
+    def keys(self):
+        return sorted(key for _, key in self.backend.group(1).records)
+
+    def stripes(self):
+        return elliptics_driver.stripe_keys(self.path,
+                                            self._storage.stat(self.path))
+
+    def interrupt(self, storage=None, stripes=5, content=None):
+        storage = storage or self._storage
+        try:
+            storage.stream_write(self.path, DroppingBody(
+                content or self.content, self.stripe * stripes + 10))
+        except IOError:
+            pass
+        else:  # pragma: no cover
+            assert False, "the upload must fail"
+
+    def test_resume(self):
+        self.interrupt()
+        assert not self._storage.exists(self.path)
+        assert elliptics_driver.upload_key(self.path) in self.keys()
+        written = self.backend.count('write_data')
+        self._storage.stream_write(self.path,
+                                   StringIO.StringIO(self.content))
+        # the stripe read ahead when the connection dropped is not written
+        assert self._storage.upload_bytes_resumed == 4 * self.stripe
+        # 7 stripes, their checkpoints, the manifest and fake directories
+        assert self.backend.count('write_data') - written == 7 + 7 + 1 + 2
+        assert ''.join(self._storage.stream_read(self.path)) == self.content
+        assert elliptics_driver.upload_key(self.path) not in self.keys()
+        assert self._storage.s_find([elliptics_driver.UPLOADS_INDEX]) == []
+
+    def test_other_content(self):
+        self.interrupt()
+        content = self.content[:3 * self.stripe] + os.urandom(
+            len(self.content) - 3 * self.stripe)
+        self._storage.stream_write(self.path, StringIO.StringIO(content))
+        assert self._storage.upload_bytes_resumed == 3 * self.stripe
+        assert ''.join(self._storage.stream_read(self.path)) == content
+
+    def test_shorter_content(self):
+        self.interrupt(stripes=8)
+        content = self.content[:int(2.5 * self.stripe)]
+        self._storage.stream_write(self.path, StringIO.StringIO(content))
+        assert self._storage.upload_bytes_resumed == 2 * self.stripe
+        assert ''.join(self._storage.stream_read(self.path)) == content
+        assert len(self.stripes()) == 3
+        assert self.keys() == sorted(['images', 'images/a', self.path] +
+                                     self.stripes())
+
+    def test_small_content(self):
+        self.interrupt()
+        self._storage.stream_write(self.path, StringIO.StringIO('data'))
+        assert self._storage.get_content(self.path) == 'data'
+        assert self.keys() == ['images', 'images/a', self.path]
+
+    def test_clean_uploads(self):
+        self.interrupt()
+        assert self._storage.clean_uploads() == []
+        assert self._storage.clean_uploads(ttl=0) == [self.path]
+        assert self.keys() == []
+        assert self._storage.s_find([elliptics_driver.UPLOADS_INDEX]) == []
+
+    def test_clean_uploads_keeps_stored_object(self):
+        self._storage.stream_write(self.path, StringIO.StringIO(
+            self.content[:3 * self.stripe]))
+        self.interrupt()
+        self._storage.clean_uploads(ttl=0)
+        assert len(self.stripes()) == 3
+        assert [key for key in self.keys() if '#stripe' in key] == sorted(
+            self.stripes())
+
+    def test_interrupted_overwrite(self):
+        self._storage.stream_write(self.path, StringIO.StringIO(
+            self.content))
+        stripes = self.stripes()
+        self.interrupt(content=os.urandom(len(self.content)))
+        # the stored object is left whole
+        assert self.stripes() == stripes
+        assert ''.join(self._storage.stream_read(self.path)) == self.content
+        self._storage.clean_uploads(ttl=0)
+        assert [key for key in self.keys() if '#stripe' in key] == sorted(
+            stripes)
+        assert ''.join(self._storage.stream_read(self.path)) == self.content
+
+    def test_resume_completed(self):
+        self._storage.stream_write(self.path, StringIO.StringIO(
+            self.content))
+        # the manifest has been written, the checkpoint has not been removed
+        generation = self._storage.stat(self.path).generation
+        self._storage.s_save_checkpoint(self.path, self.path, generation, [])
+        self.interrupt(content=os.urandom(len(self.content)))
+        assert ''.join(self._storage.stream_read(self.path)) == self.content
+
+    def test_dedup(self):
+        config = dict(self.extra_config, elliptics_dedup=True)
+        storage = self.make_storage(config)
+        self.interrupt(storage)
+        storage.stream_write(self.path, StringIO.StringIO(self.content))
+        assert storage.upload_bytes_resumed == 4 * self.stripe
+        assert ''.join(storage.stream_read(self.path)) == self.content
+        blobs = [key for key in self.keys()
+                 if key.startswith(elliptics_driver.BLOB_PREFIX) and
+                 '#' not in key[len(elliptics_driver.BLOB_PREFIX):]]
+        assert len(blobs) == 1
+
+
+class FuseOSError(OSError):
+    pass
+
+
+def load_registry_fs():
+    """Import fuse_module/registry-fs.py on top of a stub of fusepy,
+    which BlockCache does not use.
+    """
+    fuse = types.ModuleType('fuse')
+    fuse.FUSE = None
+    fuse.FuseOSError = FuseOSError
+    fuse.LoggingMixIn = type('LoggingMixIn', (object,), {})
+    fuse.Operations = type('Operations', (object,), {})
+    saved = sys.modules.get('fuse')
+    root = logging.getLogger()
+    level = root.level
+    sys.modules['fuse'] = fuse
+    try:
+        return imp.load_source('registry_fs', os.path.join(
+            os.path.dirname(os.path.dirname(FAKE_DIR)), 'fuse_module',
+            'registry-fs.py'))
+    except ImportError as err:
+        raise SkipTest("registry-fs.py cannot be imported: %s" % err)
+    finally:
+        root.setLevel(level)
+        if saved is None:
+            sys.modules.pop('fuse')
+        else:
+            sys.modules['fuse'] = saved
+
+
+class TestBlockCache(FakeBackendMixin):
+    stripe = 256 * 1024
+    block = 64 * 1024
+    extra_config = {'elliptics_stripe_size': stripe,
+                    'elliptics_compress_patterns': ['images/*/json']}
+
+    def setUp(self):
+        registry_fs = load_registry_fs()
+        super(TestBlockCache, self).setUp()
+        self.cache = registry_fs.BlockCache(self._storage, self.block,
+                                            blocks=64, read_ahead=2)
+        self.content = os.urandom(int(self.stripe * 2.5))
+        self.path = 'images/a/layer'
+
+    def reads(self):
+        return self.backend.count('read_latest')
+
+    def check(self, path, content):
+        for _ in range(50):
+            offset = random.randint(0, len(content) + 10)
+            length = random.randint(0, 3 * self.block)
+            assert self.cache.read(path, length, offset) == (
+                content[offset:offset + length])
+        assert self.cache.read(path, len(content) + 1, 0) == content
+
+    def test_single_key(self):
+        self._storage.put_content(self.path, self.content)
+        assert not self._storage.stat(self.path).stripe_size
+        self.check(self.path, self.content)
+
+    def test_striped(self):
+        self._storage.stream_write(self.path,
+                                   StringIO.StringIO(self.content))
+        assert self._storage.stat(self.path).stripe_size == self.stripe
+        self.check(self.path, self.content)
+
+    def test_dedup(self):
+        # a blob written in chunks and a striped one
+        for name, config in (('a', {}), ('b', self.extra_config)):
+            path = 'images/%s/layer' % name
+            content = os.urandom(len(self.content))
+            storage = self.make_storage(dict(config, elliptics_dedup=True))
+            storage.stream_write(path, StringIO.StringIO(content))
+            assert self._storage.stat(path).target is not None
+            self.check(path, content)
+
+    def test_compressed(self):
+        content = json.dumps([{'id': '%064d' % n} for n in xrange(4000)])
+        self._storage.put_content('images/a/json', content)
+        assert self._storage.s_read('images/a/json').startswith(
+            elliptics_driver.COMPRESSED_MAGIC)
+        self.check('images/a/json', content)
+
+    def test_read_ahead(self):
+        self._storage.put_content(self.path, self.content)
+        assert self.cache.read(self.path, 10, 0) == self.content[:10]
+        reads = self.reads()
+        # a sequential read of blocks 0 and 1 fetches 2 and 3 in advance
+        assert self.cache.read(self.path, self.block, 10) == (
+            self.content[10:self.block + 10])
+        assert self.reads() - reads == 3
+        reads = self.reads()
+        assert self.cache.read(self.path, 10, 3 * self.block + 1) == (
+            self.content[3 * self.block + 1:3 * self.block + 11])
+        assert self.reads() == reads
+        # a random read does not
+        assert self.cache.read(self.path, 10, 8 * self.block) == (
+            self.content[8 * self.block:8 * self.block + 10])
+        assert self.reads() - reads == 1
+
+
+class TestFakeConfig(FakeBackendMixin):
+    @tools.raises(exceptions.ConfigError)
+    def test_stream_write_inflight_conf(self):
+        self.make_storage({'elliptics_stream_write_inflight': 0})
+
+    @tools.raises(exceptions.ConfigError)
+    def test_stream_read_ahead_conf(self):
+        self.make_storage({'elliptics_stream_read_ahead': -1})
+
+    @tools.raises(exceptions.ConfigError)
+    def test_remove_concurrency_conf(self):
+        self.make_storage({'elliptics_remove_concurrency': 0})
+
+    @tools.raises(exceptions.ConfigError)
+    def test_wait_mode_conf(self):
+        self.make_storage({'elliptics_wait_mode': 'blabla'})
+
+    @tools.raises(exceptions.ConfigError)
+    def test_lookup_concurrency_conf(self):
+        self.make_storage({'elliptics_lookup_concurrency': 0})
+
+    @tools.raises(exceptions.ConfigError)
+    def test_global_index_conf(self):
+        self.make_storage({'elliptics_global_index': 'blabla'})
+
+    @tools.raises(exceptions.ConfigError)
+    def test_global_index_shards_conf(self):
+        self.make_storage({'elliptics_global_index_shards': 0})
+
+    @tools.raises(exceptions.ConfigError)
+    def test_disk_cache_size_conf(self):
+        self.make_storage({'elliptics_disk_cache_size': -1})
+
+    @tools.raises(exceptions.ConfigError)
+    def test_images_read_mode_conf(self):
+        self.make_storage({'elliptics_images_read_mode': 'blabla'})
+
+    @tools.raises(exceptions.ConfigError)
+    def test_hedge_percentile_conf(self):
+        self.make_storage({'elliptics_images_read_mode': 'fastest',
+                           'elliptics_hedge_percentile': 100})
+
+    @tools.raises(exceptions.ConfigError)
+    def test_hedge_read_mode_conf(self):
+        self.make_storage({'elliptics_hedge_percentile': 95})
+
+    @tools.raises(exceptions.ConfigError)
+    def test_stripe_size_conf(self):
+        self.make_storage({'elliptics_stripe_size': 1000})
+
+    @tools.raises(exceptions.ConfigError)
+    def test_compress_min_size_conf(self):
+        self.make_storage({'elliptics_compress_min_size': -1})
+
+    @tools.raises(exceptions.ConfigError)
+    def test_connect_mode_conf(self):
+        self.make_storage({'elliptics_connect_mode': 'blabla'})
+
+    @tools.raises(exceptions.ConfigError)
+    def test_route_refresh_interval_conf(self):
+        self.make_storage({'elliptics_connect_mode': 'lazy',
+                           'elliptics_route_refresh_interval': -1})
+
+    @tools.raises(exceptions.ConfigError)
+    def test_resumable_uploads_conf(self):
+        self.make_storage({'elliptics_resumable_uploads': True})
+
+    @tools.raises(exceptions.ConfigError)
+    def test_upload_ttl_conf(self):
+        self.make_storage({'elliptics_upload_ttl': -1})
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+"""
+Remove what interrupted uploads of a registry stored in Elliptics have
+written when they have not been retried for `elliptics_upload_ttl`
+seconds (with `elliptics_resumable_uploads` on). Run it periodically,
+e.g. daily from cron.
+
+    clean-uploads.py [--ttl SECONDS]
+
+The configuration is loaded the same way the registry loads it
+(DOCKER_REGISTRY_CONFIG and SETTINGS_FLAVOR).
+"""
+
+import argparse
+import logging
+
+from docker_registry.drivers.elliptics import Storage
+from docker_registry.lib import config
+
+logging.basicConfig()
+log = logging.getLogger("")
+log.setLevel(logging.INFO)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Remove interrupted uploads of Elliptics registry")
+    parser.add_argument('--ttl', type=float, default=None,
+                        help="seconds since the last checkpoint "
+                        "(default: elliptics_upload_ttl)")
+    args = parser.parse_args()
+
+    storage = Storage(path=None, config=config.load())
+    removed = storage.clean_uploads(args.ttl)
+    log.info("%d interrupted uploads have been removed", len(removed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+"""
+Bring the global index of a registry stored in Elliptics in line with
+`elliptics_global_index` (and `elliptics_global_index_shards`) of the
+registry configuration: after switching modes or changing the number
+of shards run it once over the whole tree.
+
+    rebuild-global-index.py [--old-shards N] [path]
+
+The configuration is loaded the same way the registry loads it
+(DOCKER_REGISTRY_CONFIG and SETTINGS_FLAVOR).
+"""
+
+import argparse
+import logging
+
+from docker_registry.drivers.elliptics import Storage
+from docker_registry.lib import config
+
+logging.basicConfig()
+log = logging.getLogger("")
+log.setLevel(logging.INFO)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Rebuild the global index of Elliptics registry keys")
+    parser.add_argument('path', nargs='?', default='',
+                        help="directory to rebuild (default: everything)")
+    parser.add_argument('--old-shards', type=int, default=None,
+                        help="number of shards keys were written with")
+    args = parser.parse_args()
+
+    storage = Storage(path=None, config=config.load())
+    log.info("Rebuilding global index of '%s' in %s mode", args.path,
+             storage.global_index)
+    count = storage.rebuild_global_index(args.path, args.old_shards)
+    log.info("%d keys have been reindexed", count)
+
+
+if __name__ == '__main__':
+    main()